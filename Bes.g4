@@ -1,7 +1,7 @@
 grammar Bes;
 
 file
-    :   (importDecl | statement)* EOF
+    :   (importDecl | exportDecl | statement)* EOF
     ;
 
 // Lexer rules
@@ -78,6 +78,10 @@ importDecl
     :   'import' IDENTIFIER ';'
     ;
 
+exportDecl
+    :   'export' IDENTIFIER (',' IDENTIFIER)* ';'
+    ;
+
 possiblyBracketedIdentifier
     :   IDENTIFIER
     |   '[' IDENTIFIER ']'
@@ -99,9 +103,14 @@ exprStm
     :   EXPR IDENTIFIER '=' expression ';'
     ;
 
+macroStm
+    :   MACRO IDENTIFIER '(' idList ')' blockExpr
+    ;
+
 statement
     :   letStm
     |   exprStm
+    |   macroStm
     |   functionStm
     ;
 
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import struct
+import hashlib
+import zipfile
+import zlib
+from datetime import datetime
+
+from zip_format import WorkbookFormatError, check_zip32, dos_date_time
+
+# Blobs that no snapshot refers to are only deleted once they are this old, so
+# that a backup being made at the same time (e.g. by --batch) never loses a
+# blob it has written or reused but not yet recorded in its snapshot
+GARBAGE_GRACE_SECONDS = 3600
+
+CHUNK_SIZE = 1 << 20
+
+class BackupStore:
+    """
+    Content-addressed store of workbook backups in `backup_dir`. A workbook is
+    split into its zip members, and the (already compressed) data of each one
+    is stored once in objects/, named by its SHA-256, however many backups it
+    is in. Files that aren't zip archives are stored whole and compressed.
+
+    Each backup is a snapshot: a small JSON file in snapshots/ that lists the
+    blobs and zip headers needed to rebuild the workbook with restore().
+    """
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.objects_dir = os.path.join(backup_dir, "objects")
+        self.snapshots_dir = os.path.join(backup_dir, "snapshots")
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots_dir, f"{snapshot_id}.json")
+
+    def put_blob(self, read_chunks, level):
+        """
+        Stores the bytes yielded by read_chunks() unless they are already
+        stored, and returns their hash. read_chunks is called a second time to
+        write a new blob, so that a blob that exists is only read once.
+        """
+        hasher = hashlib.sha256()
+        for chunk in read_chunks():
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            # Mark it as in use for the garbage collector (see GARBAGE_GRACE_SECONDS)
+            os.utime(path)
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            compressor = zlib.compressobj(level)
+            with open(tmp_path, "wb") as file:
+                for chunk in read_chunks():
+                    file.write(compressor.compress(chunk))
+                file.write(compressor.flush())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest
+
+    def read_blob(self, digest, out):
+        decompressor = zlib.decompressobj()
+        hasher = hashlib.sha256()
+        with open(self.blob_path(digest), "rb") as file:
+            while chunk := file.read(CHUNK_SIZE):
+                data = decompressor.decompress(chunk)
+                hasher.update(data)
+                out.write(data)
+        data = decompressor.flush()
+        hasher.update(data)
+        out.write(data)
+        if hasher.hexdigest() != digest:
+            raise ValueError(f"The backup blob {digest} is corrupt")
+
+    def backup(self, filepath):
+        """
+        Backs up the file at `filepath` and returns the id of its snapshot. If
+        the file is the same as in its latest snapshot, that snapshot's id is
+        returned instead.
+        """
+        filename = os.path.basename(filepath)
+        source = os.path.abspath(filepath)
+        try:
+            snapshot = self.backup_zip(filepath)
+        except (zipfile.BadZipFile, WorkbookFormatError):
+            snapshot = self.backup_whole(filepath)
+        snapshot.update(file=filename, source=source, size=os.path.getsize(filepath))
+
+        latest = self.snapshots(source)
+        content = {key: value for key, value in snapshot.items() if key not in ("source", "size")}
+        if latest and {key: latest[-1].get(key) for key in content} == content:
+            return latest[-1]["id"]
+
+        now = time.time()
+        snapshot["time"] = now
+        # Workbooks with the same name in different directories get different ids
+        content_hash = hashlib.sha256(json.dumps(dict(content, source=source), sort_keys=True).encode("utf-8")).hexdigest()
+        stem = os.path.splitext(filename)[0]
+        snapshot["id"] = f"{stem}_{datetime.fromtimestamp(now).strftime('%Y-%m-%d_%H-%M-%S')}_{content_hash[:8]}"
+
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        path = self.snapshot_path(snapshot["id"])
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(snapshot, file, indent=1)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return snapshot["id"]
+
+    def backup_zip(self, filepath):
+        members = []
+        with open(filepath, "rb") as src, zipfile.ZipFile(src) as archive:
+            check_zip32(archive)
+            for info in archive.infolist():
+                offset, length = member_data_span(src, info)
+                def read_chunks():
+                    src.seek(offset)
+                    remaining = length
+                    while remaining > 0:
+                        chunk = src.read(min(CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise WorkbookFormatError("Unexpected end of file")
+                        remaining -= len(chunk)
+                        yield chunk
+                # Deflated data doesn't compress any further
+                level = 1 if info.compress_type == zipfile.ZIP_STORED else 0
+                members.append({
+                    "name": info.orig_filename,
+                    "blob": self.put_blob(read_chunks, level),
+                    "date_time": list(info.date_time),
+                    "compress_type": info.compress_type,
+                    # Without the data descriptor bit, since the sizes go in the local header
+                    "flag_bits": info.flag_bits & ~0x08,
+                    "crc": info.CRC,
+                    "compress_size": info.compress_size,
+                    "file_size": info.file_size,
+                    "create_version": info.create_version,
+                    "create_system": info.create_system,
+                    "extract_version": info.extract_version,
+                    "internal_attr": info.internal_attr,
+                    "external_attr": info.external_attr,
+                    "extra": info.extra.hex(),
+                    "comment": info.comment.hex(),
+                })
+            comment = archive.comment.hex()
+        return {"kind": "zip", "members": members, "comment": comment}
+
+    def backup_whole(self, filepath):
+        def read_chunks():
+            with open(filepath, "rb") as file:
+                while chunk := file.read(CHUNK_SIZE):
+                    yield chunk
+        return {"kind": "file", "blob": self.put_blob(read_chunks, 6)}
+
+    def snapshots(self, filepath=None):
+        """The snapshots (of the workbook at `filepath`, if given), oldest first."""
+        source = None if filepath is None else os.path.abspath(filepath)
+        snapshots = []
+        try:
+            entries = os.listdir(self.snapshots_dir)
+        except OSError:
+            return snapshots
+        for entry in entries:
+            if not entry.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.snapshots_dir, entry), "r") as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if source is None or snapshot.get("source") == source:
+                snapshots.append(snapshot)
+        snapshots.sort(key=lambda snapshot: snapshot["time"])
+        return snapshots
+
+    def restore(self, snapshot_id, output_path):
+        """Rebuilds the workbook in the snapshot `snapshot_id` at `output_path`."""
+        with open(self.snapshot_path(snapshot_id), "r") as file:
+            snapshot = json.load(file)
+        # Write next to the destination first, so a failed restore leaves it as it was
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as out:
+                if snapshot["kind"] == "file":
+                    self.read_blob(snapshot["blob"], out)
+                else:
+                    self.write_zip(snapshot, out)
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def write_zip(self, snapshot, out):
+        central_dir = []
+        for member in snapshot["members"]:
+            filename = member["name"].encode("utf-8" if member["flag_bits"] & 0x800 else "cp437")
+            extra = bytes.fromhex(member["extra"])
+            comment = bytes.fromhex(member["comment"])
+            offset = out.tell()
+            dostime, dosdate = dos_date_time(member["date_time"])
+            header = (member["flag_bits"], member["compress_type"], dostime, dosdate, member["crc"],
+                      member["compress_size"], member["file_size"], len(filename))
+            out.write(struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, member["extract_version"], 0,
+                                  *header, len(extra)))
+            out.write(filename)
+            out.write(extra)
+            self.read_blob(member["blob"], out)
+            central_dir.append(struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, member["create_version"],
+                                           member["create_system"], member["extract_version"], 0, *header,
+                                           len(extra), len(comment), 0, member["internal_attr"],
+                                           member["external_attr"], offset) + filename + extra + comment)
+        central_dir_offset = out.tell()
+        central_dir = b"".join(central_dir)
+        comment = bytes.fromhex(snapshot["comment"])
+        out.write(central_dir)
+        out.write(struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, len(snapshot["members"]),
+                              len(snapshot["members"]), len(central_dir), central_dir_offset, len(comment)))
+        out.write(comment)
+
+    def delete_snapshot(self, snapshot_id):
+        try:
+            os.remove(self.snapshot_path(snapshot_id))
+        except FileNotFoundError:
+            pass
+
+    def blob_sizes(self):
+        sizes = {}
+        try:
+            prefixes = os.listdir(self.objects_dir)
+        except OSError:
+            return sizes
+        for prefix in prefixes:
+            directory = os.path.join(self.objects_dir, prefix)
+            for entry in os.listdir(directory):
+                if not entry.endswith(".tmp"):
+                    sizes[entry] = os.path.getsize(os.path.join(directory, entry))
+        return sizes
+
+    def prune(self, keep=None, max_age_days=None, max_size_mb=None, protect=()):
+        """
+        Deletes the snapshots beyond the newest `keep` of each workbook, the
+        ones older than `max_age_days`, and then the oldest ones until the
+        blobs take at most `max_size_mb`, except the snapshots in `protect`.
+        Then deletes the blobs no snapshot refers to. Returns the ids of the
+        deleted snapshots.
+        """
+        snapshots = self.snapshots()
+        deleted = set()
+        if keep is not None:
+            by_source = {}
+            for snapshot in snapshots:
+                by_source.setdefault(snapshot["source"], []).append(snapshot)
+            for source_snapshots in by_source.values():
+                for snapshot in source_snapshots[:max(len(source_snapshots) - keep, 0)]:
+                    deleted.add(snapshot["id"])
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 86400
+            deleted.update(snapshot["id"] for snapshot in snapshots if snapshot["time"] < cutoff)
+        deleted -= set(protect)
+        remaining = [snapshot for snapshot in snapshots if snapshot["id"] not in deleted]
+
+        sizes = self.blob_sizes()
+        if max_size_mb is not None:
+            references = {}
+            for snapshot in remaining:
+                for digest in snapshot_blobs(snapshot):
+                    references[digest] = references.get(digest, 0) + 1
+            total = sum(sizes.get(digest, 0) for digest in references)
+            for snapshot in list(remaining):
+                if total <= max_size_mb * 1e6:
+                    break
+                if snapshot["id"] in protect:
+                    continue
+                remaining.remove(snapshot)
+                deleted.add(snapshot["id"])
+                for digest in snapshot_blobs(snapshot):
+                    references[digest] -= 1
+                    if references[digest] == 0:
+                        total -= sizes.get(digest, 0)
+
+        for snapshot_id in deleted:
+            self.delete_snapshot(snapshot_id)
+        self.collect_garbage(remaining, sizes)
+        return sorted(deleted)
+
+    def collect_garbage(self, snapshots=None, sizes=None):
+        """Deletes the blobs that no snapshot refers to (see GARBAGE_GRACE_SECONDS)."""
+        if snapshots is None:
+            snapshots = self.snapshots()
+        if sizes is None:
+            sizes = self.blob_sizes()
+        referenced = {digest for snapshot in snapshots for digest in snapshot_blobs(snapshot)}
+        cutoff = time.time() - GARBAGE_GRACE_SECONDS
+        for digest in sizes:
+            if digest in referenced:
+                continue
+            path = self.blob_path(digest)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+def snapshot_blobs(snapshot):
+    if snapshot["kind"] == "file":
+        return {snapshot["blob"]}
+    return {member["blob"] for member in snapshot["members"]}
+
+def member_data_span(src, info):
+    """The offset and length of the compressed data of the zip member `info`."""
+    src.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+        raise WorkbookFormatError(f"Bad local header for {info.filename}")
+    filename_length, extra_length = header[10], header[11]
+    return info.header_offset + zipfile.sizeFileHeader + filename_length + extra_length, info.compress_size
@@ -0,0 +1,201 @@
+"""
+Measures how Best's phases scale with the size and shape of a Bes program.
+Each axis of bench/workload.py is swept in turn, with the other parameters at
+their defaults, and every phase is timed:
+
+* parse: reading and parsing the script and its imports (no cache)
+* compile: compiling the parsed files into formulas (the files come from a warm cache)
+* xlfn: adding the "_xlfn." prefixes to the compiled formulas
+* load, store, save: reading the defined names of a workbook, storing the names
+  in it and saving it, both with the fast path and with `--full-load` (openpyxl)
+* up_to_date: checking that the saved workbook already holds the names, which
+  is all a build that changes nothing does
+
+The peak memory used while parsing is measured in a separate, untimed run.
+
+Run it with the Python that runs Best (the venv):
+
+    .venv/bin/python bench/compile_bench.py [--axes names,if_chain] [--quick] [--json out.json]
+
+To check for regressions, save the results of one commit with --json and pass
+them to a later run with --compare. With --max-ratio, exits with status 1 if a
+phase got slower by more than that factor.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import contextlib
+import io
+import subprocess
+import tempfile
+import tracemalloc
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.abspath(os.path.join(bench_dir, os.pardir))
+sys.path.insert(0, root_dir)
+
+import best
+import formula_tokens
+from module_cache import ModuleCache
+from workload import DEFAULTS, generate_workload, generate_workbook
+
+# The values each axis is swept over
+AXES = {
+    "names": [100, 1000, 5000],
+    "lets_per_block": [1, 10, 100],
+    "if_chain": [1, 10, 100],
+    "expr_depth": [1, 10, 100],
+    "imports": [1, 10, 50],
+    "diamond": [False, True],
+    "rows": [100, 10000, 50000],
+}
+
+# Differences below this are noise, whatever the ratio
+MIN_REGRESSION_MS = 1.0
+
+def time_ms(function, runs):
+    """Returns the fastest of `runs` calls of `function` in ms, and its last result."""
+    fastest = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = function()
+        fastest = min(fastest, (time.perf_counter() - start) * 1000)
+    return fastest, result
+
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root_dir, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def workbook_phases(lets, workbook_path, output_path, full_load, runs):
+    prefix = "full_" if full_load else ""
+    load_ms, wb = time_ms(lambda: best.load_defined_names(workbook_path, full_load), runs)
+    store_ms, _ = time_ms(lambda: best.store_lets(lets, wb, False, True), runs)
+    save_ms, _ = time_ms(lambda: wb.save(output_path), runs)
+    phases = {f"{prefix}load": load_ms, f"{prefix}store": store_ms, f"{prefix}save": save_ms}
+    if not full_load:
+        phases["up_to_date"], _ = time_ms(lambda: best.workbook_up_to_date(lets, output_path, False), runs)
+    return phases
+
+def peak_memory_mb(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+def run_case(directory, overrides, args):
+    params = {**DEFAULTS, **overrides}
+    script = generate_workload(directory, **params)
+    workbook_path = os.path.join(directory, f"rows_{params['rows']}.xlsx")
+    if not os.path.exists(workbook_path):
+        generate_workbook(workbook_path, params["rows"])
+    output_path = os.path.join(directory, "out.xlsx")
+
+    phases = {}
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        phases["parse"], _ = time_ms(lambda: best.get_file_elements(script, parser=args.parser), args.runs)
+        parse_peak_mb = peak_memory_mb(lambda: best.get_file_elements(script, parser=args.parser, jobs=1))
+
+        cache = ModuleCache(None, in_memory=True)
+        best.get_file_elements(script, cache, args.parser)
+        phases["compile"], lets = time_ms(lambda: best.compile_file(script, cache, parser=args.parser), args.runs)
+
+        ok = lets is not None
+        if ok:
+            functions = best.xlfn_functions(best.DEFAULT_TARGET)
+            formulas = list(lets.values())
+            phases["xlfn"], _ = time_ms(
+                lambda: [formula_tokens.prefix_function_calls(formula, functions) for formula in formulas], args.runs)
+            phases.update(workbook_phases(lets, workbook_path, output_path, False, args.runs))
+            if not args.no_full_load:
+                phases.update(workbook_phases(lets, workbook_path, output_path, True, args.runs))
+
+    result = {"ok": ok, "phases_ms": phases, "parse_peak_mb": parse_peak_mb}
+    if ok:
+        result["formula_chars"] = sum(len(formula) for formula in lets.values())
+    else:
+        result["output"] = output.getvalue().splitlines()[-5:]
+    return result
+
+def compare(results, baseline, max_ratio):
+    """Prints how each phase changed since `baseline` and returns the phases that regressed."""
+    regressions = []
+    for case, result in results["cases"].items():
+        old = baseline.get("cases", {}).get(case)
+        if old is None:
+            continue
+        for phase, ms in result["phases_ms"].items():
+            old_ms = old["phases_ms"].get(phase)
+            if old_ms is None:
+                continue
+            ratio = ms / old_ms if old_ms > 0 else float("inf")
+            print(f"{case:24} {phase:12} {old_ms:10.2f} -> {ms:10.2f} ms  {ratio:6.2f}x")
+            if max_ratio is not None and ratio > max_ratio and ms - old_ms > MIN_REGRESSION_MS:
+                regressions.append(f"{case} {phase}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark how Best's phases scale with synthetic Bes programs.")
+    parser.add_argument("--axes", help=f"Comma-separated axes to sweep (defaults to all of {', '.join(AXES)})")
+    parser.add_argument("--quick", action="store_true", help="Only sweep the two smallest values of each axis")
+    parser.add_argument("--runs", type=int, default=3, help="Number of timed runs of each phase (defaults to 3)")
+    parser.add_argument("--parser", choices=best.PARSERS, default="antlr", help="The Bes parser to use (defaults to antlr)")
+    parser.add_argument("--no-full-load", dest="no_full_load", action="store_true", help="Don't time loading and saving workbooks with openpyxl")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare the results with the ones in this file (from --json)")
+    parser.add_argument("--max-ratio", dest="max_ratio", type=float, help="With --compare, fail if a phase got slower by more than this factor")
+    args = parser.parse_args()
+
+    axes = args.axes.split(",") if args.axes else list(AXES)
+    for axis in axes:
+        if axis not in AXES:
+            parser.error(f"Unknown axis: {axis}")
+
+    # Import the lazily imported modules up front so the first case isn't slower for it
+    import workbook_xml
+    if args.parser == "antlr":
+        best.import_parser()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parser": args.parser,
+        "runs": args.runs,
+        "defaults": DEFAULTS,
+        "cases": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for axis in axes:
+            values = AXES[axis][:2] if args.quick else AXES[axis]
+            for value in values:
+                case = f"{axis}={value}"
+                result = run_case(os.path.join(tmp_dir, case), {axis: value}, args)
+                result.update(axis=axis, value=value)
+                results["cases"][case] = result
+                phases = "  ".join(f"{phase} {ms:.1f}" for phase, ms in result["phases_ms"].items())
+                phases = f"{phases}  parse peak {result['parse_peak_mb']:.1f} MB"
+                status = "" if result["ok"] else "  (did not compile)"
+                print(f"{case:24} {phases}{status}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        print(f"\nCompared with {baseline.get('commit') or args.compare} (times in ms):")
+        regressions = compare(results, baseline, args.max_ratio)
+        if regressions:
+            print(f"Slower by more than {args.max_ratio}x: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Compiles Bes programs at each optimization level (-O) and evaluates calls of
+the compiled names with evaluator.py, to check that they compute the right
+thing and to measure how much work it takes. For each case it prints the
+result and the evaluation steps, LAMBDA calls, deepest recursion and arrays
+allocated. Run it with the Python that runs Best (the venv):
+
+    .venv/bin/python bench/eval_bench.py [--parser fast] [--json out.json]
+
+Exits with status 1 if a result is wrong. To check for regressions, save the
+results of one commit with --json and pass them to a later run with
+--compare; with --max-ratio, it also fails if a case takes more than that
+factor more steps.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import io
+import tempfile
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.abspath(os.path.join(bench_dir, os.pardir))
+sys.path.insert(0, root_dir)
+
+import best
+import evaluator
+from compile_bench import git_commit
+
+# Programs that aren't in examples/
+PROGRAMS = {
+    "pasted_exprs.bes": """
+expr squares = "SUM(SEQUENCE(100)^2)";
+let ratio = "`squares` / (`squares` + 1)";
+fn scaled(x) {
+    "x * `squares` - `squares`"
+}
+let invoked = "LAMBDA(x, x*2)(10+20+30+40) + LAMBDA(y, y*3)(10+20+30+40)";
+expr divided_by_zero = "SUM(SEQUENCE(10)) / 0";
+let guarded = "IF(1 > 2, `divided_by_zero` + `divided_by_zero`, 7)";
+""",
+    "branches.bes": """
+fn grade(score) {
+    if "score >= 90" { s"A" }
+    else if "score >= 80" { s"B" }
+    else if "score >= 70" { s"C" }
+    else { s"F" }
+}
+fn count_down(n) {
+    ifl "n <= 0" { "0" } else { "1 + count_down(n - 1)" }
+}
+""",
+    "tail_calls.bes": """
+fn fib2_rec(a, b, i) {
+    ifl "i <= 0" { "a" } else if "i = 1" { "b" } else { "fib2_rec(b, a + b, i - 1)" }
+}
+fn total(n, [sum]) {
+    let s = "IF(ISOMITTED(sum), 0, sum)";
+    if "n <= 0" { s } else { "total(n - 1, s + n)" }
+}
+""",
+    "exports.bes": """
+export entry;
+let entry = "Helper(20) + 1";
+fn helper(x) {
+    "x * 2"
+}
+fn unused(y) {
+    "y"
+}
+""",
+    "macros.bes": """
+macro sum_multiply(a, b, c) {
+    "(`a` + `b`) * `c`"
+}
+macro twice(x) {
+    let t = "`x` * 2";
+    "t + t"
+}
+expr _e = "EXP(1)";
+let two_plus_pi_times_e = "`sum_multiply(2, PI(), `_e`)`";
+fn shifted(t) {
+    "`twice(t)` + `twice(t + 1)` + `twice(`twice(t)`)`"
+}
+""",
+}
+
+# Compiled with --loops
+LOOPS = {"tail_calls.bes": ["*"]}
+
+# (script, formula, expected result)
+CASES = [
+    ("examples/levenshtein.bes", 'lev("kitten", "sitting")', 3),
+    ("examples/levenshtein.bes", 'lev("flaw", "lawn")', 2),
+    ("examples/fib.bes", "fib(15)", 610),
+    ("examples/fib.bes", "\\fib2(30)", 832040),
+    ("pasted_exprs.bes", "ratio", 338350 / 338351),
+    ("pasted_exprs.bes", "scaled(2)", 338350),
+    ("pasted_exprs.bes", "invoked", 500),
+    ("pasted_exprs.bes", "guarded", 7),
+    ("branches.bes", "grade(85)", "B"),
+    ("branches.bes", "grade(12)", "F"),
+    ("branches.bes", "count_down(200)", 200),
+    ("tail_calls.bes", "fib2_rec(0, 1, 30)", 832040),
+    ("tail_calls.bes", "total(900)", 405450),
+    ("exports.bes", "entry", 41),
+    ("macros.bes", "two_plus_pi_times_e", (2 + 3.141592653589793) * 2.718281828459045),
+    ("macros.bes", "shifted(1)", 28),
+]
+
+# Differences below this are noise, whatever the ratio
+MIN_REGRESSION_STEPS = 100
+
+def compile_script(path, optimize, parser):
+    loop_patterns = LOOPS.get(os.path.basename(path))
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        lets = best.compile_file(path, optimize=optimize, parser=parser, loop_patterns=loop_patterns)
+    if lets is None:
+        raise RuntimeError(f"{path} did not compile:\n{output.getvalue()}")
+    return lets
+
+def run_case(lets, formula, expected):
+    ev = evaluator.Evaluator(lets)
+    start = time.perf_counter()
+    value = evaluator.to_python(ev.evaluate(formula))
+    ms = (time.perf_counter() - start) * 1000
+    if isinstance(expected, float):
+        ok = isinstance(value, (int, float)) and abs(value - expected) <= 1e-9 * abs(expected)
+    else:
+        ok = value == expected
+    result = {"ok": ok, "value": value, "ms": ms, **ev.stats()}
+    if ev.unsupported:
+        result["unsupported"] = sorted(ev.unsupported)
+    return result
+
+def compare(results, baseline, max_ratio):
+    """Prints how the steps of each case changed since `baseline` and returns the cases that regressed."""
+    regressions = []
+    for case, result in results["cases"].items():
+        old = baseline.get("cases", {}).get(case)
+        if old is None:
+            continue
+        ratio = result["steps"] / old["steps"] if old["steps"] > 0 else float("inf")
+        print(f"{case:48} {old['steps']:10} -> {result['steps']:10} steps  {ratio:6.2f}x")
+        if max_ratio is not None and ratio > max_ratio and result["steps"] - old["steps"] > MIN_REGRESSION_STEPS:
+            regressions.append(case)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate compiled Bes programs without Excel and count the work it takes.")
+    parser.add_argument("--parser", choices=best.PARSERS, default="antlr", help="The Bes parser to use (defaults to antlr)")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", help="Compare the results with the ones in this file (from --json)")
+    parser.add_argument("--max-ratio", dest="max_ratio", type=float, help="With --compare, fail if a case takes more steps by more than this factor")
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(), "parser": args.parser, "cases": {}}
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, source in PROGRAMS.items():
+            with open(os.path.join(tmp_dir, name), "w") as file:
+                file.write(source)
+        compiled = {}
+        for script, formula, expected in CASES:
+            path = os.path.join(root_dir, script) if script.startswith("examples/") else os.path.join(tmp_dir, script)
+            for optimize in range(best.optimizer.MAX_LEVEL + 1):
+                if (path, optimize) not in compiled:
+                    compiled[path, optimize] = compile_script(path, optimize, args.parser)
+                case = f"{formula} -O{optimize}"
+                result = run_case(compiled[path, optimize], formula, expected)
+                results["cases"][case] = result
+                status = "" if result["ok"] else f"  (expected {expected!r})"
+                print(f"{case:48} = {result['value']!r:12} steps {result['steps']:8}  calls {result['calls']:6}  "
+                      f"depth {result['max_depth']:5}  arrays {result['arrays']:5} ({result['array_cells']} cells)  "
+                      f"{result['ms']:.1f} ms{status}")
+                if not result["ok"]:
+                    failures.append(case)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        print(f"\nCompared with {baseline.get('commit') or args.compare}:")
+        regressions = compare(results, baseline, args.max_ratio)
+        if regressions:
+            print(f"More steps by more than {args.max_ratio}x: {', '.join(regressions)}")
+            failures += regressions
+
+    if failures:
+        print(f"Failed: {', '.join(failures)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Compares the hand-written parser (fast_parser.py) with the one ANTLR generates
+from Bes.g4, and measures how fast each of them parses. Run it with the Python
+that runs Best (the venv):
+
+    .venv/bin/python bench/parser_bench.py [--fuzz 500] [--size-kb 512] [--json out.json]
+
+Every file in examples/, plus generated and randomly mutated programs, is
+parsed with both parsers. The lowered modules must be identical, and a file
+that ANTLR reports syntax errors for must be rejected by the fast parser.
+Exits with status 1 on any difference.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+import io
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+sys.path.insert(0, root_dir)
+
+import best
+import fast_parser
+
+FRAGMENTS = [
+    'let a = "1";', 'expr b = "`a` + 1";', 'fn f(x, [y]) { "x + y" }', 'import other;', 'export a, f;',
+    'macro m(x) { "`x` * 2" }', 'macro',
+    'let c = if "a > 1" { "1" } else if "a < 0" { s"neg" } else { b };', 'ifl', '{', '}', '(', ')',
+    '[', ']', ',', ';', '=', '"', 's"', '`', '# comment\n', '\n', ' ', 'else', 'let', 'fn', 'x',
+    '"\\"quoted\\""', '"\\n"', '`a.b`', '\\name', '$',
+]
+
+def generate_program(size, rng):
+    """A syntactically valid Bes program of about `size` characters."""
+    parts = []
+    length = 0
+    i = 0
+    while length < size:
+        kind = rng.randrange(5)
+        if kind == 0:
+            part = f'let name_{i} = "SUM(A1:A{i}) + `expr_{i}`";'
+        elif kind == 1:
+            part = f'expr expr_{i} = if "A{i} > 0" {{ "1" }} else if "A{i} < 0" {{ s"neg" }} else {{ name_{i} }};'
+        elif kind == 2:
+            part = f'fn fn_{i}(a, [b]) {{ let c = "a * b"; expr d = (c); "c + `d`" }}'
+        elif kind == 3:
+            part = f'macro macro_{i}(a, b) {{ let c = "`a` * `b`"; "c + `macro_{i}_inner(c)`" }}'
+        else:
+            part = f'# comment {i}\nlet str_{i} = s"text {i}";'
+        parts.append(part)
+        length += len(part) + 1
+        i += 1
+    return "\n".join(parts)
+
+def mutate(contents, rng):
+    """Inserts, deletes or replaces a few fragments so the result is often, but not always, invalid."""
+    for _ in range(rng.randint(1, 3)):
+        position = rng.randint(0, len(contents))
+        choice = rng.randrange(3)
+        if choice == 0:
+            contents = contents[:position] + rng.choice(FRAGMENTS) + contents[position:]
+        elif choice == 1:
+            contents = contents[:position] + contents[position + rng.randint(1, 10):]
+        else:
+            contents = contents[:position] + rng.choice(FRAGMENTS) + contents[position + rng.randint(1, 10):]
+    return contents
+
+def parse_antlr(contents):
+    # ANTLR prints its syntax errors. The lexer's aren't counted by the parser:
+    # it skips the unrecognized character and carries on, where the fast parser stops.
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr), contextlib.redirect_stdout(io.StringIO()):
+        tree, syntax_errors = best.parse_contents(contents)
+    if syntax_errors or "token recognition error" in stderr.getvalue():
+        return None
+    return best.lower_file(tree)
+
+def parse_fast(contents):
+    try:
+        return fast_parser.parse(contents)
+    except fast_parser.BesSyntaxError:
+        return None
+
+def normalize(module):
+    # Compare the modules the way the cache stores them
+    return None if module is None else json.loads(json.dumps(module))
+
+def compare(name, contents):
+    """Returns a description of the difference between the parsers, or None."""
+    expected = normalize(parse_antlr(contents))
+    actual = normalize(parse_fast(contents))
+    if expected == actual:
+        return None
+    if expected is None:
+        return f"{name}: ANTLR reports syntax errors but the fast parser accepts it"
+    if actual is None:
+        return f"{name}: the fast parser rejects it but ANTLR accepts it"
+    return f"{name}: the lowered modules differ"
+
+def throughput(parse, contents, runs):
+    best_time = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        parse(contents)
+        best_time = min(best_time, time.perf_counter() - start)
+    return len(contents.encode("utf-8")) / best_time / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the fast Bes parser against ANTLR and benchmark both.")
+    parser.add_argument("--fuzz", type=int, default=300, help="Number of mutated programs to compare (defaults to 300)")
+    parser.add_argument("--size-kb", dest="size_kb", type=int, default=256, help="Size of the generated program parsed for throughput (defaults to 256)")
+    parser.add_argument("--runs", type=int, default=3, help="Number of timed parses of each parser (defaults to 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated programs (defaults to 0)")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    best.import_parser()
+
+    cases = []
+    examples_dir = os.path.join(root_dir, "examples")
+    for filename in sorted(os.listdir(examples_dir)):
+        if filename.endswith(".bes"):
+            with open(os.path.join(examples_dir, filename)) as file:
+                cases.append((f"examples/{filename}", file.read()))
+    for i in range(20):
+        cases.append((f"generated {i}", generate_program(rng.randint(10, 2000), rng)))
+    seeds = [contents for _, contents in cases]
+    for i in range(args.fuzz):
+        cases.append((f"mutated {i}", mutate(rng.choice(seeds), rng)))
+
+    differences = [difference for name, contents in cases if (difference := compare(name, contents))]
+    for difference in differences:
+        print(difference)
+    print(f"Compared {len(cases)} programs: {len(differences)} differences")
+
+    contents = generate_program(args.size_kb * 1024, rng)
+    results = {
+        "programs": len(cases),
+        "differences": differences,
+        "size_bytes": len(contents),
+        "antlr_mb_per_s": throughput(parse_antlr, contents, args.runs),
+        "fast_mb_per_s": throughput(parse_fast, contents, args.runs),
+    }
+    print(f"antlr {results['antlr_mb_per_s']:8.2f} MB/s")
+    print(f"fast  {results['fast_mb_per_s']:8.2f} MB/s")
+    print(f"Speedup: {results['fast_mb_per_s'] / results['antlr_mb_per_s']:.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+    if differences:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measures how long Best takes to start up and do nothing, e.g. compile a script
+whose modules are all cached. Run it with the Python that runs Best (the venv):
+
+    .venv/bin/python bench/startup.py [--runs 20] [--max-ms 150] [--json out.json]
+
+With --max-ms, exits with status 1 if the median no-op compile is slower, so it
+can be used to catch startup regressions.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+root_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+best_script = os.path.join(root_dir, "best.py")
+
+# Modules that a no-op compile should never have to import
+HEAVY_MODULES = ["openpyxl", "antlr4", "parser.BesParser", "concurrent.futures.process"]
+
+NOOP_SCRIPT = """
+expr one = "1";
+let two = "`one` + `one`";
+fn add(a, b) { "a + b" }
+"""
+
+def time_command(command, runs, cwd):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return {"min_ms": min(times), "median_ms": statistics.median(times), "max_ms": max(times)}
+
+def imported_heavy_modules(best_args, cwd):
+    # Run Best in-process and report which heavy modules it ended up importing
+    code = (
+        "import sys, runpy, json\n"
+        f"sys.argv = [{best_script!r}, *{best_args!r}]\n"
+        f"sys.path.insert(0, {root_dir!r})\n"
+        "import io, contextlib\n"
+        "with contextlib.redirect_stdout(io.StringIO()):\n"
+        f"    runpy.run_path({best_script!r}, run_name='__main__')\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, check=True, capture_output=True, text=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Best's cold-start latency.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs of each command (defaults to 10)")
+    parser.add_argument("--max-ms", dest="max_ms", type=float, help="Fail if the median no-op compile takes longer than this")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, "noop.bes"), "w") as file:
+            file.write(NOOP_SCRIPT)
+        cache_dir = os.path.join(tmp_dir, "cache")
+        noop_args = ["-s", "noop.bes", "--check", "--cache-dir", cache_dir]
+        # Warm the cache so that the measured compiles don't need the parser
+        subprocess.run([sys.executable, best_script, *noop_args], cwd=tmp_dir, check=True, stdout=subprocess.DEVNULL)
+
+        commands = {
+            "python": [sys.executable, "-c", "pass"],
+            "noop_compile": [sys.executable, best_script, *noop_args],
+            "delete_backups": [sys.executable, best_script, "-d", "delete-backups", "-b", os.path.join(tmp_dir, "backups")],
+        }
+        results = {name: time_command(command, args.runs, tmp_dir) for name, command in commands.items()}
+        results["noop_compile"]["heavy_imports"] = imported_heavy_modules(noop_args, tmp_dir)
+
+    for name, result in results.items():
+        print(f"{name:16} min {result['min_ms']:7.1f} ms   median {result['median_ms']:7.1f} ms   max {result['max_ms']:7.1f} ms")
+    heavy = results["noop_compile"]["heavy_imports"]
+    if heavy:
+        print(f"A no-op compile imported: {', '.join(heavy)}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+    if args.max_ms is not None and results["noop_compile"]["median_ms"] > args.max_ms:
+        print(f"The median no-op compile took longer than {args.max_ms} ms")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
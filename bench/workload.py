@@ -0,0 +1,94 @@
+"""
+Generates synthetic Bes programs and workbooks for the benchmarks. Each
+parameter of a workload scales one thing that Best's running time depends on:
+
+* names: the number of top-level `let`s and `fn`s
+* lets_per_block: the number of `let`s in the body of each `fn`
+* if_chain: the number of branches in each `fn`'s if/else if chain
+* expr_depth: the length of the chain of `expr`s pasted into each other
+* imports: the number of files the main script imports, which the names are spread across
+* diamond: whether every imported file also imports one shared file (which holds the `expr`s)
+* rows: the number of rows of data in the workbook the names are stored in
+"""
+import os
+
+DEFAULTS = {
+    "names": 200,
+    "lets_per_block": 3,
+    "if_chain": 3,
+    "expr_depth": 5,
+    "imports": 1,
+    "diamond": False,
+    "rows": 100,
+}
+
+def expr_statements(depth):
+    lines = ['expr depth_0 = "1";']
+    for i in range(1, depth + 1):
+        lines.append(f'expr depth_{i} = "(`depth_{i - 1}` + {i})";')
+    return lines
+
+def fn_statement(i, params):
+    lines = [f"fn func_{i}(a, [b]) {{"]
+    previous = "a"
+    for j in range(params["lets_per_block"]):
+        lines.append(f'    let tmp_{j} = "{previous} * 2 + b";')
+        previous = f"tmp_{j}"
+    lines.append(f'    if "{previous} > 0" {{ {previous} }}')
+    for j in range(1, params["if_chain"]):
+        lines.append(f'    else if "{previous} > {j}" {{ "SEQUENCE({j}) + {previous}" }}')
+    lines.append(f'    else {{ "XLOOKUP({previous}, A:A, B:B) + `depth_{params["expr_depth"]}`" }}')
+    lines.append("}")
+    return lines
+
+def let_statement(i):
+    return [f'let name_{i} = "SUM(Sheet1!$A$1:$A$10) + func_{i - 1}(1, 2)";']
+
+def module_lines(indices, params):
+    lines = []
+    for i in indices:
+        lines += fn_statement(i, params) if i % 2 == 0 else let_statement(i)
+    return lines
+
+def write_file(path, lines):
+    with open(path, "w") as file:
+        file.write("\n".join(lines))
+        file.write("\n")
+
+def generate_workload(directory, **overrides):
+    """
+    Writes a Bes program with the given parameters (see DEFAULTS) into
+    `directory` and returns the path to its main script.
+    """
+    params = {**DEFAULTS, **overrides}
+    os.makedirs(directory, exist_ok=True)
+    names = range(params["names"])
+    imports = params["imports"]
+
+    if params["diamond"]:
+        write_file(os.path.join(directory, "common.bes"), expr_statements(params["expr_depth"]))
+
+    main_lines = []
+    for k in range(imports):
+        lib_lines = ["import common;"] if params["diamond"] else []
+        if k == 0 and not params["diamond"]:
+            lib_lines += expr_statements(params["expr_depth"])
+        # A `let` calls the `fn` before it, so keep each pair in the same file
+        lib_lines += module_lines([i for i in names if (i // 2) % imports == k], params)
+        write_file(os.path.join(directory, f"lib_{k}.bes"), lib_lines)
+        main_lines.append(f"import lib_{k};")
+
+    main_path = os.path.join(directory, "main.bes")
+    write_file(main_path, main_lines)
+    return main_path
+
+def generate_workbook(path, rows):
+    """Writes a workbook with `rows` rows of data in one sheet."""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet("Sheet1")
+    for row in range(1, rows + 1):
+        sheet.append([row, row * 2.5, f"text {row}", f"=A{row}+B{row}"])
+    wb.save(path)
+    return path
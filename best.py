@@ -1,39 +1,61 @@
 import os
+import errno
 import shutil
 import argparse
 from datetime import datetime
 import re
-
-from openpyxl import Workbook, load_workbook
-from openpyxl.workbook.defined_name import DefinedName
-
-from antlr4 import *
-from parser.BesLexer import BesLexer
-from parser.BesParser import BesParser
+import json
+import hashlib
+import fnmatch
+import time
+import zipfile
+import threading
+import functools
+import xml.etree.ElementTree as ET
 
 import versioned_formulae as vf
+from module_cache import ModuleCache
+from backup_store import BackupStore
+import dependencies
+import formula_tokens
+import profiling
+import optimizer
+import loops
+import outliner
+import macros
+from diagnostics import RED, RESET, Diagnostics, current_diagnostics, error, warning, info
 
-errors = 0
+# openpyxl, the ANTLR runtime and the generated parser are slow to import, so
+# they are imported by the code paths that use them. The parser is only
+# needed when a file is not in the cache.
+antlr4 = None
+BesLexer = None
+BesParser = None
 
-def compile_formula_id_regex(ids):
-    patterns = [rf"(?<![a-zA-Z_\\])\b{re.escape(id)}\b(?![a-zA-Z0-9_\\.])" for id in ids]
-    combined_patern = re.compile('|'.join(patterns))
-    return combined_patern
+def import_parser():
+    global antlr4, BesLexer, BesParser
+    if antlr4 is None:
+        import antlr4 as antlr4_module
+        from parser.BesLexer import BesLexer as lexer_class
+        from parser.BesParser import BesParser as parser_class
+        antlr4, BesLexer, BesParser = antlr4_module, lexer_class, parser_class
 
-def compile_xlfn_regex():
-    return compile_formula_id_regex(vf.versioned_formulae)
+script_dir = os.path.dirname(os.path.realpath(__file__))
 
-RED = "\033[31m"
-YELLOW = "\033[33m"
-RESET = "\033[0m"
+DEFAULT_TARGET = "office_365"
 
-def error(msg):
-    global errors
-    errors += 1
-    print(f"{RED}ERROR: {msg}{RESET}")
-
-def warning(msg):
-    print(f"{YELLOW}WARNING: {msg}{RESET}")
+@functools.lru_cache(maxsize=None)
+def xlfn_functions(target):
+    """
+    The functions that have to be stored with the "_xlfn." prefix for a workbook
+    targeting the given Excel version (see versioned_formulae.versions).
+    """
+    functions = set()
+    for version, version_functions in vf.versions.items():
+        functions |= version_functions
+        if version == target:
+            break
+    return frozenset(functions)
 
 def unexpected_child(child):
     if hasattr(child, "getText"):
@@ -45,317 +67,950 @@ a1_pattern = re.compile(r"^[a-zA-Z]{1,3}[1-9][0-9]*$")
 r1c1_pattern = re.compile(r"^R[1-9][0-9]*C[1-9][0-9]*$")
 
 def validate_name(name: str, line):
-    if re.match(a1_pattern, name):
-        error(f"The name, `{name}`, (line {line}) is not valid since it is an A1-style reference to a cell.")
+    if a1_pattern.match(name):
+        error(f"The name, `{name}`, (line {line}) is not valid since it is an A1-style reference to a cell.", line)
         return
-    if re.match(r1c1_pattern, name):
-        error(f"The name, `{name}`, (line {line}) is not valid since it is an R1C1-style reference to a cell.")
+    if r1c1_pattern.match(name):
+        error(f"The name, `{name}`, (line {line}) is not valid since it is an R1C1-style reference to a cell.", line)
         return
-    if len(name) > 250:
-        error(f"The name, `{name}`, (line {line}) is not valid since it contains more than 250 characters.")
+    if len(name) > outliner.MAX_NAME_LENGTH:
+        error(f"The name, `{name}`, (line {line}) is not valid since it contains more than {outliner.MAX_NAME_LENGTH} characters.", line)
         return
 
-def parse_file(filename):
-    with open(filename, "r") as file:
-        contents = file.read()
-
-    input_stream = InputStream(contents)
+# The generated lexer and parser share their DFA caches with every other
+# instance, which can't be grown by several threads at once
+antlr_lock = threading.Lock()
 
-    lexer = BesLexer(input_stream)
-    token_stream = CommonTokenStream(lexer)
+def syntax_error_listener(syntax_errors):
+    """An ANTLR error listener that adds the (line, column, message) of each syntax error to `syntax_errors`."""
+    from antlr4.error.ErrorListener import ErrorListener
 
-    parser = BesParser(token_stream)
-    tree = parser.file_()
+    class SyntaxErrorListener(ErrorListener):
+        def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
+            syntax_errors.append((line, column, msg))
 
-    return tree
+    return SyntaxErrorListener()
 
-def get_file_elements_rec(filepath, imported_files=None):
-    if imported_files is None:
-        imported_files = set()
+def parse_contents(contents, syntax_errors=None):
+    """
+    Parses `contents` with ANTLR. Its syntax errors are printed, or added to
+    the list, `syntax_errors`, if it's given (see syntax_error_listener).
+    """
+    import_parser()
+    input_stream = antlr4.InputStream(contents)
 
-    if filepath in imported_files:
-        return [], [], []
+    with antlr_lock:
+        lexer = BesLexer(input_stream)
+        token_stream = antlr4.CommonTokenStream(lexer)
 
-    parsed_file = parse_file(filepath)
-    children = parsed_file.getChildren()
+        parser = BesParser(token_stream)
+        if syntax_errors is not None:
+            listener = syntax_error_listener(syntax_errors)
+            for recognizer in (lexer, parser):
+                recognizer.removeErrorListeners()
+                recognizer.addErrorListener(listener)
+        tree = parser.file_()
 
-    import_decls = []
-    expr_stms = []
-    let_stms = []
-    fn_stms = []
+    return tree, parser.getNumberOfSyntaxErrors()
 
-    for child in children:
-        if isinstance(child, BesParser.ImportDeclContext):
-            import_decls.append(child)
-        elif isinstance(child, BesParser.StatementContext):
-            subchildren = list(child.getChildren())
-            if len(subchildren) != 1:
-                raise ValueError(f"Statement object had {len(subchildren)} subchildren")
-            subchild = subchildren[0]
-
-            if isinstance(subchild, BesParser.LetStmContext):
-                let_stms.append(subchild)
-            elif isinstance(subchild, BesParser.ExprStmContext):
-                expr_stms.append(subchild)
-            elif isinstance(subchild, BesParser.FunctionStmContext):
-                fn_stms.append(subchild)
-            else:
-                unexpected_child(subchild)
-        elif isinstance(child, tree.Tree.TerminalNodeImpl) and child.getText() == "<EOF>":
-            pass
+def release_parse_tree(tree):
+    """
+    Breaks the reference cycles between the contexts of an ANTLR parse tree,
+    the parser and its token stream, so that they are freed as soon as the
+    tree has been lowered instead of whenever the garbage collector runs.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        node.parentCtx = None
+        if isinstance(node, antlr4.ParserRuleContext):
+            if node.children:
+                stack.extend(node.children)
+            node.children = None
+            parser = getattr(node, "parser", None)
+            if parser is not None:
+                parser._ctx = None
+                parser._input.tokens.clear()
+                node.parser = None
         else:
-            unexpected_child(child)
+            node.symbol = None
 
-    current_dir = os.path.dirname(filepath)
-    for import_decl in import_decls:
-        import_decl: BesParser.ImportDeclContext
-        identifier = import_decl.IDENTIFIER().getText()
-        if identifier.startswith("\\"):
-            raise ValueError(f"Illegal import name: {identifier}")
-        new_filepath = os.path.join(current_dir, f"{identifier}.bes")
-
-        new_expr_stms, new_let_stms, new_fn_stms = get_file_elements_rec(new_filepath)
-        expr_stms += new_expr_stms
-        let_stms += new_let_stms
-        fn_stms += new_fn_stms
-        
-    return expr_stms, let_stms, fn_stms
+# Parsed files are lowered into plain lists/tuples/strings so that they can be
+# cached on disk (see module_cache.py) and compiled without the parse tree.
+#
+# Statements:
+#   ("let", name, line, expression)
+#   ("expr", name, line, expression)
+#   ("macro", name, line, [(param, line, bracketed), ...], block)
+#   ("fn", name, line, [(param, line, bracketed), ...], block)
+# Expressions:
+#   ("block", [statement, ...], expression)
+#   ("if" | "ifl", condition, block, block or ("if", ...))
+#   ("formula", formula)
+#   ("string", formula)
+#   ("defined", "`name`")
+#   ("id", name)
 
-def stm_to_let(stm, lets, defines, local_defines):
-    if isinstance(stm, BesParser.LetStmContext):
-        identifier = stm.IDENTIFIER().getText()
-        expr = stm.expression()
-        formula = expr_to_formula(expr, defines, local_defines)
-        if identifier in lets:
-            error(f"Redefinition of name `{identifier}` on line {stm.IDENTIFIER().symbol.line}")
-        validate_name(identifier, stm.IDENTIFIER().symbol.line)
-        lets[identifier] = formula
+def lower_statement(stm):
+    if isinstance(stm, BesParser.StatementContext):
+        subchildren = list(stm.getChildren())
+        if len(subchildren) != 1:
+            raise ValueError(f"Statement object had {len(subchildren)} subchildren")
+        return lower_statement(subchildren[0])
+    elif isinstance(stm, BesParser.LetStmContext):
+        identifier = stm.IDENTIFIER()
+        return ("let", identifier.getText(), identifier.symbol.line, lower_expression(stm.expression()))
     elif isinstance(stm, BesParser.ExprStmContext):
-        identifier = stm.IDENTIFIER().getText()
-        expr = stm.expression()
-        formula = expr_to_formula(expr, defines, local_defines)
-        if identifier in local_defines:
-            error(f"Redefinition of name \"{identifier}\" on line {stm.IDENTIFIER().symbol.line}")
-        validate_name(identifier, stm.IDENTIFIER().symbol.line)
-        local_defines[identifier] = formula
-    elif isinstance(stm, BesParser.FunctionStmContext):
-        identifier = stm.IDENTIFIER().getText()
-        matchable_args = []
-        args = ""
+        identifier = stm.IDENTIFIER()
+        return ("expr", identifier.getText(), identifier.symbol.line, lower_expression(stm.expression()))
+    elif isinstance(stm, (BesParser.FunctionStmContext, BesParser.MacroStmContext)):
+        kind = "fn" if isinstance(stm, BesParser.FunctionStmContext) else "macro"
+        identifier = stm.IDENTIFIER()
+        params = []
         for bracketedId in stm.idList().possiblyBracketedIdentifier():
-            id = bracketedId.IDENTIFIER().getText()
-            validate_name(id, bracketedId.IDENTIFIER().symbol.line)
+            param = bracketedId.IDENTIFIER()
             bracketed = bracketedId.getText().startswith("[")
-            matchable_args.append(id)
-            if bracketed:
-                args = f"{args}_xlop.{id},"
-            else:
-                args = f"{args}_xlpm.{id},"
-        defined_arg_regex = compile_formula_id_regex(matchable_args)
-        expr = stm.blockExpr()
-        body_formula = expr_to_formula(expr, defines, local_defines)
-        if args:
-            # Replace parameter "a" with "_xlpm.a". In Excel it still looks like "a", but in the code they store it differently.
-            body_formula = defined_arg_regex.sub(lambda match: f"_xlpm.{match.group(0)}", body_formula)
-        formula = f"LAMBDA({args}{body_formula})"
-        if identifier in lets:
-            error(f"Redefinition of name `{identifier}` on line {stm.IDENTIFIER().symbol.line}")
-        validate_name(identifier, stm.IDENTIFIER().symbol.line)
-        lets[identifier] = formula
-    elif isinstance(stm, BesParser.StatementContext):
-        let_stm = stm.letStm()
-        if let_stm is not None:
-            return stm_to_let(let_stm, lets, defines, local_defines)
-        expr_stm = stm.exprStm()
-        if expr_stm is not None:
-            return stm_to_let(expr_stm, lets, defines, local_defines)
-        function_stm = stm.functionStm()
-        return stm_to_let(function_stm, lets, defines, local_defines)
+            params.append((param.getText(), param.symbol.line, bracketed))
+        return (kind, identifier.getText(), identifier.symbol.line, params, lower_expression(stm.blockExpr()))
     else:
         unexpected_child(stm)
 
+def lower_expression(expr):
+    if isinstance(expr, BesParser.BlockExprContext):
+        statements = [lower_statement(stm) for stm in expr.statement()]
+        return ("block", statements, lower_expression(expr.expression()))
+    elif isinstance(expr, (BesParser.IfExprContext, BesParser.IflExprContext)):
+        kind = "if" if isinstance(expr, BesParser.IfExprContext) else "ifl"
+        condition = lower_expression(expr.expression())
+        value_if_true = lower_expression(expr.blockExpr(0))
+        value_if_false = expr.blockExpr(1)
+        if value_if_false is None:
+            value_if_false = expr.ifExpr()
+        return (kind, condition, value_if_true, lower_expression(value_if_false))
+    elif isinstance(expr, antlr4.tree.Tree.TerminalNodeImpl):
+        text = expr.getText()
+        if expr.getSymbol().type == BesLexer.FORMULA_LITERAL:
+            formula = bytes(text[1:-1], 'utf-8').decode('unicode_escape')
+            return ("formula", formula)
+        elif expr.getSymbol().type == BesLexer.STRING_LITERAL:
+            return ("string", text[1:])
+        elif expr.getSymbol().type == BesLexer.DEFINED_EXPRESSION:
+            return ("defined", text)
+        elif expr.getSymbol().type == BesLexer.IDENTIFIER:
+            return ("id", text)
+        else:
+            unexpected_child(expr)
+    elif isinstance(expr, BesParser.ExpressionContext):
+        for child in (expr.blockExpr(), expr.ifExpr(), expr.iflExpr(), expr.FORMULA_LITERAL(), 
+                      expr.STRING_LITERAL(), expr.DEFINED_EXPRESSION(), expr.IDENTIFIER()):
+            if child is not None:
+                return lower_expression(child)
+        return lower_expression(expr.expression())
+    else:
+        unexpected_child(expr)
+
+def lower_file(parsed_file):
+    module = empty_module()
+    for child in parsed_file.getChildren():
+        if isinstance(child, BesParser.ImportDeclContext):
+            module["imports"].append(child.IDENTIFIER().getText())
+        elif isinstance(child, BesParser.ExportDeclContext):
+            module["exports"] += [identifier.getText() for identifier in child.IDENTIFIER()]
+        elif isinstance(child, BesParser.StatementContext):
+            stm = lower_statement(child)
+            if stm is not None:
+                module[stm[0]].append(stm)
+        elif isinstance(child, antlr4.tree.Tree.TerminalNodeImpl) and child.getText() == "<EOF>":
+            pass
+        else:
+            unexpected_child(child)
+    return module
+
+PARSERS = ["antlr", "fast"]
+
+def empty_module():
+    return {"imports": [], "exports": [], "expr": [], "macro": [], "let": [], "fn": []}
+
+def parse_module(filepath, contents, parser="antlr"):
+    """
+    Parses the `contents` of the Bes file at `filepath` into a lowered module.
+    Returns (module, ok, messages) where `ok` says whether the file had no
+    syntax errors and `messages` lists the (line, message) of each of them.
+    It runs in worker processes too, so it doesn't report errors itself.
+    """
+    if parser == "fast":
+        import fast_parser
+        try:
+            return fast_parser.parse(contents), True, []
+        except fast_parser.BesSyntaxError as e:
+            return empty_module(), False, [(e.line, f"Syntax error in {filepath}, {e}")]
+    syntax_errors = []
+    parsed_file, _ = parse_contents(contents, syntax_errors)
+    module = lower_file(parsed_file)
+    release_parse_tree(parsed_file)
+    messages = [(line, f"Syntax error in {filepath}, line {line}:{column} {msg}") for line, column, msg in syntax_errors]
+    return module, not syntax_errors, messages
+
+def parse_module_job(filepath, contents, parser):
+    start = time.perf_counter()
+    module, ok, messages = parse_module(filepath, contents, parser)
+    return module, ok, messages, (time.perf_counter() - start) * 1000
+
+def finish_module(filepath, contents, parsed, cache, parser):
+    module, ok, messages = parsed
+    for line, message in messages:
+        error(message, line)
+    # Don't cache whatever ANTLR recovered from a file with syntax errors
+    if cache is not None and ok:
+        cache.store(contents, module, parser)
+    return module
+
+def read_source(filepath, sources=None):
+    """
+    The contents of the Bes file at `filepath`, read from `sources` (a dict of
+    normalized paths to contents, see Compiler) instead of the disk if it's given.
+    """
+    if sources is None:
+        with open(filepath, "r") as file:
+            return file.read()
+    try:
+        return sources[os.path.normpath(filepath)]
+    except KeyError:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filepath) from None
+
+def load_module(filepath, cache=None, parser="antlr"):
+    """
+    Loads the Bes file at `filepath` without reporting its syntax errors, which
+    a build (see load_modules) has already reported.
+    """
+    contents = read_source(filepath)
+
+    if cache is not None:
+        module = cache.load(contents, parser)
+        if module is not None:
+            return module
+
+    # Lowering what ANTLR recovered from a file with syntax errors reports errors too
+    token = current_diagnostics.set(Diagnostics(collect=True))
+    try:
+        module, ok, _ = parse_module(filepath, contents, parser)
+    finally:
+        current_diagnostics.reset(token)
+    if cache is not None and ok:
+        cache.store(contents, module, parser)
+    return module
+
+def import_path(filepath, identifier):
+    if identifier.startswith("\\"):
+        raise ValueError(f"Illegal import name: {identifier}")
+    return os.path.normpath(os.path.join(os.path.dirname(filepath), f"{identifier}.bes"))
+
+# Files that aren't cached are only parsed in worker processes when there is
+# at least this much to parse at once, since starting the workers takes time too
+PARALLEL_PARSE_BYTES = 32 * 1024
+
+def load_modules(filepath, cache=None, parser="antlr", jobs=None, profiler=None, sources=None):
+    """
+    Loads the script at `filepath` and every file it imports, directly or
+    indirectly, from the disk or from `sources` (see read_source). Each file is
+    loaded once, however many files import it, and
+    files that aren't cached are parsed in parallel by up to `jobs` worker
+    processes. Returns (paths, modules) where `paths` lists the files in the
+    order their statements are compiled in (see dependencies.import_order)
+    and `modules` maps each path to its module. Raises DependencyCycle if
+    files import each other in a loop.
+    """
+    from collections import deque
+
+    root = os.path.normpath(filepath)
+    modules = {}
+    imports = {}
+    pending = deque([root])
+    discovered = {root}
+    futures = {}
+    pool = None
+
+    def loaded(path, module, ms, cached):
+        modules[path] = module
+        imports[path] = [import_path(path, identifier) for identifier in module["imports"]]
+        for imported in imports[path]:
+            if imported not in discovered:
+                discovered.add(imported)
+                pending.append(imported)
+        if profiler is not None:
+            profiler.parsed(path, ms, cached, [stm[1] for stm in module["let"] + module["fn"]])
+
+    try:
+        while pending or futures:
+            to_parse = []
+            while pending:
+                path = pending.popleft()
+                start = time.perf_counter()
+                contents = read_source(path, sources)
+                module = cache.load(contents, parser) if cache is not None else None
+                if module is not None:
+                    loaded(path, module, (time.perf_counter() - start) * 1000, True)
+                else:
+                    to_parse.append((path, contents))
+
+            if pool is None and jobs != 1 and len(to_parse) + len(futures) > 1 \
+                    and sum(len(contents) for _, contents in to_parse) >= PARALLEL_PARSE_BYTES:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(max_workers=jobs)
+            for path, contents in to_parse:
+                if pool is not None:
+                    futures[pool.submit(parse_module_job, path, contents, parser)] = (path, contents)
+                else:
+                    *parsed, ms = parse_module_job(path, contents, parser)
+                    loaded(path, finish_module(path, contents, parsed, cache, parser), ms, False)
+
+            if futures and not pending:
+                from concurrent.futures import wait, FIRST_COMPLETED
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, contents = futures.pop(future)
+                    *parsed, ms = future.result()
+                    loaded(path, finish_module(path, contents, parsed, cache, parser), ms, False)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return dependencies.import_order(root, imports), modules
+
+def get_file_elements(filepath, cache=None, parser="antlr", jobs=None, profiler=None, exports=None, sources=None):
+    """
+    Returns the (expr and macro, let, fn) statements of the script at
+    `filepath` and every file it imports (see load_modules). If `exports` is
+    given, the names the script exports are added to it.
+    """
+    paths, modules = load_modules(filepath, cache, parser, jobs, profiler, sources)
+    if exports is not None:
+        exports += modules[paths[0]]["exports"]
+
+    expr_stms = []
+    let_stms = []
+    fn_stms = []
+    for path in paths:
+        expr_stms += modules[path]["expr"]
+        expr_stms += modules[path]["macro"]
+        let_stms += modules[path]["let"]
+        fn_stms += modules[path]["fn"]
+    return expr_stms, let_stms, fn_stms
+
 def flatten_if_expr(if_expr):
+    """The (condition, value) branches of an if/else if chain. The condition of the final else is "TRUE"."""
     ifs = []
-    condition = if_expr.expression()
-    value_if_true = if_expr.blockExpr(0)
-    ifs.append((condition, value_if_true))
-
-    value_if_false = if_expr.blockExpr(1)
-    if value_if_false is not None:
-        ifs.append(("TRUE", value_if_false))
-    else:
-        value_if_false = if_expr.ifExpr()
-        subsequent_ifs = flatten_if_expr(value_if_false)
-        ifs += subsequent_ifs
-    
+    while if_expr[0] != "block":
+        _, condition, value_if_true, if_expr = if_expr
+        ifs.append((condition, value_if_true))
+    ifs.append(("TRUE", if_expr))
     return ifs
 
+class Macro:
+    """
+    A `macro` statement, `stm`, with the names that were in scope where it was
+    defined, which its body uses wherever it's expanded. Each distinct tuple
+    of arguments is only expanded once.
+    """
+    def __init__(self, stm, defines, local_defines):
+        self.stm = stm
+        self.defines = defines
+        self.local_defines = local_defines
+        # Arguments: expanded formula
+        self.expansions = {}
+        self.expanding = False
+
+    def expand(self, args, string):
+        """
+        Returns the formula of the macro called with `args` (formulas with
+        their back-tick references already expanded) in `string`, or None if
+        it can't be expanded.
+        """
+        _, name, line, params, body = self.stm
+        key = tuple(args)
+        if key in self.expansions:
+            return self.expansions[key]
+        if self.expanding:
+            error(f"The macro, `{name}` (line {line}), expands itself in string, \"{string}\"", line)
+            return None
+        if len(args) != len(params):
+            error(f"The macro, `{name}` (line {line}), takes {len(params)} argument{'s' if len(params) != 1 else ''} but was given {len(args)} in string, \"{string}\"", line)
+            return None
+        if not all(arg.strip() for arg in args):
+            error(f"Missing argument to the macro, `{name}`, in string, \"{string}\"", line)
+            return None
+
+        # The arguments are pasted like `expr`s, in parentheses
+        arguments = {param: macros.unwrap_parentheses(arg) for (param, _, _), arg in zip(params, args)}
+        self.expanding = True
+        try:
+            formula = expr_to_formula(macros.hygienic_body(body, args), self.defines, {**self.local_defines, **arguments})
+        finally:
+            self.expanding = False
+        self.expansions[key] = formula
+        return formula
+
 def expand_definitions(string, defines, local_defines):
-    while "`" in string:
-        start = string.index("`")
-        end = string.index("`", start+1)
+    if "`" not in string:
+        return string
 
-        name = string[start+1:end]
+    count = 0
+    parts = []
+    last = 0
+    for start, end, name, args in macros.find_references(string):
+        parts.append(string[last:start])
+        if end is None:
+            error(f"Unterminated back-tick in string, \"{string}\"")
+            last = start
+            break
+        last = end
+        # `expr`s are stored already expanded, so their bodies never have to be scanned again
         if name in local_defines:
-            string = string[:start] + "(" + local_defines[name] + ")" + string[end+1:]
+            definition = local_defines[name]
         elif name in defines:
-            string = string[:start] + "(" + defines[name] + ")" + string[end+1:]
+            definition = defines[name]
         else:
             error(f"Unrecognized reference to name, `{name}`, in string, \"{string}\"")
-    return string
+            parts.append(string[start:end])
+            continue
+        if args is None and isinstance(definition, Macro):
+            error(f"The macro, `{name}`, is used without arguments in string, \"{string}\"")
+            parts.append(string[start:end])
+            continue
+        if args is not None:
+            if not isinstance(definition, Macro):
+                error(f"`{name}` is called with arguments in string, \"{string}\", but it is not a macro")
+                parts.append(string[start:end])
+                continue
+            definition = definition.expand([expand_definitions(arg.strip(), defines, local_defines) for arg in args], string)
+            if definition is None:
+                parts.append(string[start:end])
+                continue
+        count += 1
+        parts.append(f"({definition})")
+    parts.append(string[last:])
+
+    current_diagnostics.get().expansions += count
+    # Formulas too long for Excel are split up after they're compiled (see outliner.py)
+    return "".join(parts)
+
+# The code generator doesn't recurse, so how deeply a program can nest is only
+# limited by memory. It works through a stack of tasks, each a tuple whose first
+# item says what to do:
+#
+# ("expr", expr, defines, local_defines): compile `expr` and push its formula
+#     onto the stack of formulas
+# ("stm", stm, lets, defines, local_defines): compile a statement into `lets`
+#     (or `local_defines` for an `expr` or a `macro`), like stm_to_let
+# ("block", lets), ("if", n), ("ifl", n): pop the formulas of the parts of a
+#     block or an if/else if chain of `n` branches and push the whole formula
+# ("let", stm, lets), ("define", stm, local_defines), ("fn", stm, lets): pop
+#     the formula of a statement and define its name
+#
+# The parts of a formula are pushed in order, so each task pops them all at once
+# and joins them, instead of appending to the formula one part at a time.
+def generate(task):
+    """Runs `task` and the ones it leads to. Returns the formulas it pushes."""
+    diagnostics = current_diagnostics.get()
+    formulas = []
+    work = [task]
+    # Bound once, since they're called for every node
+    push = work.append
+    emit = formulas.append
+    while work:
+        task = work.pop()
+        kind = task[0]
+        if kind == "expr":
+            _, expr, defines, local_defines = task
+            expr_kind = expr[0]
+            if expr_kind == "formula" or expr_kind == "defined":
+                emit(expand_definitions(expr[1], defines, local_defines))
+            elif expr_kind == "string":
+                emit(expr[1])
+            elif expr_kind == "id":
+                name = expr[1]
+                definition = local_defines[name] if name in local_defines else defines.get(name)
+                if isinstance(definition, Macro):
+                    error(f"The macro, `{name}`, is used without arguments")
+                    emit(name)
+                elif definition is not None:
+                    diagnostics.expansions += 1
+                    emit(definition)
+                else:
+                    emit(name)
+            elif expr_kind == "block":
+                _, statements, final_expr = expr
+                block_defines = local_defines.copy()
+                lets = {}
+                # Pushed in reverse, so the statements run in order and before the final expression
+                push(("block", lets))
+                push(("expr", final_expr, defines, block_defines))
+                for stm in reversed(statements):
+                    push(("stm", stm, lets, block_defines, defines))
+            elif expr_kind == "if" or expr_kind == "ifl":
+                ifs = flatten_if_expr(expr)
+                push((expr_kind, len(ifs)))
+                for condition, value_if_true in reversed(ifs):
+                    push(("expr", value_if_true, defines, local_defines))
+                    # The else has no condition to compile
+                    if condition != "TRUE":
+                        push(("expr", condition, defines, local_defines))
+            else:
+                unexpected_child(expr)
+                emit(None)
+
+        elif kind == "stm":
+            _, stm, lets, defines, local_defines = task
+            stm_kind = stm[0]
+            if stm_kind == "let":
+                push(("let", stm, lets))
+                push(("expr", stm[3], defines, local_defines))
+            elif stm_kind == "expr":
+                push(("define", stm, local_defines))
+                push(("expr", stm[3], defines, local_defines))
+            elif stm_kind == "macro":
+                # Compiled when it's expanded
+                _, identifier, line, params, _ = stm
+                for id, param_line, bracketed in params:
+                    if bracketed:
+                        error(f"The parameter, `{id}`, of the macro, `{identifier}`, (line {param_line}) can't be optional", param_line)
+                if identifier in local_defines:
+                    error(f"Redefinition of name \"{identifier}\" on line {line}", line)
+                local_defines[identifier] = Macro(stm, defines, local_defines)
+            elif stm_kind == "fn":
+                for id, param_line, bracketed in stm[3]:
+                    validate_name(id, param_line)
+                push(("fn", stm, lets))
+                push(("expr", stm[4], defines, local_defines))
+            else:
+                unexpected_child(stm)
+
+        elif kind == "block":
+            lets = task[1]
+            final_expr = formulas.pop()
+            if lets:
+                names_so_far = set()
+                parts = ["LET("]
+                for name, value in lets.items():
+                    # Replace parameter "a" with "_xlpm.a". In Excel it still looks like "a", but in the code they store it differently.
+                    parts.append(f"_xlpm.{name},{formula_tokens.prefix_names(value, names_so_far)},")
+                    names_so_far.add(name)
+                parts.append(formula_tokens.prefix_names(final_expr, names_so_far))
+                parts.append(")")
+                emit("".join(parts))
+            else:
+                emit(final_expr)
+
+        elif kind == "if" or kind == "ifl":
+            # The condition and value of each branch, and the value of the else
+            count = 2 * task[1] - 1
+            parts = formulas[-count:]
+            del formulas[-count:]
+            if count == 3:
+                # Regular if
+                condition, value_if_true, value_if_false = parts
+                if kind == "if":
+                    emit(f"IF({condition}, {value_if_true}, {value_if_false})")
+                else:
+                    emit(f"IF({condition}, LAMBDA({value_if_true}), LAMBDA({value_if_false}))()")
+            else:
+                parts.insert(count - 1, "TRUE")
+                if kind == "if":
+                    emit(f"IFS({','.join(parts)})")
+                else:
+                    parts[1::2] = [f"LAMBDA({value})" for value in parts[1::2]]
+                    emit(f"IFS({','.join(parts)})()")
+
+        elif kind == "let":
+            _, (_, identifier, line, _), lets = task
+            formula = formulas.pop()
+            if identifier in lets:
+                error(f"Redefinition of name `{identifier}` on line {line}", line)
+            validate_name(identifier, line)
+            lets[identifier] = formula
+
+        elif kind == "define":
+            _, (_, identifier, line, _), local_defines = task
+            formula = formulas.pop()
+            if identifier in local_defines:
+                error(f"Redefinition of name \"{identifier}\" on line {line}", line)
+            validate_name(identifier, line)
+            local_defines[identifier] = formula
+
+        elif kind == "fn":
+            _, (_, identifier, line, params, _), lets = task
+            body_formula = formulas.pop()
+            args = "".join(f"_xlop.{id}," if bracketed else f"_xlpm.{id}," for id, _, bracketed in params)
+            # Replace parameter "a" with "_xlpm.a". In Excel it still looks like "a", but in the code they store it differently.
+            body_formula = formula_tokens.prefix_names(body_formula, {id for id, _, _ in params})
+            formula = f"LAMBDA({args}{body_formula})"
+            if identifier in lets:
+                error(f"Redefinition of name `{identifier}` on line {line}", line)
+            validate_name(identifier, line)
+            lets[identifier] = formula
+
+    return formulas
+
+def stm_to_let(stm, lets, defines, local_defines):
+    generate(("stm", stm, lets, defines, local_defines))
 
 def expr_to_formula(expr, defines, local_defines=None):
     if local_defines is None:
         local_defines = {}
-    if isinstance(expr, BesParser.BlockExprContext):
-        local_defines = local_defines.copy()
-        lets = {}
-
-        for stm in expr.statement():
-            stm_to_let(stm, lets, local_defines, defines)
-        
-        final_expr = expr_to_formula(expr.expression(), defines, local_defines)
-        if lets:
-            names_so_far = []
-            formula = "LET("
-            for name in lets:
-                if names_so_far:
-                    # Replace parameter "a" with "_xlpm.a". In Excel it still looks like "a", but in the code they store it differently.
-                    defined_let_regex = compile_formula_id_regex(names_so_far)
-                    value = defined_let_regex.sub(lambda match: f"_xlpm.{match.group(0)}", lets[name])
-                else:
-                    value = lets[name]
-                formula = f"{formula}_xlpm.{name},{value},"
-                names_so_far.append(name)
-            defined_let_regex = compile_formula_id_regex(names_so_far)
-            final_value = defined_let_regex.sub(lambda match: f"_xlpm.{match.group(0)}", final_expr)
-            formula = f"{formula}{final_value})"
-        else:
-            formula = final_expr
-        return formula
-        
-    elif isinstance(expr, BesParser.IfExprContext):
-        ifs = flatten_if_expr(expr)
-        if len(ifs) == 2:
-            # Regular if
-            condition, value_if_true = ifs[0]
-            value_if_false = ifs[1][1]
-            condition = expr_to_formula(condition, defines, local_defines)
-            value_if_true = expr_to_formula(value_if_true, defines, local_defines)
-            value_if_false = expr_to_formula(value_if_false, defines, local_defines)
-            formula = f"IF({condition}, {value_if_true}, {value_if_false})"
-        else:
-            formula = "IFS("
-            for condition, value_if_true in ifs:
-                if condition != "TRUE":
-                    condition = expr_to_formula(condition, defines, local_defines)
-                value_if_true = expr_to_formula(value_if_true, defines, local_defines)
-                formula = f"{formula}{condition},{value_if_true},"
-
-            formula = f"{formula[:-1]})"
-        return formula
-        
-    elif isinstance(expr, BesParser.IflExprContext):
-        ifs = flatten_if_expr(expr)
-        if len(ifs) == 2:
-            # Regular if
-            condition, value_if_true = ifs[0]
-            value_if_false = ifs[1][1]
-            condition = expr_to_formula(condition, defines, local_defines)
-            value_if_true = expr_to_formula(value_if_true, defines, local_defines)
-            value_if_false = expr_to_formula(value_if_false, defines, local_defines)
-            formula = f"IF({condition}, LAMBDA({value_if_true}), LAMBDA({value_if_false}))()"
-        else:
-            formula = "IFS("
-            for condition, value_if_true in ifs:
-                if condition != "TRUE":
-                    condition = expr_to_formula(condition, defines, local_defines)
-                value_if_true = expr_to_formula(value_if_true, defines, local_defines)
-                formula = f"{formula}{condition},LAMBDA({value_if_true}),"
-
-            formula = f"{formula[:-1]})()"
-        return formula
+    return generate(("expr", expr, defines, local_defines))[0]
 
-    elif isinstance(expr, tree.Tree.TerminalNodeImpl):
-        if expr.getSymbol().type == BesLexer.FORMULA_LITERAL:
-            formula = expr.getText()[1:-1]
-            formula = bytes(formula, 'utf-8').decode('unicode_escape')
-            formula = expand_definitions(formula, defines, local_defines)
-        elif expr.getSymbol().type == BesLexer.STRING_LITERAL:
-            formula = expr.getText()[1:]
-        elif expr.getSymbol().type == BesLexer.DEFINED_EXPRESSION:
-            formula = expr.getText()
-            formula = expand_definitions(formula, defines, local_defines)
-        elif expr.getSymbol().type == BesLexer.IDENTIFIER:
-            name = expr.getText()
-            if name in local_defines:
-                formula = local_defines[name]
-            elif name in defines:
-                formula = defines[name]
-            else:
-                formula = name
-        else:
-            unexpected_child(expr)
-        return formula
+@functools.lru_cache(maxsize=None)
+def compiler_version():
+    """
+    Hash of the compiler's own source, so that formulas recorded in a build
+    manifest are never reused after the compiler changes.
+    """
+    hasher = hashlib.sha256()
+    for filename in sorted(os.listdir(script_dir)):
+        if filename.endswith(".py"):
+            with open(os.path.join(script_dir, filename), "rb") as file:
+                hasher.update(file.read())
+    return hasher.hexdigest()
 
-    elif isinstance(expr, BesParser.ExpressionContext):
-        block_expr = expr.blockExpr()
-        if block_expr is not None:
-            return expr_to_formula(block_expr, defines, local_defines)
-        if_expr = expr.ifExpr()
-        if if_expr is not None:
-            return expr_to_formula(if_expr, defines, local_defines)
-        ifl_expr = expr.iflExpr()
-        if ifl_expr is not None:
-            return expr_to_formula(ifl_expr, defines, local_defines)
-        formula_literal = expr.FORMULA_LITERAL()
-        if formula_literal is not None:
-            return expr_to_formula(formula_literal, defines, local_defines)
-        string_literal = expr.STRING_LITERAL()
-        if string_literal is not None:
-            return expr_to_formula(string_literal, defines, local_defines)
-        defined_expression = expr.DEFINED_EXPRESSION()
-        if defined_expression is not None:
-            return expr_to_formula(defined_expression, defines, local_defines)
-        identifier = expr.IDENTIFIER()
-        if identifier is not None:
-            return expr_to_formula(identifier, defines, local_defines)
-        expression = expr.expression()
-        return expr_to_formula(expression, defines, local_defines)
-    else:
-        unexpected_child(expr)
+def plan_incremental_build(expr_stms, stms, manifest, target, optimize=0, loop_limit=loops.DEFAULT_LIMIT):
+    """
+    Decides what has to be recompiled given the manifest of the previous build.
+    Returns (hashes, stale, needed_exprs) where `stale[i]` says whether `stms[i]`
+    must be recompiled and `needed_exprs` is the set of `expr` names to compile.
+    """
+    version = f"{compiler_version()}-{target}-O{optimize}-L{loop_limit}"
+    if manifest.get("compiler") != version:
+        manifest.clear()
+        manifest.update({"compiler": version, "exprs": [], "names": {}})
+    previous = manifest["names"]
 
-def compile_file(filepath):
-    global errors
-    errors = 0
-    expr_stms, let_stms, fn_stms = get_file_elements_rec(filepath)
-    lets = {}
-    defines = {}
+    hashes = dependencies.input_hashes(expr_stms, stms, version)
+    stale = [previous.get(stm[1], {}).get("hash") != input_hash for stm, input_hash in zip(stms, hashes)]
+
+    expr_stms_by_name = {}
     for expr_stm in expr_stms:
-        stm_to_let(expr_stm, lets, defines.copy(), defines)
-    for let_stm in let_stms:
-        stm_to_let(let_stm, lets, defines.copy(), defines)
-    for fn_stm in fn_stms:
-        stm_to_let(fn_stm, lets, defines.copy(), defines)
+        expr_stms_by_name.setdefault(expr_stm[1], []).append(expr_stm)
 
-    if errors != 0:
-        print(f"Unable to compile due to {errors} errors")
+    # New or edited `expr`s are always compiled so that they report the same errors as a full build
+    known_exprs = set(manifest["exprs"])
+    needed_exprs = {
+        name for name, defs in expr_stms_by_name.items()
+        if len(defs) > 1 or dependencies.fingerprint(defs[0]) not in known_exprs
+    }
+    for stm, is_stale in zip(stms, stale):
+        if is_stale:
+            needed_exprs |= dependencies.inlined_exprs(stm, expr_stms_by_name)
+
+    return hashes, stale, needed_exprs
+
+def tree_shake(expr_stms, stms, entry_points, report_dropped=False):
+    """
+    Returns the statements in `stms` that define the names in `entry_points`
+    or names that they use, and reports how many were dropped.
+    """
+    defined = {stm[1].upper() for stm in stms}
+    for name in entry_points:
+        if name.upper() not in defined:
+            error(f"The exported name, `{name}`, is not defined by a `let` or `fn`")
+
+    reachable = dependencies.reachable_names(expr_stms + stms, entry_points)
+    kept = [stm for stm in stms if stm[1] in reachable]
+    dropped = [stm for stm in stms if stm[1] not in reachable]
+    info(f"Exporting {len(set(entry_points))} names: keeping {len(kept)} names and dropping {len(dropped)} that they don't use")
+    if report_dropped:
+        for stm in dropped:
+            info(f"  Dropped `{stm[1]}` (line {stm[2]})")
+    return kept
+
+def lower_tail_calls(stms, patterns, target, unavailable_functions):
+    """
+    Rewrites the `fn`s in `stms` whose names match one of the globs in
+    `patterns` and that call themselves in a tail position, so that they can
+    be compiled into loops (see loops.py), and reports them. Returns the new
+    statements and the names of the ones that were rewritten.
+    """
+    missing = loops.LOOP_FUNCTIONS & unavailable_functions
+    if missing:
+        warning(f"Not turning tail calls into loops since {', '.join(sorted(missing))} are not available in {target}")
+        return stms, set()
+
+    lowered = []
+    looped = set()
+    for stm in stms:
+        if stm[0] == "fn" and any(fnmatch.fnmatchcase(stm[1], pattern) for pattern in patterns):
+            lowered_stm, tail_calls = loops.lower_tail_calls(stm)
+            if tail_calls:
+                info(f"Turned {tail_calls} tail call{'s' if tail_calls != 1 else ''} of `{stm[1]}` (line {stm[2]}) into a loop")
+                stm = lowered_stm
+                looped.add(stm[1])
+            elif stm[1].upper() in {name.upper() for name in dependencies.statement_references(stm)[1]}:
+                warning(f"`{stm[1]}` (line {stm[2]}) calls itself, but not in a tail position, so it is still recursive", stm[2])
+        lowered.append(stm)
+
+    names = {stm[1] for stm in stms if stm[0] == "fn"}
+    for pattern in patterns:
+        if not any(fnmatch.fnmatchcase(name, pattern) for name in names):
+            warning(f"No `fn` matches `{pattern}` to turn into a loop")
+    return lowered, looped
+
+def compile_file(filepath, cache=None, manifest=None, target=DEFAULT_TARGET, parser="antlr", profiler=None, optimize=0,
+                 exports=None, report_dropped=False, jobs=None, loop_patterns=None, loop_limit=loops.DEFAULT_LIMIT,
+                 max_length=outliner.MAX_LENGTH, max_depth=outliner.MAX_DEPTH, sources=None, reserved_names=()):
+    """
+    Compiles the script at `filepath` and everything it imports into a dict of
+    defined names for the Excel version, `target`, optimized at the level,
+    `optimize` (see optimizer.py). If the script exports names or `exports`
+    are given, only those names and the ones they use are compiled (see
+    tree_shake). The self tail calls of the `fn`s matching the globs in
+    `loop_patterns` are turned into loops of at most `loop_limit` steps (see
+    loops.py). Formulas longer than `max_length` or nested deeper than
+    `max_depth` are split into helper names (see outliner.py), which aren't
+    given any of the `reserved_names` (see workbook_names). If `manifest`
+    (see load_manifest) is given, names whose inputs
+    are unchanged since the build it describes reuse their recorded formula, and
+    the manifest is updated in place to describe this build. If `profiler` (see
+    profiling.py) is given, the time spent on each phase, file and name is recorded in it.
+    Up to `jobs` processes parse the files that aren't cached. If `sources` is
+    given, the files are read from it instead of the disk (see read_source).
+    Errors, warnings and other messages are reported to current_diagnostics.
+    """
+    diagnostics = current_diagnostics.get()
+    diagnostics.errors = 0
+    entry_points = []
+    try:
+        with profiling.phase(profiler, "parse"):
+            expr_stms, let_stms, fn_stms = get_file_elements(filepath, cache, parser, jobs, profiler, entry_points, sources)
+    except dependencies.DependencyCycle as e:
+        error(f"The files {e} import each other")
+        info(f"Unable to compile due to {diagnostics.errors} errors")
         return None
-    
+    stms = let_stms + fn_stms
+    entry_points += exports or []
+    if entry_points:
+        with profiling.phase(profiler, "tree shake"):
+            stms = tree_shake(expr_stms, stms, entry_points, report_dropped)
+
     # Functions introduced into Excel after 2007 are stored in the code with the 
     # prefix, "_xlfn.", so we have to put it into the code with that prefix.
-    versioned_formula_regex = compile_xlfn_regex()
+    functions = xlfn_functions(target)
+    unavailable_functions = vf.versioned_formulae - functions
 
-    for name in lets:
-        defn = lets[name]
-        defn = versioned_formula_regex.sub(lambda match: f"_xlfn.{match.group(0)}", defn)
-        lets[name] = defn
+    looped = set()
+    if loop_patterns:
+        stms, looped = lower_tail_calls(stms, loop_patterns, target, unavailable_functions)
+    with profiling.phase(profiler, "plan"):
+        if manifest is not None:
+            hashes, stale, needed_exprs = plan_incremental_build(expr_stms, stms, manifest, target, optimize, loop_limit)
+        else:
+            stale = [True] * len(stms)
+            needed_exprs = None
+
+        # `expr`s are expanded when they are defined, so compile them after the ones they inline
+        try:
+            expr_stms = dependencies.inline_order(expr_stms)
+        except dependencies.DependencyCycle as e:
+            kinds = sorted({stm[0] for stm in expr_stms if stm[1] in e.path})
+            error(f"The {' and '.join(f'`{kind}`s' for kind in kinds)} {e} are defined in terms of each other")
+            info(f"Unable to compile due to {diagnostics.errors} errors")
+            return None
+
+    lets = {}
+    defines = {}
+    with profiling.phase(profiler, "compile exprs"):
+        for expr_stm in expr_stms:
+            if needed_exprs is None or expr_stm[1] in needed_exprs:
+                stm_to_let(expr_stm, lets, defines.copy(), defines)
+    compiled = []
+    start = time.perf_counter()
+    for stm, is_stale in zip(stms, stale):
+        identifier = stm[1]
+        if is_stale:
+            if profiler is not None:
+                stm_start = time.perf_counter()
+                stm_expansions = diagnostics.expansions
+            stm_to_let(stm, lets, defines.copy(), defines)
+            if profiler is not None:
+                profiler.compiled(identifier, (time.perf_counter() - stm_start) * 1000, diagnostics.expansions - stm_expansions)
+            compiled.append(identifier)
+        else:
+            if identifier in lets:
+                error(f"Redefinition of name `{identifier}` on line {stm[2]}", stm[2])
+            lets[identifier] = manifest["names"][identifier]["formula"]
+
+    if profiler is not None:
+        profiler.add_phase("compile names", (time.perf_counter() - start) * 1000)
+
+    if diagnostics.errors != 0:
+        info(f"Unable to compile due to {diagnostics.errors} errors")
+        return None
+
+    for stm, is_stale in zip(stms, stale):
+        if is_stale and stm[1] in looped:
+            lets[stm[1]] = loops.loop_formula(lets[stm[1]], stm[3], loop_limit)
+
+    if optimize > 0 and "LET" in unavailable_functions:
+        warning(f"Not optimizing since LET is not available in {target}")
+    elif optimize > 0:
+        with profiling.phase(profiler, "optimize"):
+            for stm, is_stale in zip(stms, stale):
+                if is_stale:
+                    identifier = stm[1]
+                    lets[identifier] = optimizer.eliminate_common_subexpressions(lets[identifier], optimize, identifier, stm[0] == "fn")
+
+    with profiling.phase(profiler, "xlfn"):
+        for name in compiled:
+            defn = lets[name]
+            if unavailable_functions:
+                called = {defn[start:end].upper() for start, end in formula_tokens.function_calls(defn)}
+                if called & unavailable_functions:
+                    warning(f"`{name}` calls {', '.join(sorted(called & unavailable_functions))}, which are not available in {target}")
+            lets[name] = formula_tokens.prefix_function_calls(defn, functions)
+
+    # The manifest keeps the whole formulas, which are split again on every build
+    if manifest is not None:
+        manifest["exprs"] = [dependencies.fingerprint(expr_stm) for expr_stm in expr_stms]
+        manifest["names"] = {
+            stm[1]: {"hash": input_hash, "formula": lets[stm[1]]} for stm, input_hash in zip(stms, hashes)
+        }
+
+    with profiling.phase(profiler, "split"):
+        lambda_prefix = None if "LAMBDA" in unavailable_functions else "_xlfn." if "LAMBDA" in functions else ""
+        lets, split = outliner.outline(lets, max_length, max_depth, lambda_prefix, reserved_names)
+    lines = {stm[1]: stm[2] for stm in stms}
+    for name, (helpers, over) in split.items():
+        if helpers:
+            info(f"Split `{name}` into {len(helpers)} helper name{'s' if len(helpers) != 1 else ''} to fit Excel's limits")
+        for helper in helpers:
+            validate_name(helper, lines.get(name))
+        for defined in over:
+            warning(f"`{defined}` is longer than {max_length} characters or nested deeper than {max_depth} levels, which Excel won't open")
+    if profiler is not None:
+        profiler.formulas(lets)
 
     return lets
 
+class CompileResult:
+    """
+    What Compiler.compile returns: the compiled names, or None if there were
+    errors, and the diagnostics the compile reported, in order.
+    """
+    def __init__(self, lets, diagnostics):
+        self.lets = lets
+        self.diagnostics = diagnostics
+
+    @property
+    def ok(self):
+        return self.lets is not None
+
+    @property
+    def errors(self):
+        return [diagnostic for diagnostic in self.diagnostics if diagnostic.severity == "error"]
+
+    @property
+    def warnings(self):
+        return [diagnostic for diagnostic in self.diagnostics if diagnostic.severity == "warning"]
+
+    def to_json(self):
+        return {"ok": self.ok, "names": self.lets, "diagnostics": [diagnostic.to_json() for diagnostic in self.diagnostics]}
+
+class Compiler:
+    """
+    Compiles Bes scripts held in memory, for programs that embed Best, like a
+    service that compiles for many clients. Nothing is printed: each compile
+    returns its diagnostics in a CompileResult.
+
+    A Compiler can be used by many threads at once. Their compiles share the
+    parsed modules, kept in memory by `cache` (up to `memory_limit` of them),
+    and the tables of functions to prefix for each Excel version. `options`
+    are passed to compile_file (e.g. target, optimize or loop_patterns).
+    Files are parsed in the calling thread, not in worker processes.
+    """
+    def __init__(self, parser="antlr", cache_dir=None, memory_limit=None, **options):
+        self.parser = parser
+        self.cache = ModuleCache(cache_dir, in_memory=True, memory_limit=memory_limit)
+        self.options = options
+
+    def compile(self, source=None, files=None, path="main.bes", **options):
+        """
+        Compiles the script at `path` in `files`, a dict of paths to the
+        contents of Bes files, which its imports are read from as well (e.g.
+        {"main.bes": ..., "lib/util.bes": ...}). If `source` is given, it's the
+        script's contents. `options` override the Compiler's for this compile.
+        """
+        sources = {os.path.normpath(file): contents for file, contents in (files or {}).items()}
+        if source is not None:
+            sources[os.path.normpath(path)] = source
+        return self.run(path, sources, options)
+
+    def compile_file(self, filepath, **options):
+        """Compiles the script at `filepath`, reading it and its imports from the disk."""
+        return self.run(filepath, None, options)
+
+    def run(self, filepath, sources, options):
+        diagnostics = Diagnostics(collect=True)
+        token = current_diagnostics.set(diagnostics)
+        try:
+            lets = compile_file(filepath, self.cache, parser=self.parser, jobs=1, sources=sources, **{**self.options, **options})
+        except (OSError, ValueError) as e:
+            error(f"Unable to compile {filepath}: {e}")
+            lets = None
+        finally:
+            current_diagnostics.reset(token)
+        return CompileResult(lets, diagnostics.items)
+
+def manifest_path(workbook_path):
+    return f"{os.path.splitext(workbook_path)[0]}.best.json"
+
+def load_manifest(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
+    with open(path, "w") as file:
+        json.dump(manifest, file, indent=1)
+
 BEST_MARKER = "===Compiled with Best==="
 
+# The comment of each name Best writes holds the marker and a hash of the
+# formula (e.g. "===Compiled with Best=== 3f2a..."), and the hidden name,
+# BUILD_NAME, holds a hash of all of them, so an unchanged build can be
+# detected by reading the defined names alone (see workbook_up_to_date)
+BUILD_NAME = "_best_build"
+marker_pattern = re.compile(rf"{re.escape(BEST_MARKER)}(?: (?P<hash>[0-9a-f]{{16}}))?")
+
+def formula_hash(formula):
+    return hashlib.sha256(formula.encode("utf-8")).hexdigest()[:16]
+
+def build_hash(hashes):
+    """The hash of a build from the formula_hash of each of its names."""
+    hasher = hashlib.sha256()
+    for name in sorted(hashes):
+        hasher.update(f"{name}\0{hashes[name]}\0".encode("utf-8"))
+    return hasher.hexdigest()[:16]
+
+def stored_hash(comment):
+    """The hash in the comment of a name Best wrote, or None."""
+    match = marker_pattern.search(comment) if comment is not None else None
+    return match.group("hash") if match is not None else None
+
+def best_comment(digest, comment=None):
+    """`comment` (of a name Best wrote before) with its hash replaced by `digest`."""
+    if comment is None or BEST_MARKER not in comment:
+        return f"{BEST_MARKER} {digest}"
+    return marker_pattern.sub(lambda _: f"{BEST_MARKER} {digest}", comment, count=1)
+
+def build_defined_name(hashes, comment=None):
+    from openpyxl.workbook.defined_name import DefinedName
+
+    digest = build_hash(hashes)
+    return DefinedName(BUILD_NAME, comment=best_comment(digest, comment), attr_text=f'"{digest}"', hidden=True)
+
 def store_lets(lets, wb, no_clear, overwrite):
+    from openpyxl.workbook.defined_name import DefinedName
+
     old_comments = {}
     if not no_clear:
         for name in list(wb.defined_names):
@@ -368,17 +1023,182 @@ def store_lets(lets, wb, no_clear, overwrite):
         if name in wb.defined_names and not overwrite:
             error(f"Name {name} already defined in the workbook and `overwrite` was not passed in.")
             continue
-        comment = old_comments.get(name, BEST_MARKER)
+        comment = best_comment(formula_hash(lets[name]), old_comments.get(name))
         defn = DefinedName(name, comment=comment, attr_text=lets[name])
         wb.defined_names[name] = defn
+    if lets:
+        hashes = {name: formula_hash(lets[name]) for name in lets}
+        wb.defined_names[BUILD_NAME] = build_defined_name(hashes, old_comments.get(BUILD_NAME))
 
-def backup_file(filepath, backup_dir):
-    os.makedirs(backup_dir, exist_ok=True)
-    filename = os.path.basename(filepath)
-    curtime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    new_filename = f"{filename[:-len('.xlsx')]}_{curtime}.xlsx"
+def update_lets(lets, wb, no_clear, overwrite):
+    """
+    Has the same effect as store_lets, but only touches the names whose hash
+    differs from the one stored with them, or whose value was changed since
+    Best wrote it. Returns the names that were written or removed.
+    """
+    from openpyxl.workbook.defined_name import DefinedName
+
+    changed = []
+    if not no_clear:
+        for name in list(wb.defined_names):
+            defn = wb.defined_names[name]
+            if name not in lets and name != BUILD_NAME and defn.comment is not None and BEST_MARKER in defn.comment:
+                del wb.defined_names[name]
+                changed.append(name)
+
+    hashes = {}
+    for name in lets:
+        digest = hashes[name] = formula_hash(lets[name])
+        comment = None
+        existing = wb.defined_names.get(name)
+        if existing is not None:
+            replaceable = not no_clear and existing.comment is not None and BEST_MARKER in existing.comment
+            if not replaceable and not overwrite:
+                error(f"Name {name} already defined in the workbook and `overwrite` was not passed in.")
+                continue
+            if replaceable:
+                if stored_hash(existing.comment) == digest and existing.attr_text == lets[name]:
+                    continue
+                comment = existing.comment
+        wb.defined_names[name] = DefinedName(name, comment=best_comment(digest, comment), attr_text=lets[name])
+        changed.append(name)
+
+    build = wb.defined_names.get(BUILD_NAME)
+    if not lets:
+        if build is not None and not no_clear:
+            del wb.defined_names[BUILD_NAME]
+    elif build is None or stored_hash(build.comment) != build_hash(hashes):
+        wb.defined_names[BUILD_NAME] = build_defined_name(hashes, build.comment if build is not None else None)
+    return changed
+
+def workbook_up_to_date(lets, filepath, no_clear):
+    """
+    Whether storing `lets` in the workbook at `filepath` would leave it as it
+    is, judging by the hashes Best stored in it. Only the defined names of the
+    workbook are read.
+    """
+    import workbook_xml
+
+    hashes = {name: formula_hash(lets[name]) for name in lets}
+    expected_build = build_hash(hashes)
+    found = 0
+    build_found = False
+    try:
+        for name, comment, value in workbook_xml.iter_defined_name_values(filepath):
+            if name == BUILD_NAME:
+                if stored_hash(comment) != expected_build:
+                    return False
+                build_found = True
+            elif name in lets:
+                if value != lets[name] or stored_hash(comment) != hashes[name]:
+                    return False
+                found += 1
+            elif not no_clear and comment is not None and BEST_MARKER in comment:
+                # A name from an older build that would be removed
+                return False
+    except (OSError, zipfile.BadZipFile, ET.ParseError, workbook_xml.WorkbookFormatError):
+        return False
+    return build_found and found == len(lets)
+
+def workbook_names(filepath):
+    """
+    The names in the workbook at `filepath` that Best didn't write, which the
+    helpers of split formulas must not replace (see outliner.py).
+    """
+    import workbook_xml
+
+    if not filepath or not os.path.exists(filepath):
+        return set()
+    try:
+        return {
+            name for name, comment, _ in workbook_xml.iter_defined_name_values(filepath)
+            if comment is None or BEST_MARKER not in comment
+        }
+    except (OSError, zipfile.BadZipFile, ET.ParseError, workbook_xml.WorkbookFormatError):
+        return set()
+
+def load_defined_names(filepath, full_load=False):
+    """
+    Loads the workbook at `filepath` for reading or changing its defined names.
+    Unless `full_load` is set, only xl/workbook.xml is read, and saving copies
+    the rest of the workbook as-is (see workbook_xml.py).
+    """
+    import workbook_xml
+
+    if not full_load:
+        try:
+            return workbook_xml.DefinedNamesWorkbook(filepath)
+        except workbook_xml.WorkbookFormatError as e:
+            warning(f"Loading the whole workbook: {e}")
+    from openpyxl import load_workbook
+    return load_workbook(filepath)
+
+def backup_file(filepath, args):
+    """
+    Backs up the file at `filepath` to the backup store in args.backup_dir
+    (see backup_store.py), then applies the retention settings to the store.
+    """
+    store = BackupStore(args.backup_dir)
+    snapshot_id = store.backup(filepath)
+    deleted = store.prune(args.backup_keep, args.backup_max_age, args.backup_max_size, protect={snapshot_id})
+    if deleted:
+        print(f"Deleted {len(deleted)} old backups")
+    return snapshot_id
+
+def list_backups(store, filepath=None):
+    for snapshot in store.snapshots(filepath):
+        created = datetime.fromtimestamp(snapshot["time"]).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"{snapshot['id']}: {snapshot['source']} ({snapshot['size'] / 1e6:.1f} MB) backed up at {created}")
+
+def restore_backup(args, output_file=None):
+    """
+    Restores the backup args.snapshot, or the newest backup of `output_file`,
+    to `output_file` (defaults to the path the workbook was backed up from).
+    """
+    store = BackupStore(args.backup_dir)
+    if args.snapshot:
+        snapshots = [snapshot for snapshot in store.snapshots() if snapshot["id"] == args.snapshot]
+        if not snapshots:
+            print(f"ERROR: There is no backup called {args.snapshot} in {args.backup_dir}")
+            return
+    else:
+        snapshots = store.snapshots(output_file)
+        if not snapshots:
+            print(f"ERROR: There are no backups of {output_file} in {args.backup_dir}")
+            return
+    snapshot_id = snapshots[-1]["id"]
+    if output_file is None:
+        output_file = snapshots[-1]["source"]
+    if os.path.exists(output_file) and not args.no_backup:
+        backup_file(output_file, args)
+    try:
+        store.restore(snapshot_id, output_file)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Unable to restore {snapshot_id}: {e}")
+        return
+    print(f"Restored {snapshot_id} to {output_file}")
 
-    shutil.copyfile(filepath, os.path.join(backup_dir, new_filename))
+def print_defined_names(defined_names, full, best_only, pattern, as_json):
+    for defn in defined_names:
+        if best_only and (defn.comment is None or BEST_MARKER not in defn.comment):
+            continue
+        if pattern is not None and not fnmatch.fnmatchcase(defn.name, pattern):
+            continue
+        if as_json:
+            if full:
+                record = {key: value for key, value in defn}
+                record["value"] = defn.attr_text
+            else:
+                record = {"name": defn.name, "comment": defn.comment, "value": defn.attr_text}
+            print(json.dumps(record))
+            continue
+        print(f"{defn.name}: ")
+        if not full:
+            if defn.comment:
+                print(f"\tComment: {defn.comment}")
+            print(f"\tValue: {defn.attr_text}")
+        else:
+            print(f"\t{defn}")
 
 def do(args, output_file):
     if args.do == "clear-bes-defs":
@@ -386,8 +1206,8 @@ def do(args, output_file):
             print("ERROR: To perform this action, you must provide an input")
             return
         if not args.no_backup:
-            backup_file(args.input, args.backup_dir)
-        wb = load_workbook(args.input)
+            backup_file(args.input, args)
+        wb = load_defined_names(args.input, args.full_load)
         store_lets({}, wb, False, False)
         wb.save(output_file)
     elif args.do == "clear-defs":
@@ -395,8 +1215,8 @@ def do(args, output_file):
             print("ERROR: To perform this action, you must provide an input")
             return
         if not args.no_backup:
-            backup_file(args.input, args.backup_dir)
-        wb = load_workbook(args.input)
+            backup_file(args.input, args)
+        wb = load_defined_names(args.input, args.full_load)
         for name in list(wb.defined_names):
             del wb.defined_names[name]
         wb.save(output_file)
@@ -404,22 +1224,238 @@ def do(args, output_file):
         if not args.input:
             print("ERROR: To perform this action, you must provide an input")
             return
-        if not args.no_backup:
-            backup_file(args.input, args.backup_dir)
-        wb = load_workbook(args.input)
-        for name in wb.defined_names:
-            print(f"{name}: ")
-            if args.do == "print-defs":
-                if wb.defined_names[name].comment:
-                    print(f"\tComment: {wb.defined_names[name].comment}")
-                print(f"\tValue: {wb.defined_names[name].attr_text}")
-            else:
-                print(f"\t{wb.defined_names[name]}")
+        # Nothing gets written, so there is no need for a backup
+        if args.full_load:
+            from openpyxl import load_workbook
+            defined_names = load_workbook(args.input).defined_names.values()
+        else:
+            import workbook_xml
+            defined_names = workbook_xml.iter_defined_names(args.input)
+        print_defined_names(defined_names, args.do == "print-defs-full", args.best_only, args.names, args.json)
     elif args.do == "delete-backups":
-        shutil.rmtree(args.backup_dir)
+        if os.path.isdir(args.backup_dir):
+            shutil.rmtree(args.backup_dir)
+    elif args.do == "list-backups":
+        list_backups(BackupStore(args.backup_dir), args.input)
+    elif args.do == "restore-backup":
+        if args.input or args.output:
+            restore_backup(args, output_file)
+        elif args.snapshot:
+            restore_backup(args)
+        else:
+            print("ERROR: To restore a backup, you must provide an input, an output or a --snapshot")
     else:
         error(f"Unrecognized action: {args.do}")
 
+def write_lets(lets, input_file, output_file, args, profiler=None):
+    """
+    Stores `lets` in the workbook at `input_file` (or a new workbook) and saves
+    it to `output_file`. Returns whether the workbook was saved or was already
+    up to date.
+    """
+    if input_file and os.path.abspath(input_file) == os.path.abspath(output_file):
+        with profiling.phase(profiler, "up-to-date check"):
+            up_to_date = workbook_up_to_date(lets, input_file, args.no_clear)
+        if up_to_date:
+            print(f"{output_file} is up to date")
+            return True
+
+    if input_file:
+        if not args.no_backup:
+            with profiling.phase(profiler, "backup"):
+                backup_file(input_file, args)
+        with profiling.phase(profiler, "workbook load"):
+            wb = load_defined_names(input_file, args.full_load)
+    else:
+        with profiling.phase(profiler, "workbook load"):
+            from openpyxl import Workbook
+            wb = Workbook()
+
+    with profiling.phase(profiler, "store"):
+        changed = update_lets(lets, wb, args.no_clear, args.overwrite_defs)
+        removed = sum(name not in lets for name in changed)
+        print(f"Updated {len(changed) - removed} of {len(lets)} names" + (f", removed {removed}" if removed else ""))
+
+    errors = current_diagnostics.get().errors
+    if errors != 0:
+        print(f"Unable to save the file because of {errors} errors")
+        return False
+    
+    with profiling.phase(profiler, "workbook save"):
+        wb.save(output_file)
+    return True
+
+def load_batch(filepath):
+    """
+    Reads a batch file: a JSON list of jobs like
+    {"script": "lib.bes", "input": "in.xlsx", "output": "out.xlsx"}, where
+    "input" and "output" are optional like --input and --output. Relative
+    paths are relative to the batch file.
+    """
+    with open(filepath, "r") as file:
+        entries = json.load(file)
+    if not isinstance(entries, list):
+        raise ValueError("Expected a list of jobs")
+
+    base_dir = os.path.dirname(os.path.abspath(filepath))
+    def resolve(path):
+        return os.path.join(base_dir, path) if path else path
+
+    jobs = []
+    outputs = set()
+    for i, entry in enumerate(entries):
+        script = resolve(entry.get("script"))
+        input_file = resolve(entry.get("input"))
+        output_file = resolve(entry.get("output")) or input_file
+        if not script:
+            raise ValueError(f"Job {i} has no script")
+        if not output_file:
+            raise ValueError(f"Job {i} needs an input or an output")
+        for path in (input_file, output_file):
+            if path and not path.endswith(".xlsx"):
+                raise ValueError(f"Job {i}: \"{path}\" must end with \".xlsx\"")
+        if output_file in outputs:
+            raise ValueError(f"Job {i} writes to {output_file}, which another job also writes to")
+        outputs.add(output_file)
+        jobs.append({"script": script, "input": input_file, "output": output_file})
+    return jobs
+
+def run_batch_job(lets, input_file, output_file, args):
+    # Worker processes are reused between jobs
+    current_diagnostics.get().errors = 0
+    start = time.perf_counter()
+    saved = write_lets(lets, input_file, output_file, args)
+    return saved, time.perf_counter() - start
+
+def run_batch(args):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    try:
+        jobs = load_batch(args.batch)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: Unable to read the batch file, {args.batch}: {e}")
+        return
+
+    # Every distinct script is compiled once, however many workbooks it goes into
+    cache = None if args.no_cache else ModuleCache(args.cache_dir)
+    compiled = {}
+    # A script's helper names must not clash with a name in any of the workbooks it goes into
+    reserved = {}
+    for job in jobs:
+        reserved.setdefault(job["script"], set()).update(workbook_names(job["input"]))
+    for job in jobs:
+        script = job["script"]
+        if script not in compiled:
+            start = time.perf_counter()
+            try:
+                compiled[script] = compile_file(script, cache, target=args.target_excel, parser=args.parser, optimize=args.optimize,
+                                                exports=args.export, report_dropped=args.report_dropped, jobs=args.jobs,
+                                                loop_patterns=args.loops, loop_limit=args.loop_limit,
+                                                max_length=args.max_length, max_depth=args.max_depth,
+                                                reserved_names=reserved[script])
+            except (OSError, ValueError) as e:
+                error(f"Unable to compile {script}: {e}")
+                compiled[script] = None
+            print(f"Compiled {script} in {time.perf_counter() - start:.2f}s")
+
+    failures = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {}
+        for job in jobs:
+            lets = compiled[job["script"]]
+            if lets is None:
+                failures += 1
+                print(f"{RED}FAILED{RESET} {job['output']}: {job['script']} did not compile")
+                continue
+            futures[pool.submit(run_batch_job, lets, job["input"], job["output"], args)] = job
+
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                saved, elapsed = future.result()
+            except Exception as e:
+                saved, elapsed = False, None
+                print(f"{RED}FAILED{RESET} {job['output']}: {type(e).__name__}: {e}")
+            else:
+                status = "OK" if saved else f"{RED}FAILED{RESET}"
+                print(f"{status} {job['output']} ({elapsed:.2f}s)")
+            if not saved:
+                failures += 1
+
+    print(f"{len(jobs) - failures} of {len(jobs)} jobs succeeded")
+
+WATCH_INTERVAL = 0.5
+
+def module_files(filepath, cache=None, parser="antlr"):
+    """
+    Returns the paths of `filepath` and of every file it imports, directly or
+    indirectly, including imports that don't exist (yet).
+    """
+    files = []
+    stack = [os.path.normpath(filepath)]
+    while stack:
+        path = stack.pop()
+        if path in files:
+            continue
+        files.append(path)
+        try:
+            module = load_module(path, cache, parser)
+        except OSError:
+            continue
+        for identifier in module["imports"]:
+            try:
+                stack.append(import_path(path, identifier))
+            except ValueError:
+                continue
+    return files
+
+def modification_times(files):
+    mtimes = {}
+    for path in files:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+def watch(args, output_file):
+    """
+    Rebuilds `output_file` whenever the script or a file it imports changes.
+    Parsed modules stay in memory between builds, only the names affected by
+    a change are recompiled, and only the definitions that changed are
+    rewritten.
+    """
+    cache = ModuleCache(None if args.no_cache else args.cache_dir, in_memory=True)
+    manifest = {}
+    watch_args = argparse.Namespace(**{**vars(args), "incremental": True})
+    input_file = args.input
+
+    print(f"Watching {args.script} (Ctrl+C to stop)")
+    try:
+        while True:
+            start = time.perf_counter()
+            misses = cache.misses
+            try:
+                lets = compile_file(args.script, cache, manifest, args.target_excel, args.parser, optimize=args.optimize,
+                                    exports=args.export, report_dropped=args.report_dropped, jobs=args.jobs,
+                                    loop_patterns=args.loops, loop_limit=args.loop_limit,
+                                    max_length=args.max_length, max_depth=args.max_depth,
+                                    reserved_names=workbook_names(input_file))
+                if lets is not None and write_lets(lets, input_file, output_file, watch_args):
+                    # From now on, update the output in place. The input was backed up by the first build
+                    input_file = output_file
+                    watch_args.no_backup = True
+            except (OSError, ValueError) as e:
+                error(f"Unable to build: {e}")
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"Built in {elapsed:.0f} ms ({cache.misses - misses} files parsed)")
+
+            mtimes = modification_times(module_files(args.script, cache, args.parser))
+            while modification_times(mtimes) == mtimes:
+                time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
 def main(args):
     # Validate the output file
     if args.output:
@@ -440,30 +1476,65 @@ def main(args):
     if args.do:
         do(args, output_file)
         return
+
+    if (args.profile or args.profile_json or args.cprofile) and (args.watch or args.batch):
+        print("ERROR: --profile can't be used with --watch or --batch")
+        return
+
+    if args.watch:
+        if not args.script:
+            print("ERROR: --watch needs a --script to watch")
+            return
+        watch(args, output_file)
+        return
+
+    if args.batch:
+        if args.incremental:
+            print("ERROR: --incremental can't be used with --batch")
+            return
+        run_batch(args)
+        return
     
     if not args.script:
-        print("ERROR: Expected either --script or --do to be specified")
+        print("ERROR: Expected either --script, --batch or --do to be specified")
         return
 
-    lets = compile_file(args.script)
+    profiler = profiling.Profiler() if args.profile or args.profile_json else None
+    if args.cprofile:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    try:
+        build(args, output_file, profiler)
+    finally:
+        if args.cprofile:
+            cprofiler.disable()
+            cprofiler.dump_stats(args.cprofile)
+        if profiler is not None:
+            if args.profile:
+                print(profiler.report())
+            if args.profile_json:
+                profiler.save_json(args.profile_json)
+
+def build(args, output_file, profiler=None):
+    cache = None if args.no_cache else ModuleCache(args.cache_dir)
+    manifest = load_manifest(manifest_path(output_file)) if args.incremental else None
+    lets = compile_file(args.script, cache, manifest, args.target_excel, args.parser, profiler, args.optimize,
+                        args.export, args.report_dropped, args.jobs, args.loops, args.loop_limit, args.max_length, args.max_depth,
+                        reserved_names=workbook_names(args.input))
     if lets is None:
         return
 
-    if args.input:
-        if not args.no_backup:
-            backup_file(args.input, args.backup_dir)
-        wb = load_workbook(args.input)
-    else:
-        wb = Workbook()
-
-    store_lets(lets, wb, args.no_clear, args.overwrite_defs)
-
-    if errors != 0:
-        print(f"Unable to save the file because of {errors} errors")
+    if args.check:
+        print(f"Compiled {len(lets)} names without errors")
         return
+
+    if write_lets(lets, args.input, output_file, args, profiler) and args.incremental:
+        save_manifest(manifest_path(output_file), manifest)
     
-    wb.save(output_file)
-    
+
+def name_list(value):
+    return [name.strip() for name in value.split(",") if name.strip()]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Transpiler from Bud Excel Script to Excel Workbook.")
@@ -475,9 +1546,38 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--output", help="The output Excel file (defaults to input file if specified, or 'BesBook.xlsx')")
     parser.add_argument("-b", "--backup-dir", dest="backup_dir", help="The directory to put backups (defaults to ./backups)", default="./backups")
     parser.add_argument("--no-backup", dest="no_backup", help="Do not backup the input file before overwriting it", action="store_true")
+    parser.add_argument("--backup-keep", dest="backup_keep", help="Only keep this many of the newest backups of each workbook", type=int)
+    parser.add_argument("--backup-max-age", dest="backup_max_age", help="Delete backups older than this many days", type=float)
+    parser.add_argument("--backup-max-size", dest="backup_max_size", help="Delete the oldest backups until the backup directory takes at most this many MB", type=float)
+    parser.add_argument("--snapshot", help="The backup to restore with `-d restore-backup` (defaults to the newest backup of the output workbook, see `-d list-backups`)")
     parser.add_argument("--no-clear-defs", dest="no_clear", help="Do not remove old definitions created by Best (non-Best definitions are unaffected)", action="store_true")
     parser.add_argument("--overwrite-defs", dest="overwrite_defs", help="Overwrite existing definitions", action="store_true")
-    parser.add_argument("-d", "--do", help="Do an action instead of compiling a script", choices=["clear-bes-defs", "clear-defs", "print-defs", "print-defs-full", "delete-backups"])
+    parser.add_argument("--cache-dir", dest="cache_dir", help="The directory to cache parsed Bes files in (defaults to ./.best_cache)", default="./.best_cache")
+    parser.add_argument("--no-cache", dest="no_cache", help="Parse every Bes file from scratch without reading or writing the cache", action="store_true")
+    parser.add_argument("--parser", help="The Bes parser to use: the one generated by ANTLR from Bes.g4 or the faster hand-written one (defaults to antlr)", choices=PARSERS, default="antlr")
+    parser.add_argument("--full-load", dest="full_load", help="Load and save the whole input workbook with openpyxl instead of only rewriting its defined names", action="store_true")
+    parser.add_argument("--incremental", help="Only recompile and rewrite the names affected by changes since the last incremental build (tracked in a .best.json manifest next to the output)", action="store_true")
+    parser.add_argument("--target-excel", dest="target_excel", help=f"The oldest Excel version the workbook has to work in (defaults to {DEFAULT_TARGET})", choices=list(vf.versions), default=DEFAULT_TARGET)
+    parser.add_argument("-O", dest="optimize", help="The optimization level: 0 (none, the default), 1 to bind `expr`s pasted more than once in a name in a LET, 2 to also bind repeated function calls", type=int, choices=range(optimizer.MAX_LEVEL + 1), default=0)
+    parser.add_argument("--export", help="Comma-separated names to write to the workbook along with the names they use, in addition to the ones the script exports (all names are written if there are none)", type=name_list)
+    parser.add_argument("--loops", help="Turn the calls that the `fn`s matching these comma-separated globs (all `fn`s if none are given) make to themselves in a tail position into REDUCE loops, which have no recursion limit. Their parameters and results must be single values, not arrays", type=name_list, nargs="?", const=["*"])
+    parser.add_argument("--loop-limit", dest="loop_limit", help=f"The most steps a loop made by --loops runs before giving up with #N/A (defaults to {loops.DEFAULT_LIMIT})", type=int, default=loops.DEFAULT_LIMIT)
+    parser.add_argument("--max-formula-length", dest="max_length", help=f"Split formulas longer than this into helper names (defaults to {outliner.MAX_LENGTH}, Excel's limit)", type=int, default=outliner.MAX_LENGTH)
+    parser.add_argument("--max-nesting", dest="max_depth", help=f"Split formulas nested deeper than this into helper names (defaults to {outliner.MAX_DEPTH}, Excel's limit)", type=int, default=outliner.MAX_DEPTH)
+    parser.add_argument("--report-dropped", dest="report_dropped", help="List the names left out because no exported name uses them", action="store_true")
+    parser.add_argument("--check", help="Only compile the script and report errors, without writing a workbook", action="store_true")
+    parser.add_argument("-w", "--watch", help="Keep running and rebuild the output whenever the script or a file it imports changes", action="store_true")
+    parser.add_argument("--batch", help="A JSON file listing scripts to compile into workbooks (see README), instead of --script/--input/--output")
+    parser.add_argument("-j", "--jobs", help="The number of Bes files to parse at once, and of workbooks to write at once in batch mode (defaults to the number of CPUs)", type=int)
+    parser.add_argument("--profile", help="Report the time spent on each phase, file and compiled name", action="store_true")
+    parser.add_argument("--profile-json", dest="profile_json", help="Write the --profile report to this JSON file")
+    parser.add_argument("--cprofile", help="Write cProfile statistics of the build to this file (for pstats or snakeviz)")
+    parser.add_argument("-d", "--do", help="Do an action instead of compiling a script", choices=["clear-bes-defs", "clear-defs", "print-defs", "print-defs-full", "delete-backups", "list-backups", "restore-backup"])
+
+    # print-defs options
+    parser.add_argument("--best-only", dest="best_only", help="Only print definitions compiled by Best", action="store_true")
+    parser.add_argument("--names", help="Only print definitions whose name matches this glob (e.g. 'lev*')")
+    parser.add_argument("--json", help="Print one JSON object per definition", action="store_true")
     
     args = parser.parse_args()
     main(args)
@@ -1,4 +1,5 @@
 import os
+import hashlib
 import subprocess
 import sys
 import venv
@@ -13,6 +14,8 @@ antlr_jar_url = f"https://www.antlr.org/download/{antlr_jar_name}"
 antlr_dir = os.path.join(cwd, "antlr")
 antlr_jar_path = os.path.join(antlr_dir, antlr_jar_name)
 parser_dir =  os.path.join(cwd, "parser")
+# Hash of the Bes.g4 that the parser was generated from
+grammar_hash_path = os.path.join(parser_dir, "Bes.g4.sha256")
 requirements_path = os.path.join(cwd, "requirements.txt")
 bes_grammar_path = os.path.join(cwd, "Bes.g4")
 best_script = os.path.join(cwd, "best.py")
@@ -37,6 +40,35 @@ def check_java_version():
     except (FileNotFoundError, IndexError) as e:
         return False
 
+def grammar_hash():
+    with open(bes_grammar_path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def parser_is_stale():
+    if not os.path.exists(parser_dir):
+        return False
+    try:
+        with open(grammar_hash_path, "r") as file:
+            return file.read().strip() != grammar_hash()
+    except OSError:
+        return True
+
+def generate_parser():
+    print("Building the Best parser!")
+    os.makedirs(parser_dir, exist_ok=True)
+    subprocess.run(["java", "-jar", antlr_jar_path, "-Dlanguage=Python3", bes_grammar_path, "-o", parser_dir])
+    with open(os.path.join(parser_dir, "__init__.py"), "w") as file:
+        pass
+    with open(grammar_hash_path, "w") as file:
+        file.write(grammar_hash())
+
+def update_parser():
+    print("Bes.g4 has changed since the Best parser was generated.")
+    if check_java_version() and os.path.exists(antlr_jar_path):
+        generate_parser()
+    else:
+        print("Unable to regenerate the parser without Java 11 and the ANTLR jar. Use --parser fast, or delete setup.txt to set Best up again.")
+
 def determine_missing_dependencies():
     missing_deps = []
     if not os.path.exists(parser_dir):
@@ -109,16 +141,26 @@ def prompt_user_for_dependencies(missing_deps):
             subprocess.run([venv_python, "-m", "pip", "install", "-r", requirements_path], check=True)
             
     if DEP_PARSER in still_missing and DEP_JAVA11 not in still_missing and DEP_ANTLR not in still_missing:
-        print("Building the Best parser!")
-        os.makedirs(parser_dir, exist_ok=True)
-        subprocess.run(["java", "-jar", antlr_jar_path, "-Dlanguage=Python3", bes_grammar_path, "-o", parser_dir])
-        with open(os.path.join(parser_dir, "__init__.py"), "w") as file:
-            pass
+        generate_parser()
         still_missing.remove(DEP_PARSER)
     
     return still_missing
 
+def in_venv():
+    return os.path.realpath(sys.prefix) == os.path.realpath(venv_dir)
+
 def run_best():
+    if in_venv():
+        # Already running in the venv's interpreter, so skip starting another one
+        import runpy
+        sys.argv = [best_script, *sys.argv[1:]]
+        sys.path.insert(0, cwd)
+        runpy.run_path(best_script, run_name="__main__")
+        sys.exit(0)
+    if os.name != 'nt':
+        # Replace this process rather than waiting on a child
+        sys.stdout.flush()
+        os.execv(venv_python, [venv_python, best_script, *sys.argv[1:]])
     sys.exit(subprocess.run([venv_python, best_script, *sys.argv[1:]]).returncode)
 
 def setup_best():
@@ -142,6 +184,8 @@ def main():
         should_continue = setup_best()
     else:
         should_continue = True
+        if parser_is_stale():
+            update_parser()
 
     if should_continue:
         run_best()
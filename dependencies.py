@@ -0,0 +1,234 @@
+import re
+import json
+import hashlib
+
+import macros
+
+identifier_pattern = re.compile(r"[a-zA-Z_\\][a-zA-Z0-9_.]*")
+
+def statement_references(stm):
+    """
+    Returns (inlined, referenced) for a lowered statement (see best.py).
+
+    `inlined` holds the names that get pasted into the compiled formula, i.e.
+    back-tick references (including the `macro`s they call and the references
+    in their arguments) and bare identifiers (which are replaced if they name
+    an `expr`). The parameters of a `macro` are left out of its references. `referenced` holds every identifier that appears anywhere in the
+    statement, including ones inside formulas, which Excel resolves by name.
+    Both are over-approximations: local names are not filtered out.
+    """
+    inlined = set()
+    referenced = set()
+    stack = [stm]
+    while stack:
+        node = stack.pop()
+        kind = node[0]
+        if kind in ("let", "expr"):
+            stack.append(node[3])
+        elif kind == "fn":
+            stack.append(node[4])
+        elif kind == "macro":
+            # Its parameters would look like references to the `expr`s they shadow
+            params = {param for param, _, _ in node[3]}
+            macro_inlined, macro_referenced = statement_references(node[4])
+            inlined |= macro_inlined - params
+            referenced |= macro_referenced - params
+        elif kind == "block":
+            stack.extend(node[1])
+            stack.append(node[2])
+        elif kind in ("if", "ifl"):
+            stack.extend(node[1:])
+        elif kind in ("formula", "defined"):
+            backticked, rest = macros.pasted_names(node[1]) if "`" in node[1] else ((), node[1])
+            inlined.update(backticked)
+            referenced.update(backticked)
+            referenced.update(identifier_pattern.findall(rest))
+        elif kind == "id":
+            inlined.add(node[1])
+            referenced.add(node[1])
+    return inlined, referenced
+
+def dependency_graph(stms):
+    """
+    Maps each top-level name to the set of other top-level names that its
+    statement inlines or references. Excel doesn't tell names apart by case,
+    so every name in the graph is upper case.
+    """
+    names = {stm[1].upper() for stm in stms}
+    graph = {}
+    for stm in stms:
+        inlined, referenced = statement_references(stm)
+        name = stm[1].upper()
+        deps = graph.setdefault(name, set())
+        deps.update({dep.upper() for dep in inlined | referenced} & names)
+        deps.discard(name)
+    return graph
+
+def reachable_names(stms, entry_points):
+    """
+    Returns the names of `stms` that the names in `entry_points` inline or
+    reference, directly or through other names, including the entry points.
+    Names are compared ignoring case, like in Excel.
+    """
+    graph = dependency_graph(stms)
+    reachable = set()
+    stack = [name.upper() for name in entry_points]
+    while stack:
+        name = stack.pop()
+        if name in reachable or name not in graph:
+            continue
+        reachable.add(name)
+        stack.extend(graph[name])
+    return {stm[1] for stm in stms if stm[1].upper() in reachable}
+
+def flat_json(obj):
+    """json.dumps(obj, separators=(",", ":")) for nested lists of strings and numbers, without recursing."""
+    close = object()
+    comma = object()
+    parts = []
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if item is close:
+            parts.append("]")
+        elif item is comma:
+            parts.append(",")
+        elif isinstance(item, (list, tuple)):
+            parts.append("[")
+            stack.append(close)
+            for i in reversed(range(len(item))):
+                stack.append(item[i])
+                if i > 0:
+                    stack.append(comma)
+        else:
+            parts.append(json.dumps(item))
+    return "".join(parts)
+
+def fingerprint(obj):
+    try:
+        text = json.dumps(obj, separators=(",", ":"))
+    except RecursionError:
+        # Too deeply nested for json (e.g. a very long else if chain)
+        text = flat_json(obj)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def inlined_exprs(stm, expr_stms_by_name):
+    """
+    Returns the names of the top-level `expr`s that end up pasted into `stm`,
+    following `expr`s that inline other `expr`s.
+    """
+    closure = set()
+    stack = [stm]
+    while stack:
+        inlined, _ = statement_references(stack.pop())
+        for name in inlined:
+            if name in expr_stms_by_name and name not in closure:
+                closure.add(name)
+                stack.extend(expr_stms_by_name[name])
+    return closure
+
+def input_hashes(expr_stms, stms, salt):
+    """
+    Hashes everything that the compiled formula of each statement in `stms`
+    depends on: the statement itself and every `expr` it inlines. Names that
+    are only referenced (e.g. a call to another `fn`) are resolved by Excel, so
+    changing them does not change this statement's formula.
+    """
+    expr_stms_by_name = {}
+    for expr_stm in expr_stms:
+        expr_stms_by_name.setdefault(expr_stm[1], []).append(expr_stm)
+
+    hashes = []
+    for stm in stms:
+        closure = sorted(inlined_exprs(stm, expr_stms_by_name))
+        inputs = [salt, stm, [expr_stms_by_name[name] for name in closure]]
+        hashes.append(fingerprint(inputs))
+    return hashes
+
+class DependencyCycle(ValueError):
+    def __init__(self, path):
+        super().__init__(" -> ".join(path))
+        self.path = path
+
+def local_names(stm):
+    """The names that are bound inside the statement, `stm`, i.e. not its own name."""
+    names = set()
+    for node in macros.walk(stm):
+        if node[0] in ("let", "expr", "fn", "macro") and node is not stm:
+            names.add(node[1])
+        if node[0] == "fn":
+            names.update(param for param, _, _ in node[3])
+    return names
+
+def inline_order(stms):
+    """
+    Orders `stms` so that every statement comes after the statements it
+    inlines, keeping the source order wherever the dependencies allow it.
+    Raises DependencyCycle if the statements inline each other in a loop.
+    """
+    stms_by_name = {}
+    for stm in stms:
+        stms_by_name.setdefault(stm[1], []).append(stm)
+    position = {name: i for i, name in enumerate(stms_by_name)}
+    deps = {}
+    for name, defs in stms_by_name.items():
+        inlined = set()
+        for stm in defs:
+            stm_inlined = statement_references(stm)[0]
+            # e.g. `total` in { let total = "5"; total } isn't the `expr` being defined
+            if name in stm_inlined and name in local_names(stm):
+                stm_inlined.discard(name)
+            inlined |= stm_inlined
+        deps[name] = sorted((dep for dep in inlined if dep in stms_by_name), key=position.get)
+
+    VISITING, DONE = 1, 2
+    state = {}
+    order = []
+    for root in stms_by_name:
+        if root in state:
+            continue
+        state[root] = VISITING
+        path = [root]
+        stack = [iter(deps[root])]
+        while stack:
+            for dep in stack[-1]:
+                if state.get(dep) == VISITING:
+                    raise DependencyCycle(path[path.index(dep):] + [dep])
+                if dep not in state:
+                    state[dep] = VISITING
+                    path.append(dep)
+                    stack.append(iter(deps[dep]))
+                    break
+            else:
+                stack.pop()
+                name = path.pop()
+                state[name] = DONE
+                order.extend(stms_by_name[name])
+    return order
+
+def import_order(root, imports):
+    """
+    Orders the files that `root` imports, directly or indirectly, the way
+    they'd be visited by following each file's `imports` in order, depth
+    first, visiting each file once. Raises DependencyCycle if files import
+    each other in a loop.
+    """
+    VISITING, DONE = 1, 2
+    state = {root: VISITING}
+    order = [root]
+    path = [root]
+    stack = [iter(imports[root])]
+    while stack:
+        for imported in stack[-1]:
+            if state.get(imported) == VISITING:
+                raise DependencyCycle(path[path.index(imported):] + [imported])
+            if imported not in state:
+                state[imported] = VISITING
+                order.append(imported)
+                path.append(imported)
+                stack.append(iter(imports[imported]))
+                break
+        else:
+            stack.pop()
+            state[path.pop()] = DONE
+    return order
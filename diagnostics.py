@@ -0,0 +1,60 @@
+"""
+What a compile reports (errors, warnings and information), kept apart from
+best.py so that the modules it imports can report through it too.
+"""
+import contextvars
+
+RED = "\033[31m"
+YELLOW = "\033[33m"
+RESET = "\033[0m"
+
+class Diagnostic:
+    """An error, a warning or some information reported by a compile, with the line it's about if it's known."""
+    def __init__(self, severity, message, line=None):
+        self.severity = severity
+        self.message = message
+        self.line = line
+
+    def __repr__(self):
+        return f"Diagnostic({self.severity!r}, {self.message!r}, {self.line!r})"
+
+    def to_json(self):
+        return {"severity": self.severity, "message": self.message, "line": self.line}
+
+class Diagnostics:
+    """
+    What a compile reports: the number of errors, the number of `expr`s pasted
+    into formulas (for --profile) and, with `collect`, the diagnostics, which
+    are printed as they're reported otherwise.
+    """
+    def __init__(self, collect=False):
+        self.collect = collect
+        self.items = []
+        self.errors = 0
+        self.expansions = 0
+
+    def report(self, severity, message, line=None):
+        if severity == "error":
+            self.errors += 1
+        if self.collect:
+            self.items.append(Diagnostic(severity, message, line))
+        elif severity == "error":
+            print(f"{RED}ERROR: {message}{RESET}")
+        elif severity == "warning":
+            print(f"{YELLOW}WARNING: {message}{RESET}")
+        else:
+            print(message)
+
+# The diagnostics of the compile running in this thread. The command line runs
+# one compile at a time and prints them, while each compile of a Compiler
+# collects its own
+current_diagnostics = contextvars.ContextVar("diagnostics", default=Diagnostics())
+
+def error(msg, line=None):
+    current_diagnostics.get().report("error", msg, line)
+
+def warning(msg, line=None):
+    current_diagnostics.get().report("warning", msg, line)
+
+def info(msg):
+    current_diagnostics.get().report("info", msg)
@@ -0,0 +1,1056 @@
+"""
+Evaluates compiled formulas in Python, so what Best generates can be checked
+and measured without Excel (see bench/eval_bench.py).
+
+Only the part of Excel that Best's output relies on is implemented: numbers,
+text, logical values, errors and arrays, the operators, LET, LAMBDA (with
+optional parameters and recursion through defined names), the functions in
+FUNCTIONS and cell references to the values in `cells`. Calls to any other
+function evaluate to #NAME?, and the function is recorded in `unsupported`.
+
+IF, IFERROR, IFNA and CHOOSE only evaluate the arguments they return, as in
+Excel. Every other function evaluates all of its arguments first, including
+IFS, which is why the branches of an `ifl` are wrapped in LAMBDAs.
+
+Evaluation doesn't recurse in Python, so recursive LAMBDAs can go as deep as
+`max_depth` (Excel's own limit depends on the formula), after which the call
+evaluates to #NUM!.
+"""
+import math
+import re
+
+MAX_DEPTH = 1024
+
+class FormulaSyntaxError(ValueError):
+    pass
+
+class ExcelError:
+    """An error value, e.g. #N/A. Errors are values in Excel, not exceptions."""
+    def __init__(self, code):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, ExcelError) and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return self.code
+
+DIV0 = ExcelError("#DIV/0!")
+NA = ExcelError("#N/A")
+NAME = ExcelError("#NAME?")
+NUM = ExcelError("#NUM!")
+REF = ExcelError("#REF!")
+VALUE = ExcelError("#VALUE!")
+CALC = ExcelError("#CALC!")
+ERRORS = {error.code: error for error in (DIV0, NA, NAME, NUM, REF, VALUE, CALC, ExcelError("#NULL!"), ExcelError("#SPILL!"))}
+
+class Omitted:
+    """The value of an optional LAMBDA parameter that wasn't passed (see ISOMITTED)."""
+    def __repr__(self):
+        return "<omitted>"
+
+OMITTED = Omitted()
+
+class Array:
+    """A 2D array of values, stored as a list of rows."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    @property
+    def height(self):
+        return len(self.rows)
+
+    @property
+    def width(self):
+        return len(self.rows[0])
+
+    def values(self):
+        for row in self.rows:
+            yield from row
+
+    def __eq__(self, other):
+        return isinstance(other, Array) and other.rows == self.rows
+
+    def __repr__(self):
+        return f"Array({self.rows!r})"
+
+class Lambda:
+    def __init__(self, params, optional, body, env):
+        self.params = params
+        self.optional = optional
+        self.body = body
+        self.env = env
+
+    def __repr__(self):
+        return f"LAMBDA({', '.join(self.params)})"
+
+# Parsing
+
+token_pattern = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<reference>(?:(?:'(?:[^']|'')+'|[a-zA-Z_][a-zA-Z0-9_.]*)!)?\$?[a-zA-Z]{1,3}\$?[0-9]+(?::\$?[a-zA-Z]{1,3}\$?[0-9]+)?(?![a-zA-Z0-9_.\\(]))
+  | (?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)
+  | (?P<error>\#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A|CALC!|SPILL!))
+  | (?P<name>[a-zA-Z_\\][a-zA-Z0-9_.\\]*)
+  | (?P<operator><>|<=|>=|[-+*/^&=<>%(),;{}])
+""", re.VERBOSE)
+
+cell_pattern = re.compile(r"\$?([a-zA-Z]{1,3})\$?([0-9]+)")
+
+# Prefixes that Excel stores names with (see xlfn_functions in best.py and the
+# LAMBDA and LET parameters in stm_to_let), but that aren't part of the name
+FUNCTION_PREFIXES = ("_XLFN._XLWS.", "_XLFN.", "_XLWS.")
+LOCAL_PREFIXES = ("_XLPM.", "_XLOP.")
+
+BINARY_OPERATORS = {
+    "=": 1, "<>": 1, "<": 1, ">": 1, "<=": 1, ">=": 1,
+    "&": 2,
+    "+": 3, "-": 3,
+    "*": 4, "/": 4,
+    "^": 5,
+}
+# Negation binds tighter than ^ in Excel: -2^2 is 4
+NEGATION = 6
+
+def tokenize(formula):
+    tokens = []
+    position = 0
+    while position < len(formula):
+        match = token_pattern.match(formula, position)
+        if match is None:
+            raise FormulaSyntaxError(f"Unexpected character {formula[position]!r} at {position} in {formula!r}")
+        position = match.end()
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group(0)))
+    return tokens
+
+def column_number(letters):
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - ord("A") + 1
+    return number
+
+def reference_node(text):
+    sheet = None
+    if "!" in text:
+        sheet, text = text.rsplit("!", 1)
+        if sheet.startswith("'"):
+            sheet = sheet[1:-1].replace("''", "'")
+        sheet = sheet.upper()
+    corners = []
+    for cell in text.split(":"):
+        letters, row = cell_pattern.fullmatch(cell).groups()
+        corners.append((int(row), column_number(letters)))
+    (top, left), (bottom, right) = corners[0], corners[-1]
+    return ("ref", sheet, min(top, bottom), min(left, right), max(top, bottom), max(left, right))
+
+def name_node(text):
+    key = text.upper()
+    for prefix in LOCAL_PREFIXES:
+        if key.startswith(prefix):
+            # Optional LAMBDA parameters are declared as _xlop.name
+            return ("local", key[len(prefix):], prefix == "_XLOP.")
+    for prefix in FUNCTION_PREFIXES:
+        if key.startswith(prefix):
+            return ("name", key[len(prefix):])
+    return ("name", key)
+
+def literal(kind, text):
+    if kind == "number":
+        return float(text)
+    if kind == "string":
+        return text[1:-1].replace('""', '"')
+    if kind == "error":
+        return ERRORS[text]
+    if kind == "name" and text.upper() in ("TRUE", "FALSE"):
+        return text.upper() == "TRUE"
+    return None
+
+def parse(formula):
+    """
+    Parses a formula (without the leading "=") into a tree of tuples. It's a
+    shunting-yard parser, so it doesn't recurse however deeply the formula nests.
+    """
+    tokens = tokenize(formula)
+    tokens.append(("end", ""))
+    output = []
+    # Operators, and [kind, callee, start of the arguments in output, seen a comma] for each open parenthesis
+    operators = []
+    expect_operand = True
+    index = 0
+
+    def reduce():
+        operator = operators.pop()
+        if operator == "neg":
+            output.append(("neg", output.pop()))
+        else:
+            right = output.pop()
+            output.append(("binary", operator, output.pop(), right))
+
+    def reduce_to_parenthesis():
+        while operators and not isinstance(operators[-1], list):
+            reduce()
+        if not operators:
+            raise FormulaSyntaxError(f"Unbalanced parentheses in {formula!r}")
+        return operators[-1]
+
+    def open_call(callee):
+        nonlocal index
+        index += 1
+        operators.append(["call", callee, len(output), False])
+
+    while True:
+        kind, text = tokens[index]
+        if expect_operand:
+            if kind in ("number", "string", "error"):
+                output.append(("literal", literal(kind, text)))
+                expect_operand = False
+            elif kind == "reference":
+                output.append(reference_node(text))
+                expect_operand = False
+            elif kind == "name":
+                if tokens[index + 1][1] == "(":
+                    open_call(name_node(text))
+                elif literal(kind, text) is not None:
+                    output.append(("literal", literal(kind, text)))
+                    expect_operand = False
+                else:
+                    output.append(name_node(text))
+                    expect_operand = False
+            elif text == "(":
+                operators.append(["group", None, len(output), False])
+            elif text == "-":
+                operators.append("neg")
+            elif text == "+":
+                pass
+            elif text == "{":
+                rows = [[]]
+                index += 1
+                sign = 1
+                while tokens[index][1] != "}":
+                    item_kind, item_text = tokens[index]
+                    if item_text == "-":
+                        sign = -sign
+                    elif item_text == ",":
+                        pass
+                    elif item_text == ";":
+                        rows.append([])
+                    elif literal(item_kind, item_text) is not None:
+                        value = literal(item_kind, item_text)
+                        rows[-1].append(sign * value if item_kind == "number" else value)
+                        sign = 1
+                    else:
+                        raise FormulaSyntaxError(f"Unexpected {item_text!r} in an array constant in {formula!r}")
+                    index += 1
+                if len({len(row) for row in rows}) != 1 or not rows[0]:
+                    raise FormulaSyntaxError(f"Uneven array constant in {formula!r}")
+                output.append(("array", rows))
+                expect_operand = False
+            elif text in (",", ")") and operators and isinstance(operators[-1], list) and operators[-1][0] == "call" \
+                    and (operators[-1][3] or len(output) > operators[-1][2] or text == ","):
+                # An empty argument, e.g. the second one of f(1,,3)
+                output.append(("omitted",))
+                expect_operand = False
+                continue
+            elif text == ")" and operators and isinstance(operators[-1], list) and operators[-1][0] == "call":
+                # No arguments
+                expect_operand = False
+                continue
+            else:
+                raise FormulaSyntaxError(f"Expected a value but found {text or 'the end'!r} in {formula!r}")
+        else:
+            if text in BINARY_OPERATORS:
+                precedence = BINARY_OPERATORS[text]
+                while operators and not isinstance(operators[-1], list) and \
+                        (NEGATION if operators[-1] == "neg" else BINARY_OPERATORS[operators[-1]]) >= precedence:
+                    reduce()
+                operators.append(text)
+                expect_operand = True
+            elif text == "%":
+                output.append(("percent", output.pop()))
+            elif text == ",":
+                parenthesis = reduce_to_parenthesis()
+                if parenthesis[0] != "call":
+                    raise FormulaSyntaxError(f"Unexpected ',' in {formula!r}")
+                parenthesis[3] = True
+                expect_operand = True
+            elif text == ")":
+                parenthesis = reduce_to_parenthesis()
+                operators.pop()
+                if parenthesis[0] == "call":
+                    start = parenthesis[2]
+                    args = output[start:]
+                    del output[start:]
+                    output.append(("call", parenthesis[1], args))
+                # A call of the result, e.g. LAMBDA(x, x)(1)
+                if tokens[index + 1][1] == "(":
+                    open_call(output.pop())
+                    expect_operand = True
+            elif kind == "end":
+                while operators:
+                    if isinstance(operators[-1], list):
+                        raise FormulaSyntaxError(f"Unbalanced parentheses in {formula!r}")
+                    reduce()
+                if len(output) != 1:
+                    raise FormulaSyntaxError(f"Incomplete formula {formula!r}")
+                return output[0]
+            else:
+                raise FormulaSyntaxError(f"Unexpected {text!r} in {formula!r}")
+        index += 1
+
+# Values
+
+number_text_pattern = re.compile(r"\s*[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?\s*")
+
+def scalar(value):
+    # A single cell's worth of an array, as when an array is used where a value is expected
+    return value.rows[0][0] if isinstance(value, Array) else value
+
+def to_number(value):
+    value = scalar(value)
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value is None or value is OMITTED:
+        return 0.0
+    if isinstance(value, str):
+        return float(value) if number_text_pattern.fullmatch(value) else VALUE
+    if isinstance(value, ExcelError):
+        return value
+    return VALUE
+
+def to_bool(value):
+    value = scalar(value)
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if value is None or value is OMITTED:
+        return False
+    if isinstance(value, str):
+        if value.upper() in ("TRUE", "FALSE"):
+            return value.upper() == "TRUE"
+        return VALUE
+    if isinstance(value, ExcelError):
+        return value
+    return VALUE
+
+def format_number(number):
+    if number == int(number) and abs(number) < 1e15:
+        return str(int(number))
+    return format(number, ".15g")
+
+def to_text(value):
+    value = scalar(value)
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return format_number(value)
+    if value is None or value is OMITTED:
+        return ""
+    if isinstance(value, (str, ExcelError)):
+        return value
+    return VALUE
+
+def is_error(value):
+    return isinstance(value, ExcelError)
+
+def first_error(values):
+    for value in values:
+        if isinstance(value, ExcelError):
+            return value
+    return None
+
+def broadcast(function, args):
+    """Applies `function` to each cell of the array arguments, as Excel does to functions that take single values."""
+    arrays = [arg for arg in args if isinstance(arg, Array)]
+    height = max(array.height for array in arrays)
+    width = max(array.width for array in arrays)
+
+    def cell(arg, row, column):
+        if not isinstance(arg, Array):
+            return arg
+        row = 0 if arg.height == 1 else row
+        column = 0 if arg.width == 1 else column
+        if row >= arg.height or column >= arg.width:
+            return NA
+        return arg.rows[row][column]
+
+    return Array([
+        [function(*[cell(arg, row, column) for arg in args]) for column in range(width)]
+        for row in range(height)
+    ])
+
+TYPE_ORDER = {float: 0, int: 0, str: 1, bool: 2}
+
+def compare(operator, a, b):
+    error = first_error((a, b))
+    if error is not None:
+        return error
+    # A blank compares as the empty value of the other's type
+    if a is None or a is OMITTED:
+        a = "" if isinstance(b, str) else False if isinstance(b, bool) else 0.0
+    if b is None or b is OMITTED:
+        b = "" if isinstance(a, str) else False if isinstance(a, bool) else 0.0
+    if isinstance(a, Lambda) or isinstance(b, Lambda):
+        return VALUE
+    key_a = (TYPE_ORDER[type(a)], a.upper() if isinstance(a, str) else a)
+    key_b = (TYPE_ORDER[type(b)], b.upper() if isinstance(b, str) else b)
+    if operator == "=":
+        return key_a == key_b
+    if operator == "<>":
+        return key_a != key_b
+    if operator == "<":
+        return key_a < key_b
+    if operator == ">":
+        return key_a > key_b
+    if operator == "<=":
+        return key_a <= key_b
+    return key_a >= key_b
+
+def binary(operator, a, b):
+    if isinstance(a, Array) or isinstance(b, Array):
+        return broadcast(lambda x, y: binary(operator, x, y), (a, b))
+    if BINARY_OPERATORS[operator] == 1:
+        return compare(operator, a, b)
+    if operator == "&":
+        a, b = to_text(a), to_text(b)
+        return first_error((a, b)) or a + b
+    a, b = to_number(a), to_number(b)
+    error = first_error((a, b))
+    if error is not None:
+        return error
+    if operator == "+":
+        return a + b
+    if operator == "-":
+        return a - b
+    if operator == "*":
+        return a * b
+    if operator == "/":
+        return DIV0 if b == 0 else a / b
+    try:
+        result = a ** b
+    except (OverflowError, ZeroDivisionError):
+        return NUM
+    return NUM if isinstance(result, complex) else result
+
+def negate(value):
+    if isinstance(value, Array):
+        return broadcast(negate, (value,))
+    value = to_number(value)
+    return value if is_error(value) else -value
+
+def percent(value):
+    if isinstance(value, Array):
+        return broadcast(percent, (value,))
+    value = to_number(value)
+    return value if is_error(value) else value / 100
+
+def to_array(value):
+    return value if isinstance(value, Array) else Array([[value]])
+
+def from_python(value):
+    """`value` as an Excel value: ints become numbers and lists of rows become Arrays."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, list):
+        return Array([[from_python(cell) for cell in row] for row in value])
+    return value
+
+def to_int(value):
+    value = to_number(value)
+    return value if is_error(value) else int(value)
+
+# Functions
+
+def numbers(args):
+    """The numbers that aggregates like SUM use: all numbers in arrays, and arguments that convert to one."""
+    result = []
+    for arg in args:
+        if isinstance(arg, Array):
+            for value in arg.values():
+                if isinstance(value, ExcelError):
+                    return value
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    result.append(float(value))
+        elif arg is not OMITTED:
+            value = to_number(arg)
+            if is_error(value):
+                return value
+            result.append(value)
+    return result
+
+def aggregate(function, empty=0.0):
+    def apply(*args):
+        values = numbers(args)
+        if is_error(values):
+            return values
+        return function(values) if values else empty
+    return apply
+
+def count(*args):
+    values = numbers(args)
+    return 0.0 if is_error(values) else float(len(values))
+
+def excel_not(value):
+    value = to_bool(value)
+    return value if is_error(value) else not value
+
+def excel_round(number, digits):
+    number, digits = to_number(number), to_int(digits)
+    error = first_error((number, digits))
+    if error is not None:
+        return error
+    scale = 10.0 ** digits
+    return math.copysign(math.floor(abs(number) * scale + 0.5) / scale, number)
+
+def mod(number, divisor):
+    if divisor == 0:
+        return DIV0
+    return number - divisor * math.floor(number / divisor)
+
+def numeric(function):
+    """Wraps a function of numbers so its arguments are converted first."""
+    def apply(*args):
+        args = [to_number(arg) for arg in args]
+        return first_error(args) or function(*args)
+    return apply
+
+def textual(function):
+    """Wraps a function of text and numbers: the first argument is converted to text, the rest to numbers."""
+    def apply(text, *args):
+        text = to_text(text)
+        args = [to_number(arg) for arg in args]
+        return first_error([text, *args]) or function(text, *args)
+    return apply
+
+def mid(text, start, count):
+    if start < 1 or count < 0:
+        return VALUE
+    start = int(start)
+    return text[start - 1:start - 1 + int(count)]
+
+def left(text, count=1.0):
+    return VALUE if count < 0 else text[:int(count)]
+
+def right(text, count=1.0):
+    if count < 0:
+        return VALUE
+    return text[len(text) - int(count):] if count >= 1 else ""
+
+def index(array, row, column=OMITTED):
+    array = to_array(array)
+    if column is OMITTED and array.height == 1:
+        row, column = 1, row
+    row = to_int(row)
+    column = 1 if column is OMITTED else to_int(column)
+    error = first_error((row, column))
+    if error is not None:
+        return error
+    if row < 0 or column < 0 or row > array.height or column > array.width:
+        return REF
+    if row == 0 and column == 0:
+        return array
+    if row == 0:
+        return Array([[r[column - 1]] for r in array.rows])
+    if column == 0:
+        return Array([list(array.rows[row - 1])])
+    return array.rows[row - 1][column - 1]
+
+def sequence(rows, columns=1.0, start=1.0, step=1.0):
+    rows, columns = int(rows), int(columns)
+    if rows < 1 or columns < 1:
+        return CALC
+    return Array([[start + step * (row * columns + column) for column in range(columns)] for row in range(rows)])
+
+def hstack(*args):
+    arrays = [to_array(arg) for arg in args]
+    height = max(array.height for array in arrays)
+    return Array([[value for array in arrays for value in (array.rows[row] if row < array.height else [NA] * array.width)]
+                  for row in range(height)])
+
+def vstack(*args):
+    arrays = [to_array(arg) for arg in args]
+    width = max(array.width for array in arrays)
+    return Array([row + [NA] * (width - len(row)) for array in arrays for row in array.rows])
+
+def ifs(*args):
+    if len(args) % 2:
+        return VALUE
+    for i in range(0, len(args), 2):
+        condition = to_bool(args[i])
+        if is_error(condition):
+            return condition
+        if condition:
+            return args[i + 1]
+    return NA
+
+def switch(value, *args):
+    default = args[-1] if len(args) % 2 else NA
+    for i in range(0, len(args) - 1, 2):
+        if compare("=", value, args[i]) is True:
+            return args[i + 1]
+    return default
+
+def logical(function):
+    def apply(*args):
+        values = []
+        for arg in args:
+            for value in (arg.values() if isinstance(arg, Array) else (arg,)):
+                if isinstance(value, str) and isinstance(arg, Array):
+                    continue
+                value = to_bool(value)
+                if is_error(value):
+                    return value
+                values.append(value)
+        return function(values) if values else VALUE
+    return apply
+
+def concat(*args):
+    parts = []
+    for arg in args:
+        for value in (arg.values() if isinstance(arg, Array) else (arg,)):
+            value = to_text(value)
+            if is_error(value):
+                return value
+            parts.append(value)
+    return "".join(parts)
+
+# Name: (function, minimum arguments, maximum arguments or None, whether it
+# applies to each cell of array arguments). Arguments that are errors are
+# returned before the function is called, unless it's in ERROR_FUNCTIONS.
+FUNCTIONS = {
+    "SUM": (aggregate(sum), 1, None, False),
+    "PRODUCT": (aggregate(math.prod), 1, None, False),
+    "MIN": (aggregate(min), 1, None, False),
+    "MAX": (aggregate(max), 1, None, False),
+    "AVERAGE": (aggregate(lambda values: sum(values) / len(values), DIV0), 1, None, False),
+    "COUNT": (count, 1, None, False),
+    "ABS": (numeric(abs), 1, 1, True),
+    "INT": (numeric(lambda number: float(math.floor(number))), 1, 1, True),
+    "MOD": (numeric(mod), 2, 2, True),
+    "ROUND": (excel_round, 2, 2, True),
+    "SQRT": (numeric(lambda number: NUM if number < 0 else math.sqrt(number)), 1, 1, True),
+    "POWER": (lambda a, b: binary("^", a, b), 2, 2, True),
+    "EXP": (numeric(lambda number: math.exp(number)), 1, 1, True),
+    "LN": (numeric(lambda number: NUM if number <= 0 else math.log(number)), 1, 1, True),
+    "SIGN": (numeric(lambda number: float((number > 0) - (number < 0))), 1, 1, True),
+    "QUOTIENT": (numeric(lambda a, b: DIV0 if b == 0 else float(math.trunc(a / b))), 2, 2, True),
+    "PI": (lambda: math.pi, 0, 0, False),
+    "N": (lambda value: value if isinstance(value, float) else 1.0 if value is True else 0.0, 1, 1, True),
+    "NOT": (excel_not, 1, 1, True),
+    "AND": (logical(all), 1, None, False),
+    "OR": (logical(any), 1, None, False),
+    "TRUE": (lambda: True, 0, 0, False),
+    "FALSE": (lambda: False, 0, 0, False),
+    "NA": (lambda: NA, 0, 0, False),
+    "IFS": (ifs, 2, None, False),
+    "SWITCH": (switch, 3, None, False),
+    "ISOMITTED": (lambda value: value is OMITTED, 1, 1, False),
+    "ISERROR": (lambda value: is_error(value), 1, 1, True),
+    "ISNA": (lambda value: value == NA, 1, 1, True),
+    "ISNUMBER": (lambda value: isinstance(value, float), 1, 1, True),
+    "ISTEXT": (lambda value: isinstance(value, str), 1, 1, True),
+    "ISLOGICAL": (lambda value: isinstance(value, bool), 1, 1, True),
+    "ISBLANK": (lambda value: value is None, 1, 1, True),
+    "LEN": (textual(lambda text: float(len(text))), 1, 1, True),
+    "MID": (textual(mid), 3, 3, True),
+    "LEFT": (textual(left), 1, 2, True),
+    "RIGHT": (textual(right), 1, 2, True),
+    "UPPER": (textual(str.upper), 1, 1, True),
+    "LOWER": (textual(str.lower), 1, 1, True),
+    "REPT": (textual(lambda text, count: VALUE if count < 0 else text * int(count)), 2, 2, True),
+    "VALUE": (lambda value: to_number(value) if not isinstance(value, bool) else VALUE, 1, 1, True),
+    "CONCAT": (concat, 1, None, False),
+    "CONCATENATE": (concat, 1, None, True),
+    "INDEX": (index, 2, 3, False),
+    "ROWS": (lambda array: float(to_array(array).height), 1, 1, False),
+    "COLUMNS": (lambda array: float(to_array(array).width), 1, 1, False),
+    "SEQUENCE": (numeric(sequence), 1, 4, False),
+    "HSTACK": (hstack, 1, None, False),
+    "VSTACK": (vstack, 1, None, False),
+}
+ERROR_FUNCTIONS = {"ISERROR", "ISNA", "ISNUMBER", "ISTEXT", "ISLOGICAL", "ISBLANK", "ISOMITTED", "IFS", "SWITCH", "INDEX",
+                   "HSTACK", "VSTACK"}
+
+class Evaluator:
+    """
+    Evaluates formulas that use the defined names in `names` (e.g. the dict
+    that best.compile_file returns) and the cell values in `cells`, which maps
+    references like "Sheet1!A1" (or "A1" for references without a sheet) to
+    numbers, text or booleans.
+
+    Counts, since it was created or reset_stats was last called:
+    * steps: the number of parts of formulas evaluated
+    * calls: the number of LAMBDA calls
+    * max_depth: the deepest that LAMBDA calls were nested
+    * arrays, array_cells: the number of arrays created, and their total size
+    """
+    def __init__(self, names, cells=None, max_depth=MAX_DEPTH):
+        # Excel names are case-insensitive
+        self.names = {name.upper(): formula for name, formula in names.items()}
+        self.cells = {reference.upper().replace("$", ""): from_python(value) for reference, value in (cells or {}).items()}
+        self.max_depth = max_depth
+        self.parsed = {}
+        self.unsupported = set()
+        # Names being evaluated, to catch names defined in terms of themselves
+        self.evaluating = set()
+        self.depth = 0
+        self.reset_stats()
+        # Parts of formulas that need other values first
+        self.generators = {
+            "name": self.eval_name,
+            "call": self.eval_call,
+            "binary": self.eval_binary,
+            "neg": self.eval_unary,
+            "percent": self.eval_unary,
+        }
+        # Functions that don't evaluate all of their arguments first
+        self.special_forms = {
+            "LET": self.special_let,
+            "IF": self.special_if,
+            "IFERROR": self.special_iferror,
+            "IFNA": self.special_ifna,
+            "CHOOSE": self.special_choose,
+        }
+        # Functions that call LAMBDAs
+        self.higher_order_functions = {
+            "MAKEARRAY": self.function_makearray,
+            "MAP": self.function_map,
+            "REDUCE": self.function_reduce,
+            "SCAN": self.function_scan,
+            "BYROW": self.function_byrow,
+            "BYCOL": self.function_bycol,
+        }
+
+    def reset_stats(self):
+        self.steps = 0
+        self.calls = 0
+        self.max_depth_reached = 0
+        self.arrays = 0
+        self.array_cells = 0
+
+    def stats(self):
+        return {
+            "steps": self.steps,
+            "calls": self.calls,
+            "max_depth": self.max_depth_reached,
+            "arrays": self.arrays,
+            "array_cells": self.array_cells,
+        }
+
+    def parse_name(self, key):
+        if key not in self.parsed:
+            self.parsed[key] = parse(self.names[key])
+        return self.parsed[key]
+
+    def evaluate(self, formula):
+        """Evaluates `formula`, e.g. 'lev("kitten", "sitting")'. A leading "=" is optional."""
+        if formula.startswith("="):
+            formula = formula[1:]
+        return self.run(parse(formula), {})
+
+    def call(self, name, *args):
+        """Calls the LAMBDA defined as `name` with `args` (numbers, text, booleans or Arrays)."""
+        return self.run(("call", ("name", name.upper()), [("literal", from_python(arg)) for arg in args]), {})
+
+    def run(self, node, env):
+        """
+        Evaluates `node`. Each part of a formula is evaluated by a generator that
+        yields ("eval", node, env) or ("call", function, args) for each value it
+        needs and is sent the value back, so they run on this loop's stack rather
+        than Python's.
+        """
+        stack = []
+        value = None
+        request = ("eval", node, env)
+        while True:
+            if request is None:
+                pass
+            elif request[0] == "eval":
+                _, node, env = request
+                self.steps += 1
+                kind = node[0]
+                if kind == "literal":
+                    value = node[1]
+                elif kind == "local":
+                    value = env.get(node[1], NAME)
+                elif kind == "omitted":
+                    value = OMITTED
+                elif kind == "ref":
+                    value = self.eval_ref(node)
+                elif kind == "array":
+                    value = self.allocated(Array([list(row) for row in node[1]]))
+                else:
+                    stack.append(self.generators[kind](node, env))
+                    value = None
+            else:
+                _, function, args = request
+                stack.append(self.apply(function, args))
+                value = None
+            if not stack:
+                return value
+            try:
+                request = stack[-1].send(value)
+            except StopIteration as stop:
+                stack.pop()
+                value = stop.value
+                request = None
+
+    def allocated(self, result, *inputs):
+        if isinstance(result, Array) and not any(result is arg for arg in inputs):
+            self.arrays += 1
+            self.array_cells += result.height * result.width
+        return result
+
+    def apply(self, function, args):
+        if not isinstance(function, Lambda):
+            return function if is_error(function) else VALUE
+        if len(args) > len(function.params):
+            return VALUE
+        env = dict(function.env)
+        for i, param in enumerate(function.params):
+            if i < len(args):
+                env[param] = args[i]
+            elif param in function.optional:
+                env[param] = OMITTED
+            else:
+                return VALUE
+        if self.depth >= self.max_depth:
+            return NUM
+        self.calls += 1
+        self.depth += 1
+        self.max_depth_reached = max(self.max_depth_reached, self.depth)
+        try:
+            return (yield ("eval", function.body, env))
+        finally:
+            self.depth -= 1
+
+    def eval_name(self, node, env):
+        key = node[1]
+        if key in env:
+            return env[key]
+        if key not in self.names:
+            return NAME
+        if key in self.evaluating:
+            return REF
+        self.evaluating.add(key)
+        try:
+            return (yield ("eval", self.parse_name(key), {}))
+        finally:
+            self.evaluating.discard(key)
+
+    def eval_binary(self, node, env):
+        _, operator, left, right = node
+        a = yield ("eval", left, env)
+        b = yield ("eval", right, env)
+        return self.allocated(binary(operator, a, b), a, b)
+
+    def eval_unary(self, node, env):
+        value = yield ("eval", node[1], env)
+        return self.allocated(negate(value) if node[0] == "neg" else percent(value), value)
+
+    def eval_ref(self, node):
+        _, sheet, top, left, bottom, right = node
+        prefix = f"{sheet}!" if sheet else ""
+
+        def cell(row, column):
+            letters = ""
+            while column:
+                column, remainder = divmod(column - 1, 26)
+                letters = chr(ord("A") + remainder) + letters
+            return self.cells.get(f"{prefix}{letters}{row}")
+
+        if top == bottom and left == right:
+            return cell(top, left)
+        return self.allocated(Array([[cell(row, column) for column in range(left, right + 1)] for row in range(top, bottom + 1)]))
+
+    def eval_call(self, node, env):
+        _, callee, arg_nodes = node
+        if callee[0] == "name" and callee[1] not in env:
+            key = callee[1]
+            if key == "LAMBDA":
+                return self.make_lambda(arg_nodes, env)
+            if key in self.special_forms:
+                return (yield from self.special_forms[key](arg_nodes, env))
+            if key not in self.names:
+                args = []
+                for arg_node in arg_nodes:
+                    args.append((yield ("eval", arg_node, env)))
+                if key in self.higher_order_functions:
+                    return self.allocated((yield from self.call_higher_order(key, args)), *args)
+                return self.allocated(self.call_function(key, args), *args)
+        function = yield ("eval", callee, env)
+        args = []
+        for arg_node in arg_nodes:
+            args.append((yield ("eval", arg_node, env)))
+        return (yield ("call", function, args))
+
+    def call_function(self, key, args):
+        if key not in FUNCTIONS:
+            self.unsupported.add(key)
+            return NAME
+        function, minimum, maximum, lifted = FUNCTIONS[key]
+        if len(args) < minimum or (maximum is not None and len(args) > maximum):
+            return VALUE
+        if lifted and any(isinstance(arg, Array) for arg in args):
+            return broadcast(lambda *cells: self.call_function(key, cells), args)
+        if key not in ERROR_FUNCTIONS:
+            error = first_error(args)
+            if error is not None:
+                return error
+        return function(*args)
+
+    def call_higher_order(self, key, args):
+        function = self.higher_order_functions[key]
+        # The LAMBDA is always the last argument
+        if not args or not isinstance(args[-1], Lambda):
+            return VALUE
+        error = first_error(args)
+        if error is not None:
+            return error
+        try:
+            generator = function(*args)
+        except TypeError:
+            # The wrong number of arguments
+            return VALUE
+        return (yield from generator)
+
+    def make_lambda(self, arg_nodes, env):
+        if not arg_nodes:
+            return VALUE
+        params = []
+        optional = set()
+        for param in arg_nodes[:-1]:
+            if param[0] not in ("local", "name"):
+                return VALUE
+            params.append(param[1])
+            if param[0] == "local" and param[2]:
+                optional.add(param[1])
+        return Lambda(params, optional, arg_nodes[-1], env)
+
+    def special_let(self, arg_nodes, env):
+        if len(arg_nodes) < 3 or len(arg_nodes) % 2 == 0:
+            return VALUE
+        env = dict(env)
+        for i in range(0, len(arg_nodes) - 1, 2):
+            if arg_nodes[i][0] not in ("local", "name"):
+                return VALUE
+            env[arg_nodes[i][1]] = yield ("eval", arg_nodes[i + 1], env)
+        return (yield ("eval", arg_nodes[-1], env))
+
+    def special_if(self, arg_nodes, env):
+        if not 2 <= len(arg_nodes) <= 3:
+            return VALUE
+        condition = yield ("eval", arg_nodes[0], env)
+        if isinstance(condition, Array):
+            # Both branches are needed for an array of conditions
+            value_if_true = yield ("eval", arg_nodes[1], env)
+            value_if_false = (yield ("eval", arg_nodes[2], env)) if len(arg_nodes) == 3 else False
+            return self.allocated(broadcast(
+                lambda c, t, f: to_bool(c) if is_error(to_bool(c)) else t if to_bool(c) else f,
+                (condition, value_if_true, value_if_false)))
+        condition = to_bool(condition)
+        if is_error(condition):
+            return condition
+        if condition:
+            return (yield ("eval", arg_nodes[1], env))
+        return (yield ("eval", arg_nodes[2], env)) if len(arg_nodes) == 3 else False
+
+    def special_iferror(self, arg_nodes, env, errors=None):
+        if len(arg_nodes) != 2:
+            return VALUE
+        value = yield ("eval", arg_nodes[0], env)
+        if is_error(value) and (errors is None or value in errors):
+            return (yield ("eval", arg_nodes[1], env))
+        return value
+
+    def special_ifna(self, arg_nodes, env):
+        return (yield from self.special_iferror(arg_nodes, env, {NA}))
+
+    def special_choose(self, arg_nodes, env):
+        if len(arg_nodes) < 2:
+            return VALUE
+        choice = to_int((yield ("eval", arg_nodes[0], env)))
+        if is_error(choice):
+            return choice
+        if not 1 <= choice < len(arg_nodes):
+            return VALUE
+        return (yield ("eval", arg_nodes[choice], env))
+
+    # Functions that call LAMBDAs
+
+    def function_makearray(self, rows, columns, function):
+        rows, columns = to_int(rows), to_int(columns)
+        error = first_error((rows, columns))
+        if error is not None:
+            return error
+        if rows < 1 or columns < 1:
+            return CALC
+        result = []
+        for row in range(1, rows + 1):
+            values = []
+            for column in range(1, columns + 1):
+                values.append(scalar((yield ("call", function, [float(row), float(column)]))))
+            result.append(values)
+        return Array(result)
+
+    def function_map(self, *args):
+        if len(args) < 2:
+            return VALUE
+        *arrays, function = args
+        arrays = [to_array(array) for array in arrays]
+        result = []
+        for row in range(arrays[0].height):
+            values = []
+            for column in range(arrays[0].width):
+                cells = [array.rows[row][column] if row < array.height and column < array.width else NA for array in arrays]
+                values.append(scalar((yield ("call", function, cells))))
+            result.append(values)
+        return Array(result)
+
+    def function_reduce(self, initial, array, function):
+        accumulator = initial
+        for value in to_array(array).values():
+            accumulator = yield ("call", function, [accumulator, value])
+        return accumulator
+
+    def function_scan(self, initial, array, function):
+        array = to_array(array)
+        accumulator = initial
+        result = []
+        for row in array.rows:
+            values = []
+            for value in row:
+                accumulator = yield ("call", function, [accumulator, value])
+                values.append(scalar(accumulator))
+            result.append(values)
+        return Array(result)
+
+    def function_byrow(self, array, function):
+        result = []
+        for row in to_array(array).rows:
+            result.append([scalar((yield ("call", function, [Array([row])])))])
+        return Array(result)
+
+    def function_bycol(self, array, function):
+        array = to_array(array)
+        result = []
+        for column in range(array.width):
+            result.append(scalar((yield ("call", function, [Array([[row[column]] for row in array.rows])]))))
+        return Array([result])
+
+def to_python(value):
+    """`value` as plain Python data: Arrays become lists of rows and errors their codes, e.g. "#N/A"."""
+    if isinstance(value, Array):
+        return [[to_python(cell) for cell in row] for row in value.rows]
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return int(value)
+    if isinstance(value, (ExcelError, Lambda, Omitted)):
+        return repr(value)
+    return value
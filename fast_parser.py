@@ -0,0 +1,197 @@
+"""
+Hand-written lexer and recursive-descent parser for Bes (see Bes.g4). It
+produces the same lowered module as lowering the ANTLR parse tree does in
+best.py, without the ANTLR runtime or a generated parser.
+"""
+import re
+
+class BesSyntaxError(ValueError):
+    def __init__(self, message, line, column):
+        super().__init__(f"line {line}:{column} {message}")
+        self.line = line
+        self.column = column
+
+# Alternatives are in the order ANTLR resolves them: s"..." is a STRING_LITERAL
+# rather than the IDENTIFIER, s, and keywords are only keywords as whole words.
+token_pattern = re.compile(r"""
+    (?P<skip>[ \t\r\n]+|\#[^\r\n]*)
+  | (?P<FORMULA_LITERAL>"(?:\\["`]|[^"\\])*")
+  | (?P<STRING_LITERAL>s"(?:\\["`]|[^"\\])*")
+  | (?P<DEFINED_EXPRESSION>`[a-zA-Z_\\][a-zA-Z0-9_.]*`)
+  | (?P<IDENTIFIER>[a-zA-Z_\\][a-zA-Z0-9_.]*)
+  | (?P<punctuation>[;\[\],(){}=])
+  | (?P<error>.)
+""", re.VERBOSE | re.DOTALL)
+
+KEYWORDS = {"import", "IMPORT", "export", "let", "expr", "macro", "fn", "if", "ifl", "else"}
+
+EOF = "<EOF>"
+
+def tokenize(contents):
+    """
+    Returns a list of (kind, text, offset) where kind is the token type, the
+    keyword or the punctuation character. The list ends with an EOF token.
+    """
+    tokens = []
+    for match in token_pattern.finditer(contents):
+        kind = match.lastgroup
+        if kind == "skip":
+            continue
+        text = match.group(kind)
+        if kind == "IDENTIFIER":
+            if text in KEYWORDS:
+                kind = text
+        elif kind == "punctuation":
+            kind = text
+        tokens.append((kind, text, match.start()))
+    tokens.append((EOF, EOF, len(contents)))
+    return tokens
+
+class Parser:
+    def __init__(self, contents):
+        self.contents = contents
+        self.tokens = tokenize(contents)
+        self.index = 0
+        # Tokens are mostly asked for their line in order, so count newlines incrementally
+        self.line_offset = 0
+        self.line = 1
+
+    def line_of(self, offset):
+        if offset < self.line_offset:
+            self.line_offset = 0
+            self.line = 1
+        self.line += self.contents.count("\n", self.line_offset, offset)
+        self.line_offset = offset
+        return self.line
+
+    def syntax_error(self, token, expected):
+        kind, text, offset = token
+        line = self.line_of(offset)
+        column = offset - (self.contents.rfind("\n", 0, offset) + 1)
+        if kind == "error":
+            raise BesSyntaxError(f"token recognition error at: '{text}'", line, column)
+        raise BesSyntaxError(f"mismatched input '{text}' expecting {expected}", line, column)
+
+    def peek(self):
+        return self.tokens[self.index][0]
+
+    def expect(self, kind):
+        token = self.tokens[self.index]
+        if token[0] != kind:
+            self.syntax_error(token, kind)
+        self.index += 1
+        return token
+
+    def identifier(self):
+        _, text, offset = self.expect("IDENTIFIER")
+        return text, self.line_of(offset)
+
+    def parse_file(self):
+        module = {"imports": [], "exports": [], "expr": [], "macro": [], "let": [], "fn": []}
+        while self.peek() != EOF:
+            if self.peek() == "import":
+                self.index += 1
+                module["imports"].append(self.expect("IDENTIFIER")[1])
+                self.expect(";")
+            elif self.peek() == "export":
+                self.index += 1
+                module["exports"].append(self.expect("IDENTIFIER")[1])
+                while self.peek() == ",":
+                    self.index += 1
+                    module["exports"].append(self.expect("IDENTIFIER")[1])
+                self.expect(";")
+            else:
+                stm = self.statement()
+                module[stm[0]].append(stm)
+        return module
+
+    def statement(self):
+        kind = self.peek()
+        if kind in ("let", "expr"):
+            self.index += 1
+            name, line = self.identifier()
+            self.expect("=")
+            expr = self.expression()
+            self.expect(";")
+            return (kind, name, line, expr)
+        elif kind in ("macro", "fn"):
+            self.index += 1
+            name, line = self.identifier()
+            self.expect("(")
+            params = []
+            if self.peek() != ")":
+                params.append(self.param())
+                while self.peek() == ",":
+                    self.index += 1
+                    params.append(self.param())
+            self.expect(")")
+            return (kind, name, line, params, self.block())
+        self.syntax_error(self.tokens[self.index], "{'let', 'expr', 'macro', 'fn'}")
+
+    def param(self):
+        if self.peek() == "[":
+            self.index += 1
+            name, line = self.identifier()
+            self.expect("]")
+            return (name, line, True)
+        name, line = self.identifier()
+        return (name, line, False)
+
+    def block(self):
+        self.expect("{")
+        statements = []
+        while self.peek() in ("let", "expr", "macro", "fn"):
+            statements.append(self.statement())
+        expr = self.expression()
+        self.expect("}")
+        return ("block", statements, expr)
+
+    def if_expr(self):
+        # else if chains are collected in a loop and nested afterwards
+        branches = []
+        kind = self.peek()
+        while True:
+            self.index += 1
+            condition = self.expression()
+            value_if_true = self.block()
+            self.expect("else")
+            branches.append((kind, condition, value_if_true))
+            if self.peek() != "if":
+                break
+            kind = "if"
+        expr = self.block()
+        for kind, condition, value_if_true in reversed(branches):
+            expr = (kind, condition, value_if_true, expr)
+        return expr
+
+    def expression(self):
+        kind, text, _ = self.tokens[self.index]
+        if kind == "{":
+            return self.block()
+        elif kind in ("if", "ifl"):
+            return self.if_expr()
+        elif kind == "FORMULA_LITERAL":
+            self.index += 1
+            return ("formula", bytes(text[1:-1], 'utf-8').decode('unicode_escape'))
+        elif kind == "STRING_LITERAL":
+            self.index += 1
+            return ("string", text[1:])
+        elif kind == "DEFINED_EXPRESSION":
+            self.index += 1
+            return ("defined", text)
+        elif kind == "IDENTIFIER":
+            self.index += 1
+            return ("id", text)
+        elif kind == "(":
+            self.index += 1
+            expr = self.expression()
+            self.expect(")")
+            return expr
+        self.syntax_error(self.tokens[self.index], "an expression")
+
+def parse(contents):
+    """
+    Parses the contents of a Bes file into a lowered module. Raises
+    BesSyntaxError on the first syntax error.
+    """
+    return Parser(contents).parse_file()
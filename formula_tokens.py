@@ -0,0 +1,85 @@
+import re
+
+# One scan over an Excel formula. Only the tokens that can contain something that
+# looks like a name are matched; everything else is skipped by the regex engine.
+token_pattern = re.compile(r"""
+    (?P<string>"(?:[^"]|"")*"?)                         # "text", with "" as an escaped quote
+  | (?P<sheet>'(?:[^']|'')*'?)                          # 'My Sheet'!A1
+  | (?P<structured>\[(?:[^\[\]]|\[[^\[\]]*\])*\]?)      # Table1[Column], Table1[[#This Row],[Column]]
+  | (?P<number>[0-9][a-zA-Z0-9_.]*)                     # 1, 1.5, 1E5
+  | (?P<identifier>[a-zA-Z_\\][a-zA-Z0-9_.]*)
+""", re.VERBOSE)
+
+def is_sheet_reference(formula, start, end):
+    """
+    Whether the identifier at formula[start:end] is a sheet name (Sheet1!A1) or
+    a reference into a sheet (Sheet1!name) rather than a name in its own right.
+    """
+    return formula[end:end+1] == "!" or formula[start-1:start] == "!"
+
+def prefix_names(formula, names, prefix="_xlpm."):
+    """
+    Prefixes every reference to one of `names` in `formula` with `prefix` in a
+    single linear pass. Text inside string literals, quoted sheet names and
+    structured references is left alone, as are names that are already
+    qualified (e.g. `_xlpm.a` is not a reference to `a`).
+    """
+    if not names:
+        return formula
+
+    def replace(match):
+        identifier = match.group("identifier")
+        if identifier is None or identifier not in names:
+            return match.group(0)
+        if is_sheet_reference(formula, match.start(), match.end()):
+            return identifier
+        return f"{prefix}{identifier}"
+
+    return token_pattern.sub(replace, formula)
+
+parenthesis_pattern = re.compile(r"""
+    "(?:[^"]|"")*"?
+  | '(?:[^']|'')*'?
+  | [()]
+""", re.VERBOSE)
+
+def nesting_depth(formula):
+    """The deepest nesting of parentheses in `formula`, outside of string literals and sheet names."""
+    depth = 0
+    deepest = 0
+    for match in parenthesis_pattern.finditer(formula):
+        token = match.group(0)
+        if token == "(":
+            depth += 1
+            deepest = max(deepest, depth)
+        elif token == ")":
+            depth -= 1
+    return deepest
+
+call_pattern = re.compile(r"\s*\(")
+
+def function_calls(formula):
+    """
+    Yields (start, end) of every identifier in `formula` that is called as a
+    function, e.g. `SEQUENCE` in `SEQUENCE(3)`.
+    """
+    for match in token_pattern.finditer(formula):
+        if match.group("identifier") is not None and call_pattern.match(formula, match.end()):
+            yield match.start(), match.end()
+
+def prefix_function_calls(formula, functions, prefix="_xlfn."):
+    """
+    Prefixes every call to one of `functions` (upper case names) in `formula`
+    with `prefix` in a single linear pass.
+    """
+    parts = []
+    last = 0
+    for start, end in function_calls(formula):
+        if formula[start:end].upper() in functions:
+            parts.append(formula[last:start])
+            parts.append(prefix)
+            last = start
+    if not parts:
+        return formula
+    parts.append(formula[last:])
+    return "".join(parts)
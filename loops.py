@@ -0,0 +1,179 @@
+"""
+Turns self tail calls of `fn`s into loops (see --loops in best.py).
+
+A `fn` that returns a call to itself, e.g.
+
+    fn count_down(n, total) { if "n <= 0" { total } else { "count_down(n - 1, total + n)" } }
+
+compiles to a LAMBDA that calls itself, which Excel evaluates slowly and
+stops evaluating beyond its recursion limit. Instead, the parameters are kept
+in a row, the state, and a REDUCE over SEQUENCE(limit) runs the body once per
+step: a tail call returns the state of the next step, HSTACK(FALSE, 0, new
+parameters...), and any other result ends the loop with HSTACK(TRUE, result).
+
+Because the state is a row of cells, this only works if the parameters and
+results are single values, not arrays, which Best can't check before the
+formula runs. An array makes the state the wrong shape, and the loop ends with
+#VALUE!. A loop also always runs `limit` steps (the ones after it ends do
+nothing), and its result is #N/A if it hasn't ended by then.
+"""
+import re
+
+from optimizer import lambda_params_pattern
+
+DEFAULT_LIMIT = 1000
+
+# Functions the loops are made of
+LOOP_FUNCTIONS = {"HSTACK", "REDUCE", "SEQUENCE", "LAMBDA", "LET"}
+
+RESULT_NAME = "tail_call_result"
+
+argument_pattern = re.compile(r"""
+    "(?:[^"]|"")*"?
+  | '(?:[^']|'')*'?
+  | [(){},]
+""", re.VERBOSE)
+
+def call_arguments(formula, name):
+    """
+    If the whole of `formula` is a call to `name`, returns the text of each of
+    its arguments. Otherwise returns None.
+    """
+    match = re.match(rf"\s*{re.escape(name)}\s*\(", formula, re.IGNORECASE)
+    if match is None:
+        return None
+    args = []
+    depth = 1
+    start = match.end()
+    for token in argument_pattern.finditer(formula, match.end()):
+        text = token.group(0)
+        if text == "(" or text == "{":
+            depth += 1
+        elif text == ")" or text == "}":
+            depth -= 1
+            if depth == 0:
+                if formula[token.end():].strip():
+                    # Something else is done with the result, e.g. f(x) + 1
+                    return None
+                args.append(formula[start:token.start()])
+                return [] if len(args) == 1 and not args[0].strip() else args
+        elif text == "," and depth == 1:
+            args.append(formula[start:token.start()])
+            start = token.end()
+    return None
+
+def rewrite_tail_positions(expr, rewrite):
+    """
+    Returns `expr` with each expression in a tail position (the value of a
+    block or a branch of an if) replaced by rewrite(expression).
+    """
+    # Walk down to the tail positions, then rebuild the blocks and ifs above them
+    results = []
+    work = [("visit", expr)]
+    while work:
+        action, node = work.pop()
+        if action == "visit":
+            kind = node[0]
+            if kind == "block":
+                work.append(("block", node))
+                work.append(("visit", node[2]))
+            elif kind == "if" or kind == "ifl":
+                work.append(("if", node))
+                work.append(("visit", node[3]))
+                work.append(("visit", node[2]))
+            else:
+                results.append(rewrite(node))
+        elif action == "block":
+            results.append(("block", node[1], results.pop()))
+        else:
+            value_if_false = results.pop()
+            value_if_true = results.pop()
+            results.append((node[0], node[1], value_if_true, value_if_false))
+    return results[0]
+
+def lower_tail_calls(stm):
+    """
+    Rewrites the body of the `fn` statement, `stm`, to return the state of a
+    loop (see the module docstring), to be wrapped by loop_formula once it's
+    compiled. Returns (the new statement, the number of tail calls found). If
+    there are none, the statement isn't worth turning into a loop.
+    """
+    _, name, line, params, body = stm
+    tail_calls = 0
+
+    def rewrite(expr):
+        nonlocal tail_calls
+        kind = expr[0]
+        if kind == "formula":
+            args = call_arguments(expr[1], name)
+            if args is not None and len(args) <= len(params):
+                args = [arg.strip() for arg in args] + [""] * (len(params) - len(args))
+                if all(arg or bracketed for arg, (_, _, bracketed) in zip(args, params)):
+                    tail_calls += 1
+                    values = [arg or "0" for arg in args]
+                    # Whether each optional parameter is omitted, for ISOMITTED
+                    omitted = ["FALSE" if arg else "TRUE" for arg, (_, _, bracketed) in zip(args, params) if bracketed]
+                    return ("formula", f"HSTACK(FALSE,0,{','.join(values + omitted)})")
+            return ("formula", f"HSTACK(TRUE,{expr[1]})")
+        elif kind == "defined":
+            return ("formula", f"HSTACK(TRUE,{expr[1]})")
+        elif kind == "string":
+            return ("string", f"HSTACK(TRUE,{expr[1]})")
+        else:
+            # A bare name may be an `expr`, which only the code generator can paste in
+            return ("block", [("let", RESULT_NAME, line, expr)], ("formula", f"HSTACK(TRUE,{RESULT_NAME})"))
+
+    if not params:
+        return stm, 0
+    body = rewrite_tail_positions(body, rewrite)
+    return ("fn", name, line, params, body), tail_calls
+
+def unused_name(formula, base):
+    name = base
+    index = 2
+    while re.search(rf"(?<![a-zA-Z0-9_.]){name}(?![a-zA-Z0-9_.])", formula, re.IGNORECASE):
+        name = f"{base}_{index}"
+        index += 1
+    return name
+
+def loop_formula(formula, params, limit=DEFAULT_LIMIT):
+    """
+    Wraps the body of `formula`, the compiled LAMBDA of a statement rewritten
+    by lower_tail_calls with the given `params`, in a loop of at most `limit` steps.
+    """
+    match = lambda_params_pattern.match(formula)
+    prefix = match.group(0)
+    body = formula[match.end():-1]
+    state = unused_name(formula, "loop_state")
+    step = unused_name(formula, "loop_step")
+
+    # The state is [ended, result, parameters..., whether each optional parameter is omitted...]
+    values = []
+    rebind = []
+    omitted = []
+    for i, (param, _, bracketed) in enumerate(params):
+        rebind.append(f"_xlpm.{param},INDEX(_xlpm.{state},{3 + i})")
+        if bracketed:
+            values.append(f"IF(ISOMITTED(_xlpm.{param}),0,_xlpm.{param})")
+            column = 3 + len(params) + len(omitted)
+            omitted.append(f"ISOMITTED(_xlpm.{param})")
+            body = re.sub(rf"(?<![a-zA-Z0-9_.])ISOMITTED\(\s*_xlpm\.{re.escape(param)}\s*\)",
+                          f"INDEX(_xlpm.{state},{column})", body, flags=re.IGNORECASE)
+        else:
+            values.append(f"_xlpm.{param}")
+
+    initial = f"HSTACK(FALSE,0,{','.join(values + omitted)})"
+    width = 2 + len(values) + len(omitted)
+    # An ended loop's state, [TRUE, result], is narrower than any other, and
+    # an array among the parameters or the result makes it the wrong shape
+    ended = f"COLUMNS(_xlpm.{state})=2"
+    step_function = (
+        f"LAMBDA(_xlpm.{state},_xlpm.{step},"
+        f"IF({ended},_xlpm.{state},"
+        f"IF(OR(ROWS(_xlpm.{state})<>1,COLUMNS(_xlpm.{state})<>{width}),HSTACK(TRUE,#VALUE!),"
+        f"LET({','.join(rebind)},{body}))))"
+    )
+    return (
+        f"{prefix}LET(_xlpm.{state},REDUCE({initial},SEQUENCE({limit}),{step_function}),"
+        f"IF({ended},IF(ROWS(_xlpm.{state})=1,INDEX(_xlpm.{state},2),#VALUE!),NA())))"
+    )
@@ -0,0 +1,237 @@
+"""
+Finds the back-tick references in formulas, which paste `expr`s and expand
+`macro`s, and prepares the body of a macro to be expanded (see Macro in best.py).
+
+A reference is either `name`, which pastes an `expr`, or `name(arg, ...)`,
+which expands a `macro` with the given arguments. Arguments are formulas and
+can contain back-tick references themselves, e.g.
+
+    `sum_multiply(2, PI(), `_e`)`
+
+The names that a macro's body binds in Excel (its `let`s, and `fn`s and their
+parameters) would capture the same names in the arguments pasted among them,
+so the clashing ones are renamed in the body before it's compiled:
+
+    macro twice(x) { let t = "`x` * 2"; "t + t" }
+    fn f(t) { "`twice(t)`" }
+
+compiles `twice(t)` as LET(t_2, (t) * 2, t_2 + t_2), which still uses f's `t`.
+"""
+import re
+
+from formula_tokens import token_pattern, parenthesis_pattern, is_sheet_reference
+
+call_pattern = re.compile(r"([a-zA-Z_\\][a-zA-Z0-9_.]*)\s*\(")
+argument_pattern = re.compile(r"""
+    "(?:[^"]|"")*"?
+  | '(?:[^']|'')*'?
+  | [(){},`]
+""", re.VERBOSE)
+
+def parse_reference(string, start):
+    """
+    Parses the back-tick reference that starts at string[start]. Returns (end,
+    name, args) where `args` lists the text of the arguments of a macro call,
+    or is None for `name`, and `end` is None if the reference isn't closed.
+    """
+    call = call_pattern.match(string, start + 1)
+    if call is not None:
+        args = []
+        depth = 0
+        arg_start = position = call.end()
+        while True:
+            token = argument_pattern.search(string, position)
+            if token is None:
+                break
+            text = token.group(0)
+            if text == "`":
+                # A reference in an argument, which may have commas of its own
+                position = parse_reference(string, token.start())[0]
+                if position is None:
+                    break
+                continue
+            position = token.end()
+            if text == "(" or text == "{":
+                depth += 1
+            elif text == ")" or text == "}":
+                if depth == 0:
+                    if text == ")" and string.startswith("`", position):
+                        args.append(string[arg_start:token.start()])
+                        if len(args) == 1 and not args[0].strip():
+                            args = []
+                        return position + 1, call.group(1), args
+                    break
+                depth -= 1
+            elif text == "," and depth == 0:
+                args.append(string[arg_start:token.start()])
+                arg_start = position
+        # Not a call after all, so it's read like any other name
+    close = string.find("`", start + 1)
+    if close < 0:
+        return None, string[start + 1:], None
+    return close + 1, string[start + 1:close], None
+
+def find_references(string):
+    """
+    Yields (start, end, name, args) for each back-tick reference in `string`
+    (see parse_reference). Nothing follows an unclosed reference.
+    """
+    position = string.find("`")
+    while position >= 0:
+        end, name, args = parse_reference(string, position)
+        yield position, end, name, args
+        if end is None:
+            return
+        position = string.find("`", end)
+
+def pasted_names(string):
+    """
+    Returns (the names that the back-tick references in `string` paste,
+    including the ones in the arguments of macros, `string` without them).
+    """
+    names = []
+    parts = []
+    work = [string]
+    while work:
+        text = work.pop()
+        last = 0
+        for start, end, name, args in find_references(text):
+            parts.append(text[last:start])
+            names.append(name)
+            if end is None:
+                last = len(text)
+                break
+            last = end
+            if args:
+                work.extend(args)
+        parts.append(text[last:])
+    return names, " ".join(parts)
+
+def unwrap_parentheses(formula):
+    """`formula` without the parentheses around all of it, if there are any, e.g. "(EXP(1))" becomes "EXP(1)"."""
+    stripped = formula.strip()
+    if not stripped.startswith("("):
+        return formula
+    depth = 0
+    for match in parenthesis_pattern.finditer(stripped):
+        token = match.group(0)
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+            if depth == 0:
+                return stripped[1:-1] if match.end() == len(stripped) else formula
+    return formula
+
+def walk(body):
+    """Yields every statement and expression in the expression, `body`."""
+    stack = [body]
+    while stack:
+        node = stack.pop()
+        yield node
+        kind = node[0]
+        if kind == "block":
+            stack.extend(node[1])
+            stack.append(node[2])
+        elif kind == "if" or kind == "ifl":
+            stack.extend(node[1:])
+        elif kind == "let" or kind == "expr":
+            stack.append(node[3])
+        elif kind == "fn" or kind == "macro":
+            stack.append(node[4])
+
+def bound_names(body):
+    """The names that `let`s and `fn`s in the expression, `body`, bind in Excel."""
+    names = set()
+    for node in walk(body):
+        if node[0] == "let":
+            names.add(node[1])
+        elif node[0] == "fn":
+            names.add(node[1])
+            names.update(param for param, _, _ in node[3])
+    return names
+
+def formula_names(formula):
+    return {match.group("identifier").lower() for match in token_pattern.finditer(formula) if match.group("identifier")}
+
+def rename_names(formula, renames):
+    """Renames the references to the names in `renames` in `formula`, except back-tick references."""
+    def replace(match):
+        identifier = match.group("identifier")
+        if identifier not in renames or formula[match.start() - 1:match.start()] == "`" \
+                or is_sheet_reference(formula, match.start(), match.end()):
+            return match.group(0)
+        return renames[identifier]
+
+    return token_pattern.sub(replace, formula)
+
+def rename(body, renames):
+    """`body` with the names in `renames` renamed wherever they're bound or used."""
+    # Walk down the tree, then rebuild each node from the new nodes below it
+    results = []
+    work = [("visit", body)]
+    while work:
+        action, node = work.pop()
+        kind = node[0]
+        if action == "visit":
+            if kind == "formula":
+                results.append(("formula", rename_names(node[1], renames)))
+            elif kind == "id":
+                results.append(("id", renames.get(node[1], node[1])))
+            elif kind == "string" or kind == "defined":
+                results.append(node)
+            else:
+                work.append(("build", node))
+                if kind == "block":
+                    work.append(("visit", node[2]))
+                    work.extend(("visit", stm) for stm in reversed(node[1]))
+                elif kind == "if" or kind == "ifl":
+                    work.extend(("visit", child) for child in reversed(node[1:]))
+                elif kind == "let" or kind == "expr":
+                    work.append(("visit", node[3]))
+                else:
+                    work.append(("visit", node[4]))
+        elif kind == "block":
+            final_expr = results.pop()
+            statements = results[len(results) - len(node[1]):]
+            del results[len(results) - len(node[1]):]
+            results.append(("block", statements, final_expr))
+        elif kind == "if" or kind == "ifl":
+            children = results[-3:]
+            del results[-3:]
+            results.append((kind, *children))
+        elif kind == "let" or kind == "expr":
+            name = renames.get(node[1], node[1]) if kind == "let" else node[1]
+            results.append((kind, name, node[2], results.pop()))
+        else:
+            _, name, line, params, _ = node
+            if kind == "fn":
+                name = renames.get(name, name)
+                params = [(renames.get(param, param), param_line, bracketed) for param, param_line, bracketed in params]
+            results.append((kind, name, line, params, results.pop()))
+    return results[0]
+
+def hygienic_body(body, args):
+    """
+    The body of a macro with the names it binds that also appear in its
+    arguments, `args`, renamed (see the module docstring).
+    """
+    used = set()
+    for arg in args:
+        used |= formula_names(arg)
+    clashes = sorted(name for name in bound_names(body) if name.lower() in used)
+    if not clashes:
+        return body
+
+    taken = used | {name.lower() for name in bound_names(body)}
+    for node in walk(body):
+        if node[0] == "formula":
+            taken |= formula_names(node[1])
+    renames = {}
+    for name in clashes:
+        index = 2
+        while f"{name}_{index}".lower() in taken:
+            index += 1
+        renames[name] = f"{name}_{index}"
+        taken.add(renames[name].lower())
+    return rename(body, renames)
@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import threading
+
+from diagnostics import warning
+
+# Bump this whenever the lowered module format produced by best.py changes
+CACHE_FORMAT_VERSION = 2
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+# The files that define how Bes files are parsed
+grammar_paths = [os.path.join(script_dir, "Bes.g4"), os.path.join(script_dir, "fast_parser.py")]
+
+def grammar_version():
+    """
+    Identifies the grammar a cached module was parsed with. Any edit to Bes.g4
+    (which regenerates the parser), to the hand-written parser or to the cache
+    format invalidates every entry.
+    """
+    hasher = hashlib.sha256(f"format-{CACHE_FORMAT_VERSION}".encode())
+    for path in grammar_paths:
+        with open(path, "rb") as file:
+            hasher.update(file.read())
+    return hasher.hexdigest()
+
+class ModuleCache:
+    """
+    On-disk cache of lowered Bes modules, keyed by the hash of the file's
+    contents and the grammar version. Unchanged files skip lexing and parsing.
+
+    With `in_memory`, modules are also kept in memory for the life of the
+    cache (e.g. across rebuilds in watch mode), up to `memory_limit` of them
+    if it's given, dropping the ones stored first. `cache_dir` may be None to
+    only cache in memory.
+
+    A cache can be shared by threads. The modules it returns are shared too,
+    so they must not be changed.
+    """
+    def __init__(self, cache_dir, in_memory=False, memory_limit=None):
+        self.cache_dir = cache_dir
+        self.memory = {} if in_memory else None
+        self.memory_limit = memory_limit
+        self.grammar_version = grammar_version()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def remember(self, key, module):
+        with self.lock:
+            self.memory[key] = module
+            if self.memory_limit is not None:
+                while len(self.memory) > self.memory_limit:
+                    del self.memory[next(iter(self.memory))]
+
+    def key(self, contents: str, parser: str):
+        hasher = hashlib.sha256(f"{self.grammar_version}-{parser}".encode())
+        hasher.update(contents.encode("utf-8"))
+        return hasher.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, contents: str, parser="antlr"):
+        key = self.key(contents, parser)
+        module = self.memory.get(key) if self.memory is not None else None
+        if module is not None:
+            self.count(True)
+            return module
+        if self.cache_dir is None:
+            self.count(False)
+            return None
+        try:
+            with open(self.path(key), "r") as file:
+                module = json.load(file)
+        except (OSError, ValueError):
+            self.count(False)
+            return None
+        self.count(True)
+        if self.memory is not None:
+            self.remember(key, module)
+        return module
+
+    def store(self, contents: str, module, parser="antlr"):
+        key = self.key(contents, parser)
+        if self.memory is not None:
+            self.remember(key, module)
+        if self.cache_dir is None:
+            return
+        path = self.path(key)
+        # Write to a temp file first so a concurrent or interrupted build never sees half an entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, "w") as file:
+                json.dump(module, file, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            warning(f"Unable to write to the cache at {self.cache_dir}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        except RecursionError:
+            # Too deeply nested for json (e.g. a very long else if chain), so it's parsed every time
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,174 @@
+"""
+Common-subexpression elimination for compiled formulas (see -O in best.py).
+
+`expr`s are pasted into formulas as text, so the same subformula can appear
+many times in one name, and Excel evaluates every copy. This binds each
+repeated subexpression once in a LET around the formula (or around the body of
+a top-level LAMBDA) and refers to it by name.
+
+Best doesn't parse Excel formulas, so a subexpression is only hoisted when
+it's safe to move it without knowing what it means:
+
+* it doesn't refer to a LAMBDA parameter or LET name (`_xlpm.x`/`_xlop.x`),
+  so it means the same thing everywhere in the formula
+* it isn't inside a nested LAMBDA (e.g. the branches of an `ifl`), which may be
+  there to delay or avoid evaluating it
+* it isn't in an argument that Excel only evaluates when it's needed, e.g. the
+  branches of an IF, which may be guarding against an error like A1/B1
+* it doesn't call a volatile function (e.g. RAND), whose copies differ, or the
+  name being defined, which could make a recursive function never return
+* it isn't the argument list of a call, e.g. the (1, 2) of LAMBDA(x, y, x+y)(1, 2)
+"""
+import re
+
+from formula_tokens import token_pattern
+
+# Optimization levels
+# 1: hoist repeated parenthesized subexpressions, e.g. the ones `expr`s are pasted in as
+# 2: also hoist repeated function calls, e.g. SUM(A1:A10)
+MAX_LEVEL = 2
+
+VOLATILE_FUNCTIONS = {"RAND", "RANDBETWEEN", "RANDARRAY", "NOW", "TODAY", "OFFSET", "INDIRECT", "CELL", "INFO"}
+
+# Functions that only evaluate their first argument every time, and the others when they're needed
+LAZY_FUNCTIONS = {"IF", "IFS", "IFERROR", "IFNA", "CHOOSE", "SWITCH"}
+
+# Tokens that matter for finding subexpressions: strings and sheet names (skipped), identifiers, parentheses,
+# and commas and braces, which separate arguments unless they're in an array constant
+scan_pattern = re.compile(rf"{token_pattern.pattern}|(?P<open>\()|(?P<close>\))|(?P<comma>,)|(?P<brace>[{{}}])",
+                          re.VERBOSE)
+lambda_params_pattern = re.compile(r"LAMBDA\(((?:_xl(?:pm|op)\.[a-zA-Z_\\][a-zA-Z0-9_.]*,)*)", re.IGNORECASE)
+local_name_pattern = re.compile(r"_xl(?:pm|op)\.", re.IGNORECASE)
+
+def subexpressions(formula, level, name):
+    """
+    Maps the text of each subexpression of `formula` that could be hoisted to
+    the list of its (start, end) spans.
+    """
+    candidates = {}
+    # Each open parenthesis: (start of the subexpression, the function called or None, whether it's in a LAMBDA
+    # or a lazy argument, whether it's the arguments of whatever the group before it returns)
+    stack = []
+    # Identifiers in the subexpressions that are currently open
+    called = [set()]
+    # The number of arguments of each open subexpression that have been passed so far
+    commas = [0]
+    braces = 0
+    last_identifier = None
+    last_close = None
+    for match in scan_pattern.finditer(formula):
+        kind = match.lastgroup
+        if kind == "identifier":
+            last_identifier = match
+            last_close = None
+            called[-1].add(match.group(0).upper())
+            continue
+        if kind == "open":
+            function = None
+            start = match.start()
+            if last_identifier is not None and last_identifier.end() == match.start():
+                function = last_identifier.group(0).upper()
+                start = last_identifier.start()
+            in_lambda = function == "LAMBDA" or bool(stack and stack[-1][2])
+            if stack and commas[-1] > 0 and stack[-1][1] is not None \
+                    and stack[-1][1].removeprefix("_XLFN.") in LAZY_FUNCTIONS:
+                in_lambda = True
+            arguments = function is None and last_close is not None and not formula[last_close:start].strip()
+            stack.append((start, function, in_lambda, arguments))
+            called.append(set())
+            commas.append(0)
+            last_close = None
+        elif kind == "close" and stack:
+            start, function, in_lambda, arguments = stack.pop()
+            identifiers = called.pop()
+            called[-1] |= identifiers
+            commas.pop()
+            end = match.end()
+            last_close = end
+            if in_lambda or arguments or (function is not None and level < 2):
+                pass
+            elif identifiers & VOLATILE_FUNCTIONS or name.upper() in identifiers:
+                pass
+            elif local_name_pattern.search(formula, start, end):
+                pass
+            else:
+                candidates.setdefault(formula[start:end], []).append((start, end))
+        else:
+            if kind == "comma" and not braces:
+                commas[-1] += 1
+            elif kind == "brace":
+                braces += 1 if match.group(0) == "{" else -1
+            last_close = None
+        last_identifier = None
+    return candidates
+
+def has_top_level_comma(group):
+    """Whether the parenthesized `group`, e.g. the union (A1,B1), has a comma that isn't in a nested call."""
+    depth = 0
+    braces = 0
+    for match in scan_pattern.finditer(group):
+        kind = match.lastgroup
+        if kind == "open":
+            depth += 1
+        elif kind == "close":
+            depth -= 1
+        elif kind == "brace":
+            braces += 1 if match.group(0) == "{" else -1
+        elif kind == "comma" and depth == 1 and not braces:
+            return True
+    return False
+
+def unused_name(formula, index):
+    while True:
+        name = f"cse_{index}"
+        if not re.search(rf"(?<![a-zA-Z0-9_.]){name}(?![a-zA-Z0-9_.])", formula):
+            return name, index + 1
+        index += 1
+
+def eliminate_common_subexpressions(formula, level, name, is_function=False):
+    """
+    Returns `formula`, the compiled formula of `name`, with its repeated
+    subexpressions bound in a LET (see the module docstring). If `is_function`,
+    `formula` is the LAMBDA of an `fn` and they are bound inside it. Formulas
+    without any are returned unchanged.
+    """
+    if level <= 0:
+        return formula
+
+    prefix = ""
+    body = formula
+    if is_function:
+        # Bind them inside the function, where they'd be evaluated anyway
+        match = lambda_params_pattern.match(formula)
+        prefix = match.group(0)
+        body = formula[match.end():-1]
+
+    bindings = []
+    index = 1
+    while True:
+        repeated = [
+            (text, spans) for text, spans in subexpressions(body, level, name).items()
+            if len(spans) > 1 and len(text) > len("_xlpm.cse_1")
+        ]
+        if not repeated:
+            break
+        # Hoist the one that removes the most text first; the ones inside it go with it
+        text, spans = max(repeated, key=lambda item: (len(item[0]) * (len(item[1]) - 1), -item[1][0][0]))
+        binding, index = unused_name(formula, index)
+        reference = f"_xlpm.{binding}"
+        parts = []
+        last = 0
+        for start, end in spans:
+            parts.append(body[last:start])
+            parts.append(reference)
+            last = end
+        parts.append(body[last:])
+        body = "".join(parts)
+        # The parentheses of a union are part of its value, and without them its commas would separate LET arguments
+        value = text[1:-1] if text.startswith("(") and not has_top_level_comma(text) else text
+        bindings.append(f"_xlpm.{binding},{value},")
+
+    if not bindings:
+        return formula
+    body = f"LET({''.join(bindings)}{body})"
+    return f"{prefix}{body})" if prefix else body
@@ -0,0 +1,291 @@
+"""
+Splits formulas that are too long or too deeply nested for Excel into helper
+names (see --max-formula-length and --max-nesting in best.py).
+
+Excel refuses to open a workbook with a defined name longer than 8192
+characters or nested more than 64 levels deep, and pasting `expr`s and adding
+the _xlfn. and _xlpm. prefixes make Best's formulas long. A formula over
+either budget has a subexpression (a function call or a parenthesized group)
+moved into a new name, e.g. `total_part1`, which it then refers to in its
+place. If the subexpression uses LAMBDA parameters or LET names from around
+it, the new name is a LAMBDA that takes them as arguments:
+
+    LAMBDA(_xlpm.x,SUM(... _xlpm.x ...) + 1)
+    total_part1: LAMBDA(_xlpm.x,SUM(... _xlpm.x ...))
+    total:       LAMBDA(_xlpm.x,total_part1(_xlpm.x) + 1)
+
+The names a LET binds after its first few can go to a helper too, since a LET
+with many names (e.g. the `let`s of a big `fn`) can be too long by itself:
+LET(_xlpm.a,1,_xlpm.b,2,_xlpm.a+_xlpm.b) becomes LET(_xlpm.a,1,total_part1(_xlpm.a))
+with total_part1 as LAMBDA(_xlpm.a,LET(_xlpm.b,2,_xlpm.a+_xlpm.b)).
+
+The call is made where the subexpression was, so it's evaluated exactly when
+and as often as before. An omitted argument can't be passed on, so
+ISOMITTED(_xlpm.x) of a parameter from around the subexpression is worked out
+where the call is and passed to the helper as another argument.
+Subexpressions that are called right away (e.g. LAMBDA(...)()) are left where
+they are.
+"""
+import re
+from bisect import bisect_left
+
+from formula_tokens import token_pattern, nesting_depth
+
+# Excel's limits on a formula
+MAX_LENGTH = 8192
+MAX_DEPTH = 64
+# The longest name Best writes (see validate_name in best.py)
+MAX_NAME_LENGTH = 250
+
+scan_pattern = re.compile(rf"{token_pattern.pattern}|(?P<open>\()|(?P<close>\))|(?P<comma>,)|(?P<brace>[{{}}])", re.VERBOSE)
+local_name_pattern = re.compile(r"_xl(?:pm|op)\.([a-zA-Z_\\][a-zA-Z0-9_.]*)", re.IGNORECASE)
+isomitted_pattern = re.compile(r"(?:_xlfn\.)?ISOMITTED\(\s*_xlpm\.([a-zA-Z_\\][a-zA-Z0-9_.]*)\s*\)", re.IGNORECASE)
+called_pattern = re.compile(r"\s*\(")
+
+class Group:
+    """
+    A function call or parenthesized group in a formula, from `start` to
+    `end`. With `let_tail`, it's the names a LET binds from the one at `start`
+    on, and its body, up to (but not including) the closing parenthesis.
+    """
+    def __init__(self, start, function, depth, let_tail=False):
+        self.start = start
+        self.end = None
+        self.function = function
+        self.let_tail = let_tail
+        # Depth of its parentheses, and the deepest ones in it
+        self.depth = depth
+        self.deepest = depth
+        self.arg_start = None
+        self.arg_index = 0
+        # Local name: where it's bound
+        self.bound = {}
+        # Where the names bound by a LET start
+        self.binding_starts = []
+
+    @property
+    def inner_depth(self):
+        return self.deepest - self.depth + 1
+
+def scan(formula):
+    """
+    Returns the groups in `formula` (including the tails of LETs), the
+    references to local names as (position, lower case name, where it's bound
+    or -1, name) and the ISOMITTED calls as (start, end, lower case name,
+    where it's bound or -1, name), with None for all but the start if the
+    argument isn't a local name.
+    """
+    groups = []
+    references = []
+    isomitted = []
+    stack = []
+    braces = 0
+    last_identifier = None
+    for match in scan_pattern.finditer(formula):
+        kind = match.lastgroup
+        if kind == "identifier":
+            last_identifier = match
+            text = match.group(0)
+            local = local_name_pattern.fullmatch(text)
+            if local is not None:
+                name = local.group(1).lower()
+                binder = next((group.bound[name] for group in reversed(stack) if name in group.bound), -1)
+                references.append((match.start(), name, binder, local.group(1)))
+            elif text.upper() in ("ISOMITTED", "_XLFN.ISOMITTED"):
+                call = isomitted_pattern.match(formula, match.start())
+                if call is None:
+                    isomitted.append((match.start(), None, None, None, None))
+                else:
+                    name = call.group(1).lower()
+                    binder = next((group.bound[name] for group in reversed(stack) if name in group.bound), -1)
+                    isomitted.append((match.start(), call.end(), name, binder, call.group(1)))
+            continue
+        if kind == "open":
+            function = None
+            start = match.start()
+            if last_identifier is not None and last_identifier.end() == match.start():
+                function = last_identifier.group(0).upper()
+                if function.startswith("_XLFN."):
+                    function = function[len("_XLFN."):]
+                start = last_identifier.start()
+            group = Group(start, function, len(stack) + 1)
+            group.arg_start = match.end()
+            stack.append(group)
+        elif kind == "close" and stack:
+            group = stack.pop()
+            group.end = match.end()
+            if stack:
+                stack[-1].deepest = max(stack[-1].deepest, group.deepest)
+            groups.append(group)
+            # A tail needs a name and a value, and leaves at least one name in the LET
+            for binding_start in group.binding_starts[1:]:
+                tail = Group(binding_start, "LET", group.depth, let_tail=True)
+                tail.end = match.start()
+                tail.deepest = group.deepest
+                groups.append(tail)
+        elif kind == "comma" and stack and not braces:
+            group = stack[-1]
+            if group.function == "LAMBDA" or (group.function == "LET" and group.arg_index % 2 == 0):
+                # A parameter or a LET name, which is in scope for the rest of the group
+                local = local_name_pattern.fullmatch(formula[group.arg_start:match.start()].strip())
+                if local is not None:
+                    group.bound[local.group(1).lower()] = group.arg_start
+                    if references and references[-1][0] >= group.arg_start:
+                        references.pop()
+                    if group.function == "LET":
+                        group.binding_starts.append(group.arg_start)
+            group.arg_index += 1
+            group.arg_start = match.end()
+        elif kind == "brace":
+            braces += 1 if match.group(0) == "{" else -1
+        last_identifier = None
+    return groups, references, isomitted
+
+def free_names(group, references, positions, skipped=()):
+    """
+    The local names used in `group` that are bound outside of it, in order of
+    first use, except the ones used between the (start, end) spans in `skipped`.
+    """
+    names = {}
+    for i in range(bisect_left(positions, group.start), bisect_left(positions, group.end)):
+        position, key, binder, name = references[i]
+        # Bound before the group, or not at all
+        if binder < group.start and key not in names and not any(start <= position < end for start, end in skipped):
+            names[key] = name
+    return list(names.values())
+
+def unused_local_name(formula, base):
+    used = {name.lower() for name in local_name_pattern.findall(formula)}
+    name = base
+    index = 2
+    while name.lower() in used:
+        name = f"{base}_{index}"
+        index += 1
+    return name
+
+def helper_name(name, taken):
+    """The first name_partN that isn't in `taken`, with `name` shortened to keep it under MAX_NAME_LENGTH."""
+    index = 1
+    while True:
+        suffix = f"_part{index}"
+        helper = f"{name[:MAX_NAME_LENGTH - len(suffix)]}{suffix}"
+        if helper.lower() not in taken:
+            return helper
+        index += 1
+
+def outline_one(formula, name, max_length, max_depth, lambda_prefix, taken, helpers):
+    """
+    Moves one subexpression of `formula` into a helper name, or refers to the
+    one in `helpers` (helper formula: name) with the same formula. Returns (the
+    new formula, the helper's name, its formula), or None if nothing can be moved.
+    """
+    groups, references, isomitted = scan(formula)
+    positions = [reference[0] for reference in references]
+    isomitted_positions = [call[0] for call in isomitted]
+    depth = nesting_depth(formula)
+    too_deep = depth > max_depth
+
+    candidates = []
+    for group in groups:
+        if group.start == 0 and group.end == len(formula):
+            continue
+        if too_deep and (group.deepest < depth or group.let_tail):
+            continue
+        if called_pattern.match(formula, group.end):
+            continue
+        if group.inner_depth + 1 > max_depth or group.end - group.start > max_length:
+            continue
+        candidates.append(group)
+    if too_deep:
+        # Of the groups around the deepest parentheses, the biggest that fits takes the most levels off
+        candidates.sort(key=lambda group: (-group.inner_depth, -(group.end - group.start), group.start))
+    else:
+        candidates.sort(key=lambda group: (-(group.end - group.start), group.start))
+
+    for group in candidates:
+        calls = isomitted[bisect_left(isomitted_positions, group.start):bisect_left(isomitted_positions, group.end)]
+        if any(call[1] is None for call in calls):
+            continue
+        # ISOMITTED of a parameter from outside the group
+        outside = [call for call in calls if call[3] < group.start]
+
+        parts = []
+        last = group.start
+        flags = {}
+        for start, end, key, _, param in outside:
+            if key not in flags:
+                flags[key] = (param, unused_local_name(formula, f"{param}_omitted"))
+            parts.append(formula[last:start])
+            parts.append(f"_xlpm.{flags[key][1]}")
+            last = end
+        parts.append(formula[last:group.end])
+        text = "".join(parts)
+
+        params = [f"_xlpm.{param}" for param in free_names(group, references, positions, [call[:2] for call in outside])]
+        arguments = params + [f"{lambda_prefix}ISOMITTED(_xlpm.{param})" for param, _ in flags.values()]
+        params += [f"_xlpm.{flag}" for _, flag in flags.values()]
+        if group.let_tail:
+            if lambda_prefix is None:
+                continue
+            text = f"{lambda_prefix}LET({text})"
+        if params:
+            if lambda_prefix is None:
+                continue
+            helper_formula = f"{lambda_prefix}LAMBDA({','.join(params)},{text})"
+        else:
+            helper_formula = text
+        helper = helpers.get(helper_formula) or helper_name(name, taken)
+        reference = f"{helper}({','.join(arguments)})" if params else helper
+        if len(helper_formula) > max_length or nesting_depth(helper_formula) > max_depth:
+            continue
+        # Unless the reference takes fewer levels or characters, nothing is gained
+        if too_deep and nesting_depth(reference) >= group.inner_depth:
+            continue
+        if not too_deep and len(reference) >= len(text):
+            continue
+        return f"{formula[:group.start]}{reference}{formula[group.end:]}", helper, helper_formula
+    return None
+
+def outline(lets, max_length=MAX_LENGTH, max_depth=MAX_DEPTH, lambda_prefix="", reserved=()):
+    """
+    Splits the formulas in `lets` that are longer than `max_length` or nested
+    deeper than `max_depth` (see the module docstring). `lambda_prefix` is put
+    before the LAMBDAs of the helpers, or is None if LAMBDA isn't available.
+    Helpers aren't given the names in `reserved`, e.g. ones already in the workbook.
+    Returns the new dict of names, with each helper right after the name it
+    was split from, and {name: (helpers, the names' formulas still over budget)}.
+    """
+    taken = {name.lower() for name in lets} | {name.lower() for name in reserved}
+    result = {}
+    split = {}
+    for name, formula in lets.items():
+        if len(formula) <= max_length and nesting_depth(formula) <= max_depth:
+            result[name] = formula
+            continue
+        # Helper formula: name, and name: final formula
+        created = {}
+        helpers = {}
+        # The helpers are split in turn, in case they are still too big
+        work = [(name, formula)]
+        while work:
+            current, text = work.pop()
+            while len(text) > max_length or nesting_depth(text) > max_depth:
+                outlined = outline_one(text, name, max_length, max_depth, lambda_prefix, taken, created)
+                if outlined is None:
+                    break
+                text, helper, helper_formula = outlined
+                if helper_formula not in created:
+                    created[helper_formula] = helper
+                    taken.add(helper.lower())
+                    work.append((helper, helper_formula))
+            helpers[current] = text
+        result[name] = helpers.pop(name)
+        # In the order they were made
+        names = sorted(helpers, key=lambda helper: int(helper.rpartition("_part")[2]))
+        result.update((helper, helpers[helper]) for helper in names)
+        over = [
+            defined for defined in [name, *names]
+            if len(result[defined]) > max_length or nesting_depth(result[defined]) > max_depth
+        ]
+        split[name] = (names, over)
+    return result, split
@@ -0,0 +1,85 @@
+import json
+import time
+import contextlib
+
+import formula_tokens
+
+class Profiler:
+    """
+    Collects the wall time of each phase of a build (see --profile), the time
+    spent on each source file and statistics about each compiled name.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.files = {}
+        self.definitions = {}
+        # The file each top-level name is defined in
+        self.sources = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, (time.perf_counter() - start) * 1000)
+
+    def add_phase(self, name, ms):
+        self.phases[name] = self.phases.get(name, 0) + ms
+
+    def parsed(self, path, ms, cached, names):
+        """Records that the file at `path`, which defines `names`, was loaded in `ms`."""
+        file = self.files.setdefault(path, {"parse_ms": 0, "cached": cached, "names": 0, "compile_ms": 0})
+        file["parse_ms"] += ms
+        for name in names:
+            self.sources[name] = path
+
+    def compiled(self, name, ms, expansions):
+        """Records that the top-level name, `name`, was compiled in `ms`."""
+        path = self.sources.get(name)
+        self.definitions[name] = {"file": path, "compile_ms": ms, "expansions": expansions}
+        if path in self.files:
+            self.files[path]["names"] += 1
+            self.files[path]["compile_ms"] += ms
+
+    def formulas(self, lets):
+        """Records the length and nesting depth of the final formula of each name."""
+        for name, definition in self.definitions.items():
+            if name in lets:
+                definition["length"] = len(lets[name])
+                definition["depth"] = formula_tokens.nesting_depth(lets[name])
+
+    def to_json(self):
+        return {"phases_ms": self.phases, "files": self.files, "names": self.definitions}
+
+    def save_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_json(), file, indent=1)
+
+    def report(self, top=20):
+        lines = ["Phases:"]
+        total = sum(self.phases.values())
+        for name, ms in self.phases.items():
+            share = ms / total * 100 if total else 0
+            lines.append(f"  {name:16} {ms:10.1f} ms {share:5.1f}%")
+        lines.append(f"  {'total':16} {total:10.1f} ms")
+
+        lines.append("Files:")
+        for path, file in self.files.items():
+            parsed = "cached" if file["cached"] else f"parsed in {file['parse_ms']:.1f} ms"
+            lines.append(f"  {path}: {parsed}, {file['names']} names compiled in {file['compile_ms']:.1f} ms")
+
+        slowest = sorted(self.definitions.items(), key=lambda item: item[1]["compile_ms"], reverse=True)[:top]
+        if slowest:
+            lines.append(f"Slowest names (of {len(self.definitions)}):")
+            lines.append(f"  {'name':30} {'ms':>8} {'length':>8} {'depth':>6} {'expansions':>10}")
+            for name, definition in slowest:
+                lines.append(f"  {name:30} {definition['compile_ms']:8.2f} {definition.get('length', 0):8} "
+                             f"{definition.get('depth', 0):6} {definition['expansions']:10}")
+        return "\n".join(lines)
+
+def phase(profiler, name):
+    """profiler.phase(name), or nothing if `profiler` is None."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
@@ -0,0 +1,219 @@
+import os
+import re
+import struct
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+
+from zip_format import WorkbookFormatError, check_zip32, dos_date_time
+
+WORKBOOK_PART = "xl/workbook.xml"
+
+# Elements that come after <definedNames> in a <workbook>, in schema order
+FOLLOWING_ELEMENTS = ["calcPr", "oleSize", "customWorkbookViews", "pivotCaches", "smartTagPr", "smartTagTypes",
+                      "webPublishing", "fileRecoveryPr", "webPublishObjects", "extLst"]
+
+# Names that openpyxl binds to worksheets rather than the workbook
+SHEET_NAMES = ("_xlnm.Print_Titles", "_xlnm.Print_Area", "_xlnm._FilterDatabase")
+
+root_pattern = re.compile(r"<(?P<prefix>(?:[\w.-]+:)?)workbook\b[^>]*>")
+
+def defined_names_pattern(prefix):
+    prefix = re.escape(prefix)
+    return re.compile(rf"<{prefix}definedNames\b[^>]*?(?:/>|>.*?</{prefix}definedNames>)", re.DOTALL)
+
+def insertion_pattern(prefix):
+    prefix = re.escape(prefix)
+    return re.compile(rf"<{prefix}(?:{'|'.join(FOLLOWING_ELEMENTS)})\b|</{prefix}workbook>")
+
+class DefinedNamesWorkbook:
+    """
+    Stands in for an openpyxl Workbook when only the defined names are read or
+    changed. Only xl/workbook.xml is parsed; save() rewrites its <definedNames>
+    and copies every other part of the .xlsx byte-for-byte, so the time and
+    memory it takes don't depend on the size of the sheets.
+
+    Like with openpyxl, `defined_names` holds the workbook-scoped names.
+    """
+    def __init__(self, filepath):
+        from openpyxl.workbook.defined_name import DefinedNameDict, DefinedNameList
+
+        self.filepath = filepath
+        with zipfile.ZipFile(filepath) as archive:
+            check_zip32(archive)
+            try:
+                self.workbook_xml = archive.read(WORKBOOK_PART).decode("utf-8")
+            except KeyError:
+                raise WorkbookFormatError(f"{filepath} has no {WORKBOOK_PART}")
+
+        root = root_pattern.search(self.workbook_xml)
+        if root is None:
+            raise WorkbookFormatError(f"Unable to find the <workbook> element in {filepath}")
+        self.root_tag = root.group(0)
+        self.prefix = root.group("prefix")
+        self.span = None
+
+        self.defined_names = DefinedNameDict()
+        # Sheet-scoped names are written back untouched
+        self.other_names = []
+
+        match = defined_names_pattern(self.prefix).search(self.workbook_xml, root.end())
+        if match is None:
+            return
+        self.span = match.span()
+        wrapped = f"{self.root_tag}{match.group(0)}</{self.prefix}workbook>"
+        for defn in DefinedNameList.from_tree(ET.fromstring(wrapped)[0]).definedName:
+            if defn.localSheetId is None and defn.name not in SHEET_NAMES:
+                self.defined_names[defn.name] = defn
+            else:
+                self.other_names.append(defn)
+
+    def defined_names_xml(self):
+        names = list(self.defined_names.values()) + self.other_names
+        if not names:
+            return ""
+        parts = [f"<{self.prefix}definedNames>"]
+        for defn in names:
+            element = defn.to_tree()
+            element.tag = f"{self.prefix}definedName"
+            parts.append(ET.tostring(element, encoding="unicode"))
+        parts.append(f"</{self.prefix}definedNames>")
+        return "".join(parts)
+
+    def patched_workbook_xml(self):
+        if self.span is not None:
+            start, end = self.span
+        else:
+            root_end = self.workbook_xml.index(self.root_tag) + len(self.root_tag)
+            start = end = insertion_pattern(self.prefix).search(self.workbook_xml, root_end).start()
+        return f"{self.workbook_xml[:start]}{self.defined_names_xml()}{self.workbook_xml[end:]}"
+
+    def save(self, filepath):
+        # Write next to the destination first, since the input and output may be the same file
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as out:
+                replace_zip_member(self.filepath, out, WORKBOOK_PART, self.patched_workbook_xml().encode("utf-8"))
+            os.replace(tmp_path, filepath)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def local_entry_length(src, info):
+    src.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, src.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+        raise WorkbookFormatError(f"Bad local header for {info.filename}")
+    filename_length, extra_length = header[10], header[11]
+    length = zipfile.sizeFileHeader + filename_length + extra_length + info.compress_size
+    if info.flag_bits & 0x08:
+        # The sizes follow the data in a data descriptor, which may or may not have a signature
+        src.seek(info.header_offset + length)
+        length += 16 if src.read(4) == b"PK\x07\x08" else 12
+    return length
+
+def copy_bytes(src, out, offset, length, chunk_size=1 << 20):
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(chunk_size, length))
+        if not chunk:
+            raise WorkbookFormatError("Unexpected end of file")
+        out.write(chunk)
+        length -= len(chunk)
+
+def replace_zip_member(src_path, out, member, data):
+    """
+    Writes a copy of the zip archive at `src_path` to `out` with the contents
+    of `member` replaced by `data`. Every other member is copied as-is without
+    being decompressed.
+    """
+    with open(src_path, "rb") as src, zipfile.ZipFile(src) as archive:
+        check_zip32(archive)
+        infos = archive.infolist()
+
+        central_dir = []
+        for info in infos:
+            filename = info.orig_filename.encode("utf-8" if info.flag_bits & 0x800 else "cp437")
+            offset = out.tell()
+            dostime, dosdate = dos_date_time(info.date_time)
+
+            if info.filename == member:
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                compressed = compressor.compress(data) + compressor.flush()
+                flag_bits = info.flag_bits & 0x800
+                compress_type = zipfile.ZIP_DEFLATED
+                crc = zlib.crc32(data)
+                compress_size = len(compressed)
+                file_size = len(data)
+                out.write(struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, 20, 0, flag_bits,
+                                      compress_type, dostime, dosdate, crc, compress_size, file_size, len(filename), 0))
+                out.write(filename)
+                out.write(compressed)
+                extract_version = 20
+                extra = b""
+            else:
+                copy_bytes(src, out, info.header_offset, local_entry_length(src, info))
+                flag_bits = info.flag_bits
+                compress_type = info.compress_type
+                crc, compress_size, file_size = info.CRC, info.compress_size, info.file_size
+                extract_version = info.extract_version
+                extra = info.extra
+
+            central_dir.append(struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, info.create_version,
+                                           info.create_system, extract_version, info.reserved, flag_bits,
+                                           compress_type, dostime, dosdate, crc, compress_size, file_size,
+                                           len(filename), len(extra), len(info.comment), 0, info.internal_attr,
+                                           info.external_attr, offset) + filename + extra + info.comment)
+
+        central_dir_offset = out.tell()
+        if central_dir_offset >= 0xFFFFFFFF:
+            raise WorkbookFormatError("Zip64 archives are not supported")
+        central_dir = b"".join(central_dir)
+        out.write(central_dir)
+        out.write(struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, len(infos), len(infos),
+                              len(central_dir), central_dir_offset, len(archive.comment)))
+        out.write(archive.comment)
+
+def iter_defined_name_elements(filepath):
+    """
+    Yields the <definedName> elements of the workbook at `filepath` as they are
+    parsed, without reading anything past the end of its <definedNames> element.
+    Each element is cleared once the next one is requested.
+    """
+    with zipfile.ZipFile(filepath) as archive:
+        try:
+            stream = archive.open(WORKBOOK_PART)
+        except KeyError:
+            raise WorkbookFormatError(f"{filepath} has no {WORKBOOK_PART}")
+        with stream:
+            for _, element in ET.iterparse(stream, events=("end",)):
+                tag = element.tag.rpartition("}")[2]
+                if tag == "definedName":
+                    yield element
+                    element.clear()
+                elif tag == "definedNames":
+                    return
+
+def iter_defined_names(filepath, workbook_scoped=True):
+    """
+    Yields the defined names of the workbook at `filepath` as they are parsed
+    (see iter_defined_name_elements). With `workbook_scoped`, names that
+    openpyxl would bind to a sheet are skipped.
+    """
+    # Imported here so that iter_defined_name_values doesn't load openpyxl
+    from openpyxl.workbook.defined_name import DefinedName
+
+    for element in iter_defined_name_elements(filepath):
+        defn = DefinedName.from_tree(element)
+        if not workbook_scoped or (defn.localSheetId is None and defn.name not in SHEET_NAMES):
+            yield defn
+
+def iter_defined_name_values(filepath):
+    """
+    Yields (name, comment, value) for each workbook-scoped defined name, like
+    iter_defined_names but without building openpyxl objects.
+    """
+    for element in iter_defined_name_elements(filepath):
+        name = element.get("name")
+        if element.get("localSheetId") is None and name not in SHEET_NAMES:
+            yield name, element.get("comment"), element.text
@@ -0,0 +1,25 @@
+"""Zip helpers shared by workbook_xml.py and backup_store.py, which don't need openpyxl."""
+import struct
+
+class WorkbookFormatError(ValueError):
+    """The workbook can't be patched in place and has to be loaded with openpyxl."""
+
+def dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+def has_zip64_extra(extra):
+    while len(extra) >= 4:
+        header_id, size = struct.unpack("<HH", extra[:4])
+        if header_id == 1:
+            return True
+        extra = extra[4 + size:]
+    return False
+
+def check_zip32(archive):
+    infos = archive.infolist()
+    if len(infos) >= 0xFFFF:
+        raise WorkbookFormatError("Zip64 archives are not supported")
+    for info in infos:
+        if max(info.header_offset, info.compress_size, info.file_size) >= 0xFFFFFFFF or has_zip64_extra(info.extra):
+            raise WorkbookFormatError("Zip64 archives are not supported")